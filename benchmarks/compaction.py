@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Measure history compaction against large synthetic namespaces
+
+Run from the repository root:
+    python -m benchmarks.compaction --sizes 1000 10000 50000
+
+Each namespace holds conversations on a few hundred topics spread over several months,
+with a share of near-duplicate questions. Reported per size: how long compaction takes,
+conversations before and after, and query latency and payload size before and after.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from benchmarks.common import summarize
+from compaction import HistoryCompactor
+from context_assembly import assemble_payload
+from dedup import DedupVectorStore, content_hash
+from document_store import DocumentVectorStore, ConversationDocumentStore
+from namespace_stats import StatsVectorStore
+from vector_store import LocalVectorStore, EMBEDDING_DIMENSION
+
+NAMESPACE = "benchmark-user"
+
+def synthetic_records(count, topics, duplicate_share, days, rng):
+    """Conversations scattered around topic centres, timestamps spread evenly over the last `days`"""
+    centres = rng.standard_normal((topics, EMBEDDING_DIMENSION)).astype(np.float32)
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+    now = datetime.now()
+    records = []
+    previous = None
+    for i in range(count):
+        if previous is not None and rng.random() < duplicate_share:
+            # The same question asked again with slightly different wording
+            vector = previous + rng.standard_normal(EMBEDDING_DIMENSION).astype(np.float32) * 0.01
+        else:
+            topic = int(rng.integers(topics))
+            vector = centres[topic] + rng.standard_normal(EMBEDDING_DIMENSION).astype(np.float32) * 0.02
+        vector /= np.linalg.norm(vector)
+        previous = vector
+        user_prompt = f"How do I handle case {i} in module_{i % topics}.process_request?"
+        ai_response = f"Check the input for case {i} before calling process_request. " * 20
+        records.append({
+            "id": str(uuid.uuid4()),
+            "values": vector.tolist(),
+            "metadata": {
+                "user_prompt": user_prompt,
+                "ai_response": ai_response,
+                "content_hash": content_hash(user_prompt, ai_response),
+                "timestamp": (now - timedelta(days=days * i / count)).isoformat(),
+            }
+        })
+    return records, centres
+
+async def measure_queries(store, queries):
+    """Latency of a top-10 search plus body hydration, and the payload size it produces"""
+    latencies = []
+    payload_bytes = []
+    for vector in queries:
+        start_time = time.perf_counter()
+        matches = (await store.query(vector.tolist(), NAMESPACE, top_k=10)).matches
+        await store.hydrate(matches)
+        latencies.append(time.perf_counter() - start_time)
+        payload, _ = assemble_payload("How do I handle this case?", None, matches)
+        payload_bytes.append(len(json.dumps(payload)))
+    return summarize(latencies), round(sum(payload_bytes) / len(payload_bytes))
+
+async def run(size, args):
+    rng = np.random.default_rng(args.seed)
+    records, centres = synthetic_records(size, args.topics, args.duplicate_share, args.days, rng)
+    store = StatsVectorStore(DedupVectorStore(DocumentVectorStore(
+        LocalVectorStore(path=""), documents=ConversationDocumentStore(":memory:")
+    )), reconcile_seconds=0)
+    for start in range(0, len(records), 1000):
+        await store.upsert(records[start:start + 1000], NAMESPACE)
+    queries = centres[rng.integers(len(centres), size=args.queries)]
+
+    before, payload_before = await measure_queries(store, queries)
+    compactor = HistoryCompactor(store, max_conversations=args.max_conversations)
+    report = await compactor.compact_namespace(NAMESPACE)
+    after, payload_after = await measure_queries(store, queries)
+    await store.close()
+
+    print(f"{size:>7} conversations  compacted in {report['seconds']:>7.2f}s  "
+          f"{report['conversations_before']} -> {report['conversations_after']}  "
+          f"(duplicates {report['duplicates_merged']}, summarized {report['summarized']} into "
+          f"{report['summaries_written']}, over cap {report['over_cap']})")
+    print(f"{'':>7} query p50 {before['p50_ms']:.2f} -> {after['p50_ms']:.2f} ms  "
+          f"p95 {before['p95_ms']:.2f} -> {after['p95_ms']:.2f} ms  "
+          f"payload {payload_before} -> {payload_after} bytes")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--topics", type=int, default=300)
+    parser.add_argument("--duplicate-share", type=float, default=0.2)
+    parser.add_argument("--days", type=float, default=180)
+    parser.add_argument("--max-conversations", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        asyncio.run(run(size, args))
+
+if __name__ == "__main__":
+    main()
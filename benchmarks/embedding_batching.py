@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Compare one-at-a-time embedding encodes against dynamic micro-batching
+
+Run from the repository root:
+    python -m benchmarks.embedding_batching --concurrency 32 --requests 512
+"""
+
+import argparse
+import asyncio
+import time
+from sentence_transformers import SentenceTransformer
+
+from benchmarks.common import percentile
+from embeddings import EmbeddingService
+
+async def run_load(service, texts, concurrency):
+    """Encode every text with a fixed number of concurrent callers"""
+    latencies = []
+    pending = iter(texts)
+
+    async def caller():
+        for text in pending:
+            start_time = time.perf_counter()
+            await service.encode(text)
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(caller() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start_time
+    await service.close()
+    return elapsed, latencies
+
+def report(name, elapsed, latencies, service):
+    print(f"{name:<14} {len(latencies) / elapsed:>9.1f} texts/s   "
+          f"p50 {percentile(latencies, 50) * 1000:>7.1f} ms   "
+          f"p99 {percentile(latencies, 99) * 1000:>7.1f} ms   "
+          f"batches {service.stats().get('batches', len(latencies))}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--requests", type=int, default=512)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--window-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    model = SentenceTransformer(args.model)
+    # Unique texts with the cache disabled so every call reaches the model
+    texts = [f"How do I fix error {i} in function handle_request_{i}?" for i in range(args.requests)]
+    model.encode(texts[:8])
+
+    single = EmbeddingService(model, cache_size=0, max_batch_size=1)
+    elapsed, latencies = asyncio.run(run_load(single, texts, args.concurrency))
+    report("one-at-a-time", elapsed, latencies, single)
+
+    batched = EmbeddingService(model, cache_size=0, max_batch_size=args.batch_size,
+                               batch_window_ms=args.window_ms)
+    elapsed, latencies = asyncio.run(run_load(batched, texts, args.concurrency))
+    report("micro-batched", elapsed, latencies, batched)
+
+if __name__ == "__main__":
+    main()
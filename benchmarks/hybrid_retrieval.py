@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Compare vector-only history retrieval against BM25 + vector reciprocal rank fusion
+
+Run from the repository root:
+    python -m benchmarks.hybrid_retrieval --conversations 5000 --queries 500
+
+Builds one synthetic namespace of code conversations whose prompts share vocabulary but
+name different functions, classes and errors. Each query asks about one stored
+conversation by its identifiers, in a different casing style, and recall@k counts
+how often that conversation comes back in the top k.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+import uuid
+
+from sentence_transformers import SentenceTransformer
+
+from benchmarks.common import summarize
+from hybrid_search import LexicalVectorStore
+from vector_store import LocalVectorStore
+
+NAMESPACE = "benchmark-user"
+VERBS = ["get", "set", "parse", "load", "save", "update", "delete", "validate", "render", "fetch",
+         "build", "compute", "handle", "convert", "sync", "merge", "resolve", "refresh"]
+NOUNS = ["user", "config", "order", "invoice", "session", "token", "cache", "request", "response", "payment",
+         "report", "file", "record", "message", "account", "profile", "queue", "event", "schema", "widget"]
+ERRORS = ["KeyError", "ValueError", "TypeError", "AttributeError", "IndexError", "TimeoutError",
+          "NullPointerException", "ConnectionRefusedError", "JSONDecodeError", "PermissionError"]
+PROMPTS = [
+    "Why does {function} in {cls} raise {error} when the {noun} is empty?",
+    "{function} keeps throwing {error} after I refactored {cls}, what am I missing?",
+    "How should {cls} handle {error} coming out of {function}?",
+]
+QUERIES = [
+    "{error} from {function} again",
+    "fix {function} {error} in {cls}",
+    "{cls} {function} still fails",
+]
+
+def snake(words):
+    return "_".join(words)
+
+def camel(words):
+    return words[0] + "".join(word.capitalize() for word in words[1:])
+
+def pascal(words):
+    return "".join(word.capitalize() for word in words)
+
+def synthetic_conversations(count, rng):
+    conversations = []
+    for _ in range(count):
+        words = [rng.choice(VERBS), rng.choice(NOUNS), rng.choice(NOUNS)]
+        style = rng.choice([snake, camel])
+        identifiers = {
+            "words": words,
+            "cls": pascal([rng.choice(NOUNS), rng.choice(NOUNS), "service"]),
+            "error": rng.choice(ERRORS),
+            "noun": rng.choice(NOUNS),
+            "style": style,
+        }
+        user_prompt = rng.choice(PROMPTS).format(function=style(words), **identifiers)
+        ai_response = (f"The {identifiers['error']} comes from {style(words)} reading a missing field. "
+                       f"Guard the lookup before {identifiers['cls']} calls it:\n\n"
+                       f"def {style(words)}(data):\n    if not data:\n        return None\n"
+                       f"    return data.get('{identifiers['noun']}')\n")
+        conversations.append((str(uuid.uuid4()), user_prompt, ai_response, identifiers))
+    return conversations
+
+def synthetic_query(identifiers, rng):
+    # Asked in the other casing style, as users rarely repeat an identifier exactly
+    style = camel if identifiers["style"] is snake else snake
+    return rng.choice(QUERIES).format(function=style(identifiers["words"]), **identifiers)
+
+def recall(results, targets, k):
+    return round(sum(target in [match.id for match in matches[:k]]
+                     for matches, target in zip(results, targets)) / len(targets), 4)
+
+async def run(args):
+    rng = random.Random(args.seed)
+    model = SentenceTransformer(args.model)
+    conversations = synthetic_conversations(args.conversations, rng)
+
+    store = LexicalVectorStore(LocalVectorStore(path=""))
+    vectors = model.encode([f"{prompt} {response}" for _, prompt, response, _ in conversations], batch_size=64)
+    for start in range(0, len(conversations), 500):
+        await store.upsert([
+            {"id": conversation_id, "values": vector.tolist(),
+             "metadata": {"user_prompt": prompt, "ai_response": response}}
+            for (conversation_id, prompt, response, _), vector in
+            zip(conversations[start:start + 500], vectors[start:start + 500])
+        ], NAMESPACE)
+    build_start = time.perf_counter()
+    await store.ensure_index(NAMESPACE)
+    print(f"Indexed {args.conversations} conversations in {time.perf_counter() - build_start:.2f}s")
+
+    sampled = rng.sample(conversations, args.queries)
+    queries = [synthetic_query(identifiers, rng) for _, _, _, identifiers in sampled]
+    targets = [conversation_id for conversation_id, _, _, _ in sampled]
+    query_vectors = model.encode(queries, batch_size=64)
+
+    for name in ("vector-only", "hybrid"):
+        results = []
+        latencies = []
+        for query, vector in zip(queries, query_vectors):
+            start_time = time.perf_counter()
+            if name == "hybrid":
+                result = await store.hybrid_query(vector.tolist(), query, NAMESPACE, top_k=10)
+            else:
+                result = await store.query(vector.tolist(), NAMESPACE, top_k=10)
+            latencies.append(time.perf_counter() - start_time)
+            results.append(result.matches)
+        latency = summarize(latencies)
+        print(f"{name:<12} " + "  ".join(f"recall@{k} {recall(results, targets, k):.3f}" for k in (1, 3, 5, 10)) +
+              f"   p50 {latency['p50_ms']:.2f} ms  p95 {latency['p95_ms']:.2f} ms")
+    await store.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--conversations", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""Offline load test for /ask-ai with fake Gemini and vector-store backends
+
+Starts the app under uvicorn with LLM_BACKEND=fake and VECTOR_STORE=fake, replays a
+JSONL workload at a fixed concurrency and reports RPS plus p50/p95/p99 latency
+overall and per stage (embed, search, generate, dedup, store). Run from the
+repository root:
+
+    python -m benchmarks.load_test --concurrency 32 --requests 1000
+    python -m benchmarks.load_test --compare benchmarks/results/<earlier run>.json
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+from datetime import datetime
+
+import httpx
+
+from benchmarks.common import summarize
+
+STAGES = ["embed", "search", "generate", "dedup", "store", "payload"]
+DEFAULT_WORKLOAD = os.path.join(os.path.dirname(__file__), "workload.jsonl")
+DEFAULT_RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+def load_workload(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def start_server(port, llm_latency, vector_latency, extra_env):
+    """Launch the app with deterministic fake backends and wait until it reports ready"""
+    env = dict(os.environ)
+    env.update({
+        "LLM_BACKEND": "fake",
+        "FAKE_LLM_LATENCY_SECONDS": str(llm_latency),
+        "VECTOR_STORE": "fake",
+        "FAKE_VECTOR_STORE_LATENCY_SECONDS": str(vector_latency),
+        "TIMING_BREAKDOWN": "1",
+        # Store inline so dedup and store show up in each request's timings
+        "WRITE_BEHIND": "0",
+    })
+    env.update(extra_env)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            if httpx.get(base_url + "/readyz", timeout=1.0).status_code == 200:
+                return server, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.25)
+    server.terminate()
+    raise RuntimeError("Server was not ready within 120s")
+
+def parse_stream(text):
+    """Return the done event's data from an SSE body"""
+    event = None
+    for line in text.splitlines():
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:") and event == "done":
+            return json.loads(line[len("data:"):])
+    return {"error": "stream ended without a done event"}
+
+async def replay(base_url, endpoint, workload, total_requests, concurrency):
+    latencies = []
+    stage_latencies = {name: [] for name in STAGES}
+    errors = []
+    next_item = iter(range(total_requests))
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60.0,
+                                 limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def worker():
+            for position in next_item:
+                item = workload[position % len(workload)]
+                start_time = time.perf_counter()
+                try:
+                    response = await client.post(endpoint, json=item)
+                    elapsed = time.perf_counter() - start_time
+                    if response.status_code != 200:
+                        errors.append(f"HTTP {response.status_code}")
+                        continue
+                    body = parse_stream(response.text) if endpoint.endswith("/stream") else response.json()
+                except httpx.HTTPError as e:
+                    errors.append(str(e))
+                    continue
+                if body.get("error"):
+                    errors.append(body["error"])
+                    continue
+                latencies.append(elapsed)
+                for name, seconds in (body.get("timings") or {}).items():
+                    stage_latencies.setdefault(name, []).append(seconds)
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall_time = time.perf_counter() - start_time
+
+    return {
+        "requests": total_requests,
+        "errors": len(errors),
+        "sample_errors": sorted(set(errors))[:5],
+        "wall_time_seconds": round(wall_time, 3),
+        "rps": round(len(latencies) / wall_time, 2) if wall_time else 0.0,
+        "latency": summarize(latencies),
+        "stages": {name: summarize(values) for name, values in stage_latencies.items() if values},
+    }
+
+def print_report(results, baseline=None):
+    print(f"\n{results['endpoint']}  concurrency={results['config']['concurrency']}  "
+          f"requests={results['requests']}  errors={results['errors']}")
+    print(f"RPS: {results['rps']}" + (f"  (baseline {baseline['rps']})" if baseline else ""))
+    print(f"{'stage':<10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    rows = [("total", results["latency"])] + sorted(results["stages"].items())
+    for name, summary in rows:
+        line = f"{name:<10} {summary['p50_ms']:>10.2f} {summary['p95_ms']:>10.2f} {summary['p99_ms']:>10.2f}"
+        if baseline:
+            before = baseline["latency"] if name == "total" else baseline["stages"].get(name)
+            if before and before["p99_ms"]:
+                change = (summary["p99_ms"] - before["p99_ms"]) / before["p99_ms"] * 100
+                line += f"   p99 {change:+.1f}% vs baseline"
+        print(line)
+    for error in results["sample_errors"]:
+        print(f"error: {error}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workload", default=DEFAULT_WORKLOAD, help="JSONL of {query, user_ID, context}")
+    parser.add_argument("--endpoint", default="/ask-ai", choices=["/ask-ai", "/ask-ai/stream"])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="fake Gemini latency in seconds")
+    parser.add_argument("--vector-latency", type=float, default=0.02, help="fake vector-store latency in seconds")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--url", help="benchmark an already running server instead of starting one")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the server, e.g. --env RESPONSE_CACHE=1")
+    parser.add_argument("--results-dir", default=DEFAULT_RESULTS_DIR)
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    workload = load_workload(args.workload)
+    extra_env = dict(item.split("=", 1) for item in args.env)
+
+    server = None
+    base_url = args.url
+    if not base_url:
+        server, base_url = start_server(args.port, args.llm_latency, args.vector_latency, extra_env)
+    try:
+        results = asyncio.run(replay(base_url, args.endpoint, workload, args.requests, args.concurrency))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    results.update({
+        "endpoint": args.endpoint,
+        "timestamp": datetime.now().isoformat(),
+        "config": {
+            "workload": args.workload,
+            "concurrency": args.concurrency,
+            "llm_latency": args.llm_latency,
+            "vector_latency": args.vector_latency,
+            "env": extra_env,
+        },
+    })
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    path = os.path.join(args.results_dir, f"load_test_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved results to {path}")
+
+if __name__ == "__main__":
+    main()
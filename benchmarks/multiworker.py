@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Memory and throughput of serve.py at several worker counts, per-worker vs shared embeddings
+
+Run from the repository root (Linux, as it reads /proc):
+    python -m benchmarks.multiworker --workers 1 2 4 8 --requests 400
+
+For each worker count the app is started twice through serve.py with fake Gemini and
+vector-store backends: once with every worker loading its own MiniLM (EMBEDDING_SERVER=0)
+and once with one shared embedding process (EMBEDDING_SERVER=1). After a warm-up the
+workload is replayed and the whole process tree is measured: RSS and PSS summed over
+every process, and CPU seconds used during the replay, giving requests per CPU-second.
+PSS counts pages shared between forked workers once, so it is the closer figure to
+what the host actually pays.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+
+import httpx
+
+from benchmarks.load_test import load_workload, replay, DEFAULT_WORKLOAD
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024
+
+def process_tree(root_pid):
+    """root_pid and all of its descendants"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+    pids, pending = [], [root_pid]
+    while pending:
+        pid = pending.pop()
+        pids.append(pid)
+        pending.extend(children.get(pid, []))
+    return pids
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # utime and stime, fields 14 and 15 of /proc/<pid>/stat
+        total += int(fields[11]) + int(fields[12])
+    return total / CLOCK_TICKS
+
+def memory_mb(pids):
+    """(RSS, PSS) of the processes in MB"""
+    rss_kb = pss_kb = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                rss_kb += int(f.read().split()[1]) * PAGE_KB
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                pss_kb += next(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+        except (OSError, StopIteration):
+            continue
+    return round(rss_kb / 1024, 1), round(pss_kb / 1024, 1)
+
+def start_serve(port, workers, shared, args):
+    env = dict(os.environ)
+    env.update({
+        "WORKERS": str(workers),
+        "PORT": str(port),
+        "HOST": "127.0.0.1",
+        "EMBEDDING_SERVER": "1" if shared else "0",
+        "EMBEDDING_SERVER_SOCKET": f"/tmp/embedding-benchmark-{port}.sock",
+        "EMBEDDING_PRECISION": args.precision,
+        "LLM_BACKEND": "fake",
+        "FAKE_LLM_LATENCY_SECONDS": str(args.llm_latency),
+        "VECTOR_STORE": "fake",
+        "FAKE_VECTOR_STORE_LATENCY_SECONDS": str(args.vector_latency),
+        "WRITE_BEHIND": "0",
+    })
+    server = subprocess.Popen([sys.executable, "serve.py"], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + args.startup_timeout
+    # Each worker answers /readyz on its own, so wait for a run of consecutive ready responses
+    ready = 0
+    while time.time() < deadline and ready < workers * 4:
+        if server.poll() is not None:
+            raise RuntimeError(f"serve.py exited with code {server.returncode}")
+        try:
+            ready = ready + 1 if httpx.get(base_url + "/readyz", timeout=1.0).status_code == 200 else 0
+        except httpx.HTTPError:
+            ready = 0
+        time.sleep(0.1)
+    if ready < workers * 4:
+        server.terminate()
+        raise RuntimeError(f"serve.py was not ready within {args.startup_timeout}s")
+    return server, base_url
+
+def measure(workers, shared, workload, args):
+    server, base_url = start_serve(args.port, workers, shared, args)
+    try:
+        asyncio.run(replay(base_url, "/ask-ai", workload, workers * 8, args.concurrency))
+        pids = process_tree(server.pid)
+        cpu_before = cpu_seconds(pids)
+        results = asyncio.run(replay(base_url, "/ask-ai", workload, args.requests, args.concurrency))
+        cpu_used = cpu_seconds(process_tree(server.pid)) - cpu_before
+        rss, pss = memory_mb(process_tree(server.pid))
+    finally:
+        server.terminate()
+        server.wait(timeout=60)
+    completed = args.requests - results["errors"]
+    return {
+        "mode": "shared" if shared else "per-worker",
+        "workers": workers,
+        "rss_mb": rss,
+        "pss_mb": pss,
+        "rps": results["rps"],
+        "requests_per_cpu_second": round(completed / cpu_used, 1) if cpu_used else 0.0,
+        "p95_ms": results["latency"]["p95_ms"],
+        "errors": results["errors"],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workload", default=DEFAULT_WORKLOAD)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--precision", default="float32", choices=["float32", "float16", "int8"],
+                        help="EMBEDDING_PRECISION of the shared embedding process")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="fake Gemini latency in seconds")
+    parser.add_argument("--vector-latency", type=float, default=0.02, help="fake vector-store latency in seconds")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    workload = load_workload(args.workload)
+    print(f"{os.cpu_count()} CPUs")
+    print(f"{'mode':<11} {'workers':>7} {'RSS MB':>9} {'PSS MB':>9} {'RPS':>8} {'req/CPU-s':>10} "
+          f"{'p95 ms':>9} {'errors':>7}")
+    for workers in args.workers:
+        for shared in (False, True):
+            row = measure(workers, shared, workload, args)
+            print(f"{row['mode']:<11} {row['workers']:>7} {row['rss_mb']:>9.1f} {row['pss_mb']:>9.1f} "
+                  f"{row['rps']:>8.1f} {row['requests_per_cpu_second']:>10.1f} {row['p95_ms']:>9.1f} "
+                  f"{row['errors']:>7}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""Bulk import and re-embedding of stored conversations
+
+Streams conversations from a JSONL file or from namespaces already in a vector store,
+embeds them in large batches on a process pool and upserts them in parallel batches.
+Progress is checkpointed so an interrupted run resumes where it stopped:
+
+    python setup_pinecone.py import --jsonl conversations.jsonl
+    python setup_pinecone.py import --from-store pinecone --namespaces user001 user002
+    python setup_pinecone.py import --jsonl conversations.jsonl --store local
+
+Each JSONL line is one conversation: {"user_id", "user_prompt", "ai_response"} plus
+optional "id", "timestamp" and "context_hash". "namespace" may stand in for "user_id".
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from vector_store import Match, create_vector_store, base_store
+from dedup import DedupVectorStore, content_hash
+from namespace_stats import StatsVectorStore
+from document_store import DocumentVectorStore, DOCUMENT_STORE
+from startup import StartupTracker, load_embedding_model, EMBEDDING_MODEL_NAME, EMBEDDING_MODEL_PATH
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "2048"))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "100"))
+IMPORT_UPSERT_CONCURRENCY = int(os.getenv("IMPORT_UPSERT_CONCURRENCY", "8"))
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+IMPORT_CHECKPOINT_PATH = os.getenv("IMPORT_CHECKPOINT_PATH", os.path.join("vector_data", "import_checkpoint.json"))
+IMPORT_CHECKPOINT_RECORDS = int(os.getenv("IMPORT_CHECKPOINT_RECORDS", "20000"))
+
+# Model of the process-pool worker, loaded once by init_encoder()
+_encoder = None
+
+def load_encoder(name, path):
+    model = load_embedding_model(StartupTracker(), name, path)
+    if model is None:
+        raise RuntimeError(f"Could not load embedding model {name}")
+    return model
+
+def init_encoder(name, path):
+    global _encoder
+    _encoder = load_encoder(name, path)
+
+def encode_texts(texts):
+    """Runs in a pool worker; float32 arrays pickle far smaller than lists of floats"""
+    return np.asarray(_encoder.encode(texts, batch_size=len(texts)), dtype=np.float32)
+
+def conversation_id(namespace, digest, discriminator):
+    """Stable id for a conversation without one, so re-running an import overwrites rather than duplicates"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{namespace}\0{digest}\0{discriminator}"))
+
+def jsonl_source(path):
+    """(namespace, id, metadata) per line; metadata carries user_prompt/ai_response"""
+    def read(skip):
+        with open(path) as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                entry = json.loads(line)
+                namespace = entry.get("user_id") or entry.get("namespace")
+                digest = content_hash(entry["user_prompt"], entry["ai_response"])
+                timestamp = entry.get("timestamp")
+                metadata = {
+                    "user_prompt": entry["user_prompt"],
+                    "ai_response": entry["ai_response"],
+                    "content_hash": digest,
+                    "timestamp": timestamp or datetime.now().isoformat(),
+                }
+                if entry.get("context_hash"):
+                    metadata["context_hash"] = entry["context_hash"]
+                # Without a timestamp the line number keeps the id the same on every run
+                vector_id = entry.get("id") or conversation_id(namespace, digest, timestamp or f"line {line_number}")
+                yield namespace, vector_id, metadata
+    return read
+
+def store_source(store, namespaces):
+    """Every conversation in the given namespaces of a store, bodies included, for re-embedding"""
+    async def read(skip):
+        counts = {name: namespace.vector_count
+                  for name, namespace in ((await store.describe_index_stats()).namespaces or {}).items()}
+        for namespace in namespaces or sorted(counts):
+            if skip >= counts.get(namespace, 0):
+                # Finished before the checkpoint; skipping it costs no reads
+                skip -= counts.get(namespace, 0)
+                continue
+            matches = []
+            async for vector_id, _, metadata in store.records(namespace):
+                if skip:
+                    skip -= 1
+                    continue
+                matches.append(Match(id=vector_id, score=1.0, metadata=dict(metadata or {})))
+                if len(matches) >= IMPORT_CHUNK_SIZE:
+                    for match in await hydrate(matches):
+                        yield namespace, match.id, match.metadata
+                    matches = []
+            for match in await hydrate(matches):
+                yield namespace, match.id, match.metadata
+
+    async def hydrate(matches):
+        if hasattr(store, "hydrate"):
+            await store.hydrate(matches)
+        return matches
+
+    return read
+
+async def chunks(records, size):
+    """Group a sync or async record iterator into lists of up to size"""
+    chunk = []
+    if hasattr(records, "__aiter__"):
+        async for record in records:
+            chunk.append(record)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    else:
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+class Checkpoint:
+    """Records consumed from a source, saved atomically as JSON; a different source starts over"""
+
+    def __init__(self, path, source_key):
+        self.path = path
+        self.source_key = source_key
+        self.position = 0
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get("source") == source_key:
+                self.position = saved["position"]
+            else:
+                print(f"Checkpoint {path} is for {saved.get('source')}, starting from the beginning")
+
+    def save(self, position):
+        self.position = position
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"source": self.source_key, "position": position,
+                       "updated": datetime.now().isoformat()}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+class BulkImporter:
+    """Embed-and-upsert pipeline: chunks are encoded on a process pool while earlier chunks upsert
+
+    Chunks finish in source order, so the checkpoint only ever advances past records
+    that are stored. With workers=0 encoding happens on a thread in this process.
+    """
+
+    def __init__(self, store, encode, executor=None, batch_size=IMPORT_BATCH_SIZE,
+                 upsert_concurrency=IMPORT_UPSERT_CONCURRENCY, chunk_size=IMPORT_CHUNK_SIZE,
+                 chunks_in_flight=2, checkpoint_records=IMPORT_CHECKPOINT_RECORDS):
+        self.store = store
+        self.encode = encode
+        self.executor = executor
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.chunks_in_flight = chunks_in_flight
+        self.checkpoint_records = checkpoint_records
+        self.upserts = asyncio.Semaphore(upsert_concurrency)
+        self.imported = 0  # records stored by this run
+        self.skipped = 0  # records without a readable body, e.g. slim records whose document store is elsewhere
+        self.encode_seconds = 0.0
+
+    async def _upsert(self, namespace, records):
+        async with self.upserts:
+            await self.store.upsert(vectors=records, namespace=namespace)
+
+    async def _process(self, chunk):
+        consumed = len(chunk)
+        chunk = [record for record in chunk if "user_prompt" in record[2] and "ai_response" in record[2]]
+        self.skipped += consumed - len(chunk)
+        if not chunk:
+            return consumed
+        start_time = time.perf_counter()
+        texts = [f"{metadata['user_prompt']} {metadata['ai_response']}" for _, _, metadata in chunk]
+        vectors = await asyncio.get_running_loop().run_in_executor(self.executor, self.encode, texts)
+        self.encode_seconds += time.perf_counter() - start_time
+
+        by_namespace = {}
+        for (namespace, vector_id, metadata), vector in zip(chunk, vectors):
+            by_namespace.setdefault(namespace, []).append(
+                {"id": vector_id, "values": vector.tolist(), "metadata": metadata}
+            )
+        await asyncio.gather(*(
+            self._upsert(namespace, records[start:start + self.batch_size])
+            for namespace, records in by_namespace.items()
+            for start in range(0, len(records), self.batch_size)
+        ))
+        self.imported += len(chunk)
+        return consumed
+
+    async def _flush(self):
+        # The local store only writes to disk on flush; the checkpoint must not run ahead of it
+        persist = getattr(base_store(self.store), "persist", None)
+        if persist is not None:
+            await persist()
+
+    async def run(self, read, checkpoint):
+        start_time = time.perf_counter()
+        position = checkpoint.position
+        if position:
+            print(f"Resuming after {position} records")
+        saved_at = position
+        in_flight = deque()
+
+        async def finish_oldest():
+            nonlocal position, saved_at
+            done = await in_flight.popleft()
+            position += done
+            if position - saved_at >= self.checkpoint_records:
+                await self._flush()
+                checkpoint.save(position)
+                saved_at = position
+                self.report(position, start_time)
+
+        async for chunk in chunks(read(position), self.chunk_size):
+            in_flight.append(asyncio.ensure_future(self._process(chunk)))
+            if len(in_flight) >= self.chunks_in_flight:
+                await finish_oldest()
+        while in_flight:
+            await finish_oldest()
+        await self._flush()
+        return self.report(position, start_time)
+
+    def report(self, position, start_time):
+        elapsed = time.perf_counter() - start_time
+        rate = self.imported / elapsed if elapsed else 0.0
+        skipped = f", {self.skipped} skipped without a body" if self.skipped else ""
+        print(f"{position} records done, {self.imported} this run in {elapsed:.1f}s: {rate:.1f} records/s "
+              f"({self.encode_seconds:.1f}s encoding{skipped})")
+        return {"position": position, "imported": self.imported, "skipped": self.skipped,
+                "seconds": round(elapsed, 3), "records_per_second": round(rate, 1)}
+
+def wrap_store(store):
+    """The server's wrapper stack, so bodies, dedup hashes and namespace counters stay in step"""
+    if DOCUMENT_STORE:
+        store = DocumentVectorStore(store)
+    return StatsVectorStore(DedupVectorStore(store), reconcile_seconds=0)
+
+async def run_import(args):
+    store = wrap_store(create_vector_store(args.store))
+    source_store = None
+    if args.jsonl:
+        read = jsonl_source(args.jsonl)
+        source_key = f"jsonl:{os.path.abspath(args.jsonl)}"
+    else:
+        # Re-embedding in place reads from the store being written; ids are kept, so records are replaced
+        source_store = store if args.from_store == args.store else wrap_store(create_vector_store(args.from_store))
+        read = store_source(source_store, args.namespaces)
+        source_key = f"store:{args.from_store}:{','.join(args.namespaces or ['*'])}"
+
+    checkpoint = Checkpoint(args.checkpoint, source_key)
+    if args.restart:
+        checkpoint.position = 0
+
+    executor = None
+    if args.workers > 0:
+        executor = ProcessPoolExecutor(args.workers, initializer=init_encoder,
+                                       initargs=(args.model_name, args.model_path))
+    else:
+        init_encoder(args.model_name, args.model_path)
+
+    importer = BulkImporter(store, encode_texts, executor, batch_size=args.batch_size,
+                            upsert_concurrency=args.upsert_concurrency, chunk_size=args.chunk_size,
+                            chunks_in_flight=max(2, args.workers + 1), checkpoint_records=args.checkpoint_records)
+    try:
+        report = await importer.run(read, checkpoint)
+        checkpoint.clear()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if source_store is not None and source_store is not store:
+            await source_store.close()
+        await store.close()
+    return report
+
+def build_parser(parser=None):
+    parser = parser or argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--jsonl", help="JSONL file of conversations to import")
+    source.add_argument("--from-store", choices=["pinecone", "local"],
+                        help="re-embed conversations already in this vector store")
+    parser.add_argument("--namespaces", nargs="+", help="namespaces to re-embed (default: all)")
+    parser.add_argument("--store", choices=["pinecone", "local"], default="pinecone", help="store to write to")
+    parser.add_argument("--model-name", default=EMBEDDING_MODEL_NAME)
+    parser.add_argument("--model-path", default=EMBEDDING_MODEL_PATH)
+    parser.add_argument("--workers", type=int, default=IMPORT_WORKERS, help="encoder processes (0 encodes in-process)")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE, help="texts per encode call")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="records per upsert")
+    parser.add_argument("--upsert-concurrency", type=int, default=IMPORT_UPSERT_CONCURRENCY)
+    parser.add_argument("--checkpoint", default=IMPORT_CHECKPOINT_PATH)
+    parser.add_argument("--checkpoint-records", type=int, default=IMPORT_CHECKPOINT_RECORDS)
+    parser.add_argument("--restart", action="store_true", help="ignore any saved checkpoint")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return asyncio.run(run_import(args))
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,10 @@ load_dotenv()
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
 # Model configuration
+MODEL_NAME = "gemini-2.5-flash-preview-05-20"
+
+SYSTEM_INSTRUCTION = "You are an expert at coding. You are a coding assistant. You are a large language model trained by Google. Only give the specific answer to the user's question. Do not give any other information."
+
 generation_config = {
     "temperature": 0,
     "top_p": 0.95,
@@ -22,21 +26,26 @@ safety_settings = [
     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
 ]
 
-# Initialize model
-model = genai.GenerativeModel(
-    model_name="gemini-2.5-flash-preview-05-20",
-    safety_settings=safety_settings,
-    generation_config=generation_config,
-    system_instruction="You are an expert at coding. You are a coding assistant. You are a large language model trained by Google. Only give the specific answer to the user's question. Do not give any other information.",
-)
-
-# Start a new chat session
-chat_session = model.start_chat(history=[])
-
-# Get input from command-line argument
-if len(sys.argv) > 1:
-    user_input = sys.argv[1]
-    response = chat_session.send_message(user_input)
-    print(response.text)
-else:
-    print("Error: No input provided.")
+def create_model(system_instruction=SYSTEM_INSTRUCTION):
+    """Build the Gemini model used to answer coding questions"""
+    return genai.GenerativeModel(
+        model_name=MODEL_NAME,
+        safety_settings=safety_settings,
+        generation_config=generation_config,
+        system_instruction=system_instruction,
+    )
+
+if __name__ == "__main__":
+    # Initialize model
+    model = create_model()
+
+    # Start a new chat session
+    chat_session = model.start_chat(history=[])
+
+    # Get input from command-line argument
+    if len(sys.argv) > 1:
+        user_input = sys.argv[1]
+        response = chat_session.send_message(user_input)
+        print(response.text)
+    else:
+        print("Error: No input provided.")
@@ -0,0 +1,63 @@
+import os
+import asyncio
+import threading
+import concurrent.futures
+
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "1") == "1"
+
+class SingleFlight:
+    """Runs one call per key at a time; identical calls made meanwhile wait for its result
+
+    The shared result lives in a concurrent.futures.Future guarded by a threading lock, so
+    callers on different threads (and different event loops) coalesce onto the same call.
+    """
+
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    async def do(self, key, function):
+        """Return (result, coalesced): await function() unless a call for key is already in flight"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            try:
+                # Shielded so a waiter that goes away does not cancel the shared call
+                return await asyncio.shield(asyncio.wrap_future(future)), True
+            except (asyncio.CancelledError, concurrent.futures.CancelledError):
+                if not future.cancelled():
+                    raise
+            # The leader was cancelled before finishing; do the work ourselves
+            return await function(), False
+
+        try:
+            result = await function()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+            }
@@ -0,0 +1,334 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import asyncio
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import List
+
+import numpy as np
+
+from vector_store import Match, SHARED_WRITERS
+from concurrency import OverloadedError
+from dedup import content_hash, normalize_text
+from context_assembly import truncate_to_tokens, HISTORY_ENTRY_MAX_TOKENS
+
+COMPACTION = os.getenv("COMPACTION", "0") == "1"
+COMPACTION_INTERVAL_SECONDS = float(os.getenv("COMPACTION_INTERVAL_SECONDS", "3600"))
+COMPACTION_MIN_AGE_DAYS = float(os.getenv("COMPACTION_MIN_AGE_DAYS", "7"))
+COMPACTION_DUPLICATE_SIMILARITY = float(os.getenv("COMPACTION_DUPLICATE_SIMILARITY", "0.95"))
+COMPACTION_CLUSTER_SIMILARITY = float(os.getenv("COMPACTION_CLUSTER_SIMILARITY", "0.8"))
+COMPACTION_MIN_GROUP_SIZE = int(os.getenv("COMPACTION_MIN_GROUP_SIZE", "3"))
+COMPACTION_SUMMARIZER = os.getenv("COMPACTION_SUMMARIZER", "extractive")
+RETENTION_MAX_AGE_DAYS = float(os.getenv("RETENTION_MAX_AGE_DAYS", "0"))
+RETENTION_MAX_CONVERSATIONS = int(os.getenv("RETENTION_MAX_CONVERSATIONS", "2000"))
+# With several workers only the one holding this lock compacts; another takes over if it exits
+COMPACTION_LOCK_PATH = os.getenv("COMPACTION_LOCK_PATH", "/tmp/compaction.lock" if SHARED_WRITERS else "")
+
+# Scheduler user that LLM-written summaries queue under
+COMPACTION_USER = "system:compaction"
+CLUSTER_BLOCK_SIZE = 256
+UPSERT_BATCH_SIZE = 100
+DELETE_BATCH_SIZE = 1000  # Pinecone's limit on ids per delete
+SUMMARY_PROMPT_TOKENS = 40
+# Only the newest CAP_WINDOW_FACTOR x RETENTION_MAX_CONVERSATIONS conversations are clustered
+CAP_WINDOW_FACTOR = 5
+
+@dataclass
+class ConversationRecord:
+    id: str
+    vector: np.ndarray
+    metadata: dict
+    stored_at: datetime
+
+@dataclass
+class CompactionPlan:
+    expired: List[str] = field(default_factory=list)
+    duplicates: List[str] = field(default_factory=list)
+    groups: List[List[ConversationRecord]] = field(default_factory=list)
+    over_cap: List[str] = field(default_factory=list)
+
+def parse_timestamp(metadata):
+    try:
+        return datetime.fromisoformat(metadata.get("timestamp"))
+    except (TypeError, ValueError):
+        # Undated records count as the oldest
+        return datetime.min
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+def leader_clusters(vectors, threshold, block_size=CLUSTER_BLOCK_SIZE):
+    """Single-pass clustering of normalized rows in order
+
+    Each row joins its most similar existing leader if that similarity reaches the
+    threshold and otherwise becomes a leader itself, so a cluster's leader is its
+    earliest row. Rows are compared against leaders a block at a time with one
+    matrix product, which keeps the cost at O(rows x clusters).
+    """
+    count, dimension = vectors.shape
+    labels = np.empty(count, dtype=np.int64)
+    leaders = np.empty((max(16, min(count, 1024)), dimension), dtype=np.float32)
+    leader_count = 0
+    for start in range(0, count, block_size):
+        block = vectors[start:start + block_size]
+        if leader_count:
+            similarities = block @ leaders[:leader_count].T
+            best = similarities.argmax(axis=1)
+            best_similarity = similarities[np.arange(len(block)), best]
+        else:
+            best = np.zeros(len(block), dtype=np.int64)
+            best_similarity = np.full(len(block), -np.inf)
+
+        block_leaders = leader_count
+        for offset, vector in enumerate(block):
+            if best_similarity[offset] >= threshold:
+                labels[start + offset] = best[offset]
+                continue
+            if leader_count > block_leaders:
+                # Leaders created earlier in this block were not in the block-wide product
+                similarities = leaders[block_leaders:leader_count] @ vector
+                nearest = int(similarities.argmax())
+                if similarities[nearest] >= threshold:
+                    labels[start + offset] = block_leaders + nearest
+                    continue
+            if leader_count == len(leaders):
+                leaders = np.concatenate([leaders, np.empty_like(leaders)])
+            leaders[leader_count] = vector
+            labels[start + offset] = leader_count
+            leader_count += 1
+    return labels
+
+def plan_compaction(records, now=None, min_age_days=COMPACTION_MIN_AGE_DAYS,
+                    duplicate_similarity=COMPACTION_DUPLICATE_SIMILARITY,
+                    cluster_similarity=COMPACTION_CLUSTER_SIMILARITY, min_group_size=COMPACTION_MIN_GROUP_SIZE,
+                    max_age_days=RETENTION_MAX_AGE_DAYS, max_conversations=RETENTION_MAX_CONVERSATIONS):
+    """Decide what to delete, merge and summarize in one namespace; pure, so it can run off the event loop
+
+    Only conversations older than min_age_days are merged or summarized. Near-duplicates
+    collapse into their newest copy, and groups of at least min_group_size similar
+    conversations become a single summary entry. Summaries themselves are never regrouped.
+    """
+    now = now or datetime.now()
+    plan = CompactionPlan()
+
+    live = []
+    for record in records:
+        if max_age_days > 0 and record.stored_at < now - timedelta(days=max_age_days):
+            plan.expired.append(record.id)
+        else:
+            live.append(record)
+    live.sort(key=lambda record: record.stored_at, reverse=True)
+    if max_conversations > 0 and len(live) > CAP_WINDOW_FACTOR * max_conversations:
+        # Far past the cap these would be dropped whatever merging achieves, so don't cluster them
+        plan.over_cap = [record.id for record in live[CAP_WINDOW_FACTOR * max_conversations:]]
+        live = live[:CAP_WINDOW_FACTOR * max_conversations]
+
+    min_age_cutoff = now - timedelta(days=min_age_days)
+    old = [record for record in live
+           if record.stored_at < min_age_cutoff and record.metadata.get("kind") != "summary"]
+
+    if old:
+        vectors = normalize_rows(np.stack([np.asarray(record.vector, dtype=np.float32) for record in old]))
+        # Newest first, so each duplicate cluster is led by the copy worth keeping
+        labels = leader_clusters(vectors, duplicate_similarity)
+        seen = set()
+        kept_rows = []
+        for row, label in enumerate(labels):
+            if label in seen:
+                plan.duplicates.append(old[row].id)
+            else:
+                seen.add(label)
+                kept_rows.append(row)
+
+        clusters = {}
+        for row, label in zip(kept_rows, leader_clusters(vectors[kept_rows], cluster_similarity)):
+            clusters.setdefault(label, []).append(old[row])
+        plan.groups = [group for group in clusters.values() if len(group) >= min_group_size]
+
+    if max_conversations > 0:
+        removed = set(plan.duplicates)
+        grouped = {record.id for group in plan.groups for record in group}
+        remaining = [record for record in live if record.id not in removed and record.id not in grouped]
+        excess = len(remaining) + len(plan.groups) - max_conversations
+        if excess > 0:
+            plan.over_cap.extend(record.id for record in remaining[-excess:])
+    return plan
+
+def extractive_summary(bodies):
+    """Summary entry from a group's own text: its distinct questions and the newest answer"""
+    prompts = list(dict.fromkeys(normalize_text(user_prompt) for user_prompt, _ in bodies))
+    user_prompt = f"Summary of {len(bodies)} earlier conversations about: " + " | ".join(
+        truncate_to_tokens(prompt, SUMMARY_PROMPT_TOKENS) for prompt in prompts[:10]
+    )
+    return user_prompt, truncate_to_tokens(bodies[0][1], HISTORY_ENTRY_MAX_TOKENS)
+
+class HistoryCompactor:
+    """Background job that compacts user namespaces and enforces retention caps
+
+    store is attached once the vector store has connected. With an engine, summaries
+    are written by the LLM (COMPACTION_SUMMARIZER=llm); otherwise they are extractive.
+    With a scheduler, LLM summaries queue for generation slots as COMPACTION_USER. With a lock
+    path, scheduled runs only happen in the process holding an exclusive lock on it.
+    """
+
+    def __init__(self, store=None, engine=None, scheduler=None, interval_seconds=COMPACTION_INTERVAL_SECONDS,
+                 lock_path=COMPACTION_LOCK_PATH, **plan_options):
+        self.store = store
+        self.engine = engine
+        self.scheduler = scheduler
+        self.interval_seconds = interval_seconds
+        self.lock_path = lock_path
+        self.plan_options = plan_options
+        self.runs = 0
+        self.last_run = None
+        self._worker = None
+        self._lock_file = None
+
+    async def _summarize(self, bodies):
+        user_prompt, ai_response = extractive_summary(bodies)
+        if self.engine is None:
+            return user_prompt, ai_response
+        payload = json.dumps({"conversations": [
+            {"user_prompt": prompt, "ai_response": response} for prompt, response in bodies
+        ]})
+        try:
+            if self.scheduler is not None:
+                result = await self.scheduler.generate(self.engine, COMPACTION_USER, payload)
+            else:
+                result = await self.engine.agenerate(payload)
+        except OverloadedError:
+            # Requests come first; a busy scheduler gets the extractive summary
+            return user_prompt, ai_response
+        if result.error or not result.text:
+            return user_prompt, ai_response
+        return user_prompt, result.text
+
+    async def _load_records(self, namespace):
+        return [
+            ConversationRecord(vector_id, values, dict(metadata or {}), parse_timestamp(metadata or {}))
+            async for vector_id, values, metadata in self.store.records(namespace)
+        ]
+
+    async def _summary_record(self, group):
+        matches = [Match(id=record.id, score=1.0, metadata=record.metadata) for record in group]
+        hydrate = getattr(self.store, "hydrate", None)
+        if hydrate is not None:
+            await hydrate(matches)
+        bodies = [(match.metadata["user_prompt"], match.metadata["ai_response"])
+                  for match in matches if "user_prompt" in match.metadata]
+        if len(bodies) < len(group):
+            # Never replace conversations whose text can't be read back
+            return None
+
+        user_prompt, ai_response = await self._summarize(bodies)
+        vectors = normalize_rows(np.stack([np.asarray(record.vector, dtype=np.float32) for record in group]))
+        centroid = vectors.mean(axis=0)
+        centroid /= np.linalg.norm(centroid) or 1.0
+        return {
+            "id": str(uuid.uuid4()),
+            "values": centroid.tolist(),
+            "metadata": {
+                "user_prompt": user_prompt,
+                "ai_response": ai_response,
+                "content_hash": content_hash(user_prompt, ai_response),
+                "timestamp": max(record.stored_at for record in group).isoformat(),
+                "kind": "summary",
+                "summarized_count": len(group),
+            }
+        }
+
+    async def compact_namespace(self, namespace):
+        """Compact one namespace and return a report of what changed"""
+        start_time = time.perf_counter()
+        records = await self._load_records(namespace)
+        plan = await asyncio.to_thread(plan_compaction, records, **self.plan_options)
+
+        summaries = []
+        summarized = []
+        for group in plan.groups:
+            summary = await self._summary_record(group)
+            if summary is not None:
+                summaries.append(summary)
+                summarized.extend(record.id for record in group)
+
+        # Summaries go in before their sources are deleted, so history is never missing
+        for start in range(0, len(summaries), UPSERT_BATCH_SIZE):
+            await self.store.upsert(vectors=summaries[start:start + UPSERT_BATCH_SIZE], namespace=namespace)
+        deletes = list(dict.fromkeys(plan.expired + plan.duplicates + summarized + plan.over_cap))
+        for start in range(0, len(deletes), DELETE_BATCH_SIZE):
+            await self.store.delete(ids=deletes[start:start + DELETE_BATCH_SIZE], namespace=namespace)
+
+        return {
+            "namespace": namespace,
+            "conversations_before": len(records),
+            "conversations_after": len(records) - len(deletes) + len(summaries),
+            "expired": len(plan.expired),
+            "duplicates_merged": len(plan.duplicates),
+            "summarized": len(summarized),
+            "summaries_written": len(summaries),
+            "over_cap": len(plan.over_cap),
+            "seconds": round(time.perf_counter() - start_time, 3),
+        }
+
+    async def compact_all(self):
+        stats = await self.store.describe_index_stats()
+        reports = []
+        for namespace in list((stats.namespaces or {}).keys()):
+            try:
+                report = await self.compact_namespace(namespace)
+            except Exception as e:
+                print(f"Error compacting namespace {namespace}: {e}")
+                continue
+            if report["conversations_after"] != report["conversations_before"]:
+                print(f"Compacted namespace {namespace}: {report['conversations_before']} -> "
+                      f"{report['conversations_after']} conversations in {report['seconds']}s")
+            reports.append(report)
+        self.runs += 1
+        self.last_run = datetime.now().isoformat()
+        return reports
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    def _holds_lock(self):
+        """Whether this process is the one that compacts; the lock is kept once taken"""
+        if not self.lock_path or self._lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            if self.store is None or not self._holds_lock():
+                continue
+            try:
+                await self.compact_all()
+            except Exception as e:
+                print(f"Error running history compaction: {e}")
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def stats(self):
+        return {"runs": self.runs, "last_run": self.last_run}
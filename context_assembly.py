@@ -0,0 +1,158 @@
+import os
+import math
+from dataclasses import dataclass
+from datetime import datetime
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_BUDGET_SHARE = float(os.getenv("CONTEXT_BUDGET_SHARE", "0.5"))
+HISTORY_TOP_K = int(os.getenv("HISTORY_TOP_K", "10"))
+HISTORY_SCORE_FLOOR = float(os.getenv("HISTORY_SCORE_FLOOR", "0.3"))
+HISTORY_ENTRY_MAX_TOKENS = int(os.getenv("HISTORY_ENTRY_MAX_TOKENS", "800"))
+HISTORY_RECENCY_WEIGHT = float(os.getenv("HISTORY_RECENCY_WEIGHT", "0.2"))
+HISTORY_RECENCY_HALF_LIFE_DAYS = float(os.getenv("HISTORY_RECENCY_HALF_LIFE_DAYS", "14"))
+
+CHARS_PER_TOKEN = 4
+# Entries that would be cut below this are dropped rather than sent as a stub
+MIN_ENTRY_TOKENS = 32
+TRUNCATION_MARKER = "\n...[truncated]...\n"
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token) so assembly never calls the tokenizer"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def truncate_to_tokens(text, max_tokens):
+    """Keep the head and tail of text within max_tokens; code answers usually matter at both ends"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    max_chars = max(0, max_tokens * CHARS_PER_TOKEN - len(TRUNCATION_MARKER))
+    head = max_chars * 2 // 3
+    tail = max_chars - head
+    return text[:head] + TRUNCATION_MARKER + (text[-tail:] if tail else "")
+
+def recency_score(timestamp, now=None):
+    try:
+        stored_at = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return 0.0
+    now = now or datetime.now()
+    age_days = max(0.0, (now - stored_at).total_seconds() / 86400)
+    return math.exp(-math.log(2) * age_days / HISTORY_RECENCY_HALF_LIFE_DAYS)
+
+@dataclass
+class AssemblyReport:
+    tokens_included: int = 0
+    tokens_dropped: int = 0
+    history_included: int = 0
+    history_dropped: int = 0
+    history_truncated: int = 0
+    context_truncated: bool = False
+
+def entry_tokens(metadata):
+    metadata = metadata or {}
+    if "prompt_tokens" in metadata and "response_tokens" in metadata:
+        # Slim records carry their token counts; the bodies live in the document store
+        return int(metadata["prompt_tokens"]) + int(metadata["response_tokens"])
+    return estimate_tokens(metadata.get('user_prompt', "")) + estimate_tokens(metadata.get('ai_response', ""))
+
+def rank_history(matches, score_floor=HISTORY_SCORE_FLOOR, recency_weight=HISTORY_RECENCY_WEIGHT):
+    """Order matches by similarity blended with recency, dropping those under the score floor"""
+    now = datetime.now()
+    ranked = []
+    dropped = []
+    for match in matches:
+        if match.score < score_floor:
+            dropped.append(match)
+            continue
+        recency = recency_score((match.metadata or {}).get("timestamp"), now)
+        ranked.append(((1 - recency_weight) * match.score + recency_weight * recency, match))
+    ranked.sort(key=lambda item: item[0], reverse=True)
+    return [match for _, match in ranked], dropped
+
+def split_budget(query, context, token_budget=CONTEXT_TOKEN_BUDGET, context_share=CONTEXT_BUDGET_SHARE):
+    """Return (query_tokens, available, joined_context, context_tokens, history_budget)"""
+    query_tokens = estimate_tokens(query)
+    available = max(0, token_budget - query_tokens)
+
+    if context:
+        joined_context = "\n\n".join(context) if isinstance(context, list) else str(context)
+    else:
+        joined_context = None
+    context_tokens = estimate_tokens(joined_context) if joined_context else 0
+
+    # History may use whatever the context doesn't need out of its share
+    reserved_for_context = min(context_tokens, int(available * context_share))
+    return query_tokens, available, joined_context, context_tokens, available - reserved_for_context
+
+def history_candidates(query, context, matches, token_budget=CONTEXT_TOKEN_BUDGET,
+                       context_share=CONTEXT_BUDGET_SHARE, entry_max_tokens=HISTORY_ENTRY_MAX_TOKENS):
+    """Matches that will make it into the payload, judged from token counts alone
+
+    Follows the same ranking and budget walk as assemble_payload, so conversation
+    bodies only need to be fetched for these.
+    """
+    history_budget = split_budget(query, context, token_budget, context_share)[-1]
+    ranked, _ = rank_history(matches)
+    selected = []
+    history_tokens = 0
+    for match in ranked:
+        full_tokens = entry_tokens(match.metadata)
+        remaining = min(entry_max_tokens, history_budget - history_tokens)
+        if remaining < min(MIN_ENTRY_TOKENS, full_tokens):
+            continue
+        selected.append(match)
+        history_tokens += min(full_tokens, remaining)
+    return selected
+
+def assemble_payload(query, context, matches, token_budget=CONTEXT_TOKEN_BUDGET,
+                     context_share=CONTEXT_BUDGET_SHARE, entry_max_tokens=HISTORY_ENTRY_MAX_TOKENS):
+    """Build the LLM payload within a token budget and report what was kept and dropped"""
+    report = AssemblyReport()
+    query_tokens, available, joined_context, context_tokens, history_budget = split_budget(
+        query, context, token_budget, context_share
+    )
+
+    ranked, below_floor = rank_history(matches)
+    history = []
+    history_tokens = 0
+    for match in below_floor:
+        report.tokens_dropped += entry_tokens(match.metadata)
+        report.history_dropped += 1
+    for match in ranked:
+        if 'user_prompt' not in match.metadata:
+            # Body not fetched (or missing from the document store), so it cannot be sent
+            report.tokens_dropped += entry_tokens(match.metadata)
+            report.history_dropped += 1
+            continue
+        user_prompt = match.metadata['user_prompt']
+        ai_response = match.metadata['ai_response']
+        full_tokens = estimate_tokens(user_prompt) + estimate_tokens(ai_response)
+        remaining = min(entry_max_tokens, history_budget - history_tokens)
+        if remaining < min(MIN_ENTRY_TOKENS, full_tokens):
+            report.tokens_dropped += full_tokens
+            report.history_dropped += 1
+            continue
+
+        if full_tokens > remaining:
+            # Keep the question whole where possible; answers get what's left
+            prompt_limit = min(estimate_tokens(user_prompt), remaining // 2)
+            user_prompt = truncate_to_tokens(user_prompt, prompt_limit)
+            ai_response = truncate_to_tokens(ai_response, remaining - estimate_tokens(user_prompt))
+            report.history_truncated += 1
+        kept_tokens = estimate_tokens(user_prompt) + estimate_tokens(ai_response)
+        history.append({"user_prompt": user_prompt, "AI": ai_response})
+        history_tokens += kept_tokens
+        report.tokens_dropped += full_tokens - kept_tokens
+        report.history_included += 1
+
+    payload = {"query": query}
+    if joined_context:
+        context_budget = available - history_tokens
+        kept_context = truncate_to_tokens(joined_context, context_budget)
+        report.context_truncated = kept_context != joined_context
+        report.tokens_dropped += context_tokens - estimate_tokens(kept_context)
+        payload["context"] = kept_context
+        context_tokens = estimate_tokens(kept_context)
+    payload["history"] = history
+
+    report.tokens_included = query_tokens + context_tokens + history_tokens
+    return payload, report
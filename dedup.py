@@ -0,0 +1,168 @@
+import os
+import asyncio
+import hashlib
+import threading
+
+from vector_store import VectorStore, LocalVectorStore, base_store, normalize_vector_records, SHARED_WRITERS
+
+DEDUP_MODE = os.getenv("DEDUP_MODE", "exact")
+DEDUP_SIMILARITY_THRESHOLD = float(os.getenv("DEDUP_SIMILARITY_THRESHOLD", "0.98"))
+
+def normalize_text(text):
+    """Collapse whitespace so formatting-only differences hash the same"""
+    return " ".join(text.split())
+
+def content_hash(user_prompt, ai_response):
+    """Hash of a normalized prompt/response pair"""
+    digest = hashlib.sha256()
+    digest.update(normalize_text(user_prompt).encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(normalize_text(ai_response).encode("utf-8"))
+    return digest.hexdigest()
+
+class ContentHashIndex:
+    """Per-namespace map of content hash to conversation id for O(1) exact-duplicate checks"""
+
+    def __init__(self):
+        self._hashes = {}  # namespace -> {content_hash: conversation_id}
+        self._ids = {}  # namespace -> {conversation_id: content_hash}
+        self._lock = threading.Lock()
+
+    def add(self, namespace, conversation_id, digest):
+        with self._lock:
+            ids = self._ids.setdefault(namespace, {})
+            hashes = self._hashes.setdefault(namespace, {})
+            previous = ids.get(conversation_id)
+            if previous is not None and hashes.get(previous) == conversation_id:
+                del hashes[previous]
+            ids[conversation_id] = digest
+            hashes[digest] = conversation_id
+
+    def remove(self, namespace, conversation_ids):
+        with self._lock:
+            ids = self._ids.get(namespace, {})
+            hashes = self._hashes.get(namespace, {})
+            for conversation_id in conversation_ids:
+                digest = ids.pop(conversation_id, None)
+                if digest is not None and hashes.get(digest) == conversation_id:
+                    del hashes[digest]
+
+    def contains(self, namespace, digest):
+        with self._lock:
+            return digest in self._hashes.get(namespace, {})
+
+    def tracks(self, namespace, conversation_id):
+        with self._lock:
+            return conversation_id in self._ids.get(namespace, {})
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(ids) for ids in self._ids.values())
+
+def record_hash(metadata):
+    """A stored record's content hash, computed from its bodies for records written before hashes were stored"""
+    digest = metadata.get("content_hash")
+    if not digest and "user_prompt" in metadata and "ai_response" in metadata:
+        digest = content_hash(metadata["user_prompt"], metadata["ai_response"])
+    return digest
+
+class DedupVectorStore(VectorStore):
+    """Wraps a vector store and keeps the content-hash index in step with its upserts and deletes
+
+    The local store's records are all in memory, so its index is complete from the start.
+    For other stores a namespace's hashes are loaded in the background from store.records()
+    the first time it is checked; until then is_duplicate() asks the store with a
+    content_hash filter. With shared writers (several workers) the index can't know about
+    the others' writes, so only its hits are trusted and misses are always asked.
+    """
+
+    def __init__(self, store, index=None, shared=SHARED_WRITERS):
+        self.store = store
+        self.index = index if index is not None else ContentHashIndex()
+        self.shared = shared
+        self.filtered_checks = 0
+        self._loaded = set()  # namespaces whose stored hashes are all in the index
+        self._loads = {}  # namespace -> task loading its hashes
+        self._deleted = {}  # namespace -> ids deleted while its hashes were being loaded
+        self._complete = isinstance(base_store(store), LocalVectorStore)
+        if self._complete:
+            for name, namespace in base_store(store).namespaces.items():
+                for conversation_id, metadata in zip(namespace.ids, namespace.metadata):
+                    self._track(name, conversation_id, metadata)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def _track(self, namespace, conversation_id, metadata):
+        digest = record_hash(metadata)
+        if digest:
+            self.index.add(namespace, conversation_id, digest)
+
+    async def is_duplicate(self, namespace, user_prompt, ai_response, encode):
+        """Whether the exchange is already stored; encode() gives its vector if the store must be asked"""
+        digest = content_hash(user_prompt, ai_response)
+        if self.index.contains(namespace, digest):
+            return True
+        if self._complete or (namespace in self._loaded and not self.shared):
+            return False
+        if namespace not in self._loaded and namespace not in self._loads:
+            self._loads[namespace] = asyncio.create_task(self._load(namespace))
+        self.filtered_checks += 1
+        results = await self.store.query(await encode(), namespace, top_k=1,
+                                         filter={"content_hash": digest}, include_metadata=False)
+        return len(results.matches) > 0
+
+    async def _load(self, namespace):
+        try:
+            stored = []
+            async for conversation_id, _, metadata in self.store.records(namespace):
+                digest = record_hash(metadata or {})
+                if digest:
+                    stored.append((conversation_id, digest))
+            deleted = self._deleted.get(namespace, ())
+            for conversation_id, digest in stored:
+                # Writes that landed during the load are already tracked and newer than this snapshot
+                if conversation_id not in deleted and not self.index.tracks(namespace, conversation_id):
+                    self.index.add(namespace, conversation_id, digest)
+            self._loaded.add(namespace)
+        except Exception as e:
+            print(f"Error loading content hashes for namespace {namespace}: {e}")
+        finally:
+            if self._loads.get(namespace) is asyncio.current_task():
+                del self._loads[namespace]
+                self._deleted.pop(namespace, None)
+
+    async def upsert(self, vectors, namespace):
+        result = await self.store.upsert(vectors, namespace)
+        for conversation_id, _, metadata in normalize_vector_records(vectors):
+            self._track(namespace, conversation_id, metadata)
+        return result
+
+    async def query(self, vector, namespace, top_k=10, filter=None, include_metadata=True):
+        return await self.store.query(vector, namespace, top_k, filter, include_metadata)
+
+    async def query_many(self, vectors, namespace, top_k=10, filter=None, include_metadata=True):
+        return await self.store.query_many(vectors, namespace, top_k, filter, include_metadata)
+
+    async def delete(self, ids, namespace):
+        result = await self.store.delete(ids, namespace)
+        self.index.remove(namespace, ids)
+        if namespace in self._loads:
+            self._deleted.setdefault(namespace, set()).update(ids)
+        return result
+
+    async def fetch(self, ids, namespace):
+        return await self.store.fetch(ids, namespace)
+
+    async def describe_index_stats(self, filter=None):
+        return await self.store.describe_index_stats(filter)
+
+    def records(self, namespace):
+        return self.store.records(namespace)
+
+    async def close(self):
+        for load in self._loads.values():
+            load.cancel()
+        await asyncio.gather(*self._loads.values(), return_exceptions=True)
+        self._loads = {}
+        await self.store.close()
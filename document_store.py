@@ -0,0 +1,219 @@
+import os
+import json
+import zlib
+import sqlite3
+import asyncio
+import threading
+from collections import OrderedDict
+
+from vector_store import VectorStore, LocalVectorStore, base_store, normalize_vector_records
+from context_assembly import estimate_tokens
+
+# Opt-in: once enabled, bodies exist only in this file, so it must live on persistent storage
+DOCUMENT_STORE = os.getenv("DOCUMENT_STORE", "0") == "1"
+DOCUMENT_STORE_PATH = os.getenv("DOCUMENT_STORE_PATH", os.path.join("vector_data", "documents.sqlite3"))
+DOCUMENT_CACHE_SIZE = int(os.getenv("DOCUMENT_CACHE_SIZE", "512"))
+
+BODY_FIELDS = ("user_prompt", "ai_response")
+# SQLite's default limit on host parameters per statement is 999
+MAX_IDS_PER_QUERY = 500
+
+def compress_body(body):
+    return zlib.compress(json.dumps(body, separators=(",", ":")).encode("utf-8"))
+
+def decompress_body(blob):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+def split_body(metadata):
+    """(slim metadata, body): user_prompt/ai_response moved out and replaced by their token counts
+
+    The body is None, and the metadata a plain copy, unless both fields are present.
+    """
+    metadata = dict(metadata or {})
+    if not all(field in metadata for field in BODY_FIELDS):
+        return metadata, None
+    body = {field: metadata.pop(field) for field in BODY_FIELDS}
+    metadata["prompt_tokens"] = estimate_tokens(body["user_prompt"])
+    metadata["response_tokens"] = estimate_tokens(body["ai_response"])
+    return metadata, body
+
+class ConversationDocumentStore:
+    """zlib-compressed conversation bodies in SQLite keyed by conversation id, behind a small LRU"""
+
+    def __init__(self, path=DOCUMENT_STORE_PATH, cache_size=DOCUMENT_CACHE_SIZE):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.bytes_stored = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, namespace TEXT NOT NULL, body BLOB NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS documents_namespace ON documents (namespace)")
+        self._db.commit()
+
+    def _remember(self, conversation_id, body):
+        if self.cache_size <= 0:
+            return
+        self._cache[conversation_id] = body
+        self._cache.move_to_end(conversation_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def put_many(self, namespace, documents):
+        """Store {conversation_id: body} for one namespace in a single transaction"""
+        rows = [(conversation_id, namespace, compress_body(body)) for conversation_id, body in documents.items()]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO documents (id, namespace, body) VALUES (?, ?, ?)", rows)
+            self._db.commit()
+            self.bytes_stored += sum(len(row[2]) for row in rows)
+            # Just-written conversations are the likeliest to be asked for next
+            for conversation_id, body in documents.items():
+                self._remember(conversation_id, body)
+
+    def get_many(self, conversation_ids):
+        """{conversation_id: body} for the ids that exist, reading only cache misses from disk"""
+        found = {}
+        with self._lock:
+            missing = []
+            for conversation_id in dict.fromkeys(conversation_ids):
+                body = self._cache.get(conversation_id)
+                if body is None:
+                    missing.append(conversation_id)
+                else:
+                    self._cache.move_to_end(conversation_id)
+                    found[conversation_id] = body
+            self.cache_hits += len(found)
+            self.cache_misses += len(missing)
+
+            for start in range(0, len(missing), MAX_IDS_PER_QUERY):
+                chunk = missing[start:start + MAX_IDS_PER_QUERY]
+                placeholders = ",".join("?" * len(chunk))
+                for conversation_id, blob in self._db.execute(
+                    f"SELECT id, body FROM documents WHERE id IN ({placeholders})", chunk
+                ):
+                    body = decompress_body(blob)
+                    found[conversation_id] = body
+                    self._remember(conversation_id, body)
+        return found
+
+    def namespace_documents(self, namespace, since=0):
+        """[(rowid, conversation_id, body)] for a namespace, oldest write first, from rowid since on
+
+        Every write gets a rowid above all current ones, except that replacing the newest
+        document can reuse its rowid; since is inclusive so passing the last rowid seen
+        still picks that up. Bodies read here skip the cache, as they are not being served.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT rowid, id, body FROM documents WHERE namespace = ? AND rowid >= ? ORDER BY rowid",
+                (namespace, since)
+            ).fetchall()
+        return [(rowid, conversation_id, decompress_body(blob)) for rowid, conversation_id, blob in rows]
+
+    def delete(self, conversation_ids):
+        conversation_ids = list(conversation_ids)
+        with self._lock:
+            for start in range(0, len(conversation_ids), MAX_IDS_PER_QUERY):
+                chunk = conversation_ids[start:start + MAX_IDS_PER_QUERY]
+                self._db.execute(f"DELETE FROM documents WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            self._db.commit()
+            for conversation_id in conversation_ids:
+                self._cache.pop(conversation_id, None)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                "cache_size": len(self._cache),
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "cache_hit_rate": round(self.cache_hits / lookups, 4) if lookups else 0.0,
+                "compressed_bytes_written": self.bytes_stored,
+            }
+
+class DocumentVectorStore(VectorStore):
+    """Wraps a vector store so conversation bodies go to the document store and metadata stays slim
+
+    Upserted metadata keeps everything except user_prompt/ai_response, plus their token
+    counts so history can be ranked and budgeted before any body is read. hydrate()
+    fetches bodies in bulk for the matches that need them.
+    """
+
+    def __init__(self, store, documents=None):
+        self.store = store
+        if documents is None:
+            inner = base_store(store)
+            # The unpersisted fake store gets an in-memory document store to match
+            unpersisted = isinstance(inner, LocalVectorStore) and not inner.path
+            documents = ConversationDocumentStore(":memory:" if unpersisted else DOCUMENT_STORE_PATH)
+        self.documents = documents
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    async def upsert(self, vectors, namespace):
+        records = []
+        bodies = {}
+        for conversation_id, values, metadata in normalize_vector_records(vectors):
+            metadata, body = split_body(metadata)
+            if body is not None:
+                bodies[conversation_id] = body
+            records.append({"id": conversation_id, "values": values, "metadata": metadata})
+        # Bodies first, so a search never finds a vector whose body isn't stored yet
+        if bodies:
+            await asyncio.to_thread(self.documents.put_many, namespace, bodies)
+        return await self.store.upsert(records, namespace)
+
+    def stored_metadata(self, metadata):
+        """The metadata upsert() sends to the wrapped store for this metadata"""
+        return split_body(metadata)[0]
+
+    async def query(self, vector, namespace, top_k=10, filter=None, include_metadata=True):
+        return await self.store.query(vector, namespace, top_k, filter, include_metadata)
+
+    async def query_many(self, vectors, namespace, top_k=10, filter=None, include_metadata=True):
+        return await self.store.query_many(vectors, namespace, top_k, filter, include_metadata)
+
+    async def delete(self, ids, namespace):
+        result = await self.store.delete(ids, namespace)
+        await asyncio.to_thread(self.documents.delete, ids)
+        return result
+
+    async def hydrate(self, matches):
+        """Add user_prompt/ai_response to the matches' metadata with one bulk read
+
+        Metadata is replaced rather than updated so bodies never leak into a store's own records.
+        """
+        wanted = [match for match in matches if match.metadata is not None and "user_prompt" not in match.metadata]
+        if not wanted:
+            return matches
+        bodies = await asyncio.to_thread(self.documents.get_many, [match.id for match in wanted])
+        for match in wanted:
+            body = bodies.get(match.id)
+            if body is not None:
+                match.metadata = {**match.metadata, **body}
+        return matches
+
+    async def fetch(self, ids, namespace):
+        return await self.store.fetch(ids, namespace)
+
+    async def describe_index_stats(self, filter=None):
+        return await self.store.describe_index_stats(filter)
+
+    def records(self, namespace):
+        return self.store.records(namespace)
+
+    async def close(self):
+        await self.store.close()
+        self.documents.close()
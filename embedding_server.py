@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""Shared embedding process for multi-worker deployments
+
+serve.py starts it next to the API workers when WORKERS > 1; it can also run on its own:
+
+    python embedding_server.py
+    python embedding_server.py --compare    # cosine drift and speed of int8/float16 vs float32
+
+Workers connect over the Unix socket at EMBEDDING_SERVER_SOCKET, and concurrent requests
+from all of them are merged into one model batch. With EMBEDDING_PRECISION=int8 or
+float16 a reduced-precision copy of the model is served, provided its embeddings stay
+within EMBEDDING_MIN_COSINE of full precision on the calibration texts.
+"""
+
+import os
+import json
+import time
+import copy
+import socket
+import signal
+import struct
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from embeddings import EmbeddingBatcher, EMBED_BATCH_WINDOW_MS
+from startup import StartupTracker, load_embedding_model, WARMUP_TEXTS
+
+EMBEDDING_SERVER_SOCKET = os.getenv("EMBEDDING_SERVER_SOCKET", "")
+EMBEDDING_PRECISION = os.getenv("EMBEDDING_PRECISION", "float32")
+EMBEDDING_MIN_COSINE = float(os.getenv("EMBEDDING_MIN_COSINE", "0.99"))
+EMBEDDING_SERVER_BATCH_SIZE = int(os.getenv("EMBEDDING_SERVER_BATCH_SIZE", "64"))
+EMBEDDING_SERVER_CONNECT_SECONDS = float(os.getenv("EMBEDDING_SERVER_CONNECT_SECONDS", "120"))
+
+# Every message is a 4-byte big-endian length and a payload. Requests carry a JSON list of
+# texts; responses a status byte, then float32 rows (status 0) or an error message (status 1).
+FRAME_HEADER = struct.Struct("!I")
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+CALIBRATION_TEXTS = WARMUP_TEXTS + [
+    "TypeError: cannot read properties of undefined (reading 'map') in UserList.render",
+    "How do I add a composite index in PostgreSQL for a query filtering on tenant_id and created_at?",
+    "class LRUCache:\n    def __init__(self, capacity):\n        self.capacity = capacity\n"
+    "        self.entries = OrderedDict()",
+    "Why does my Dockerfile rebuild every layer after changing one line of application code?",
+    "Write a unit test for parse_config_file that covers a missing section.",
+    "What's the difference between git rebase and git merge when updating a feature branch?",
+]
+
+def reduce_precision(model, precision):
+    """A copy of the model in int8 (dynamic quantization of the Linear layers) or float16"""
+    import torch
+    if precision == "int8":
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if precision == "float16":
+        return copy.deepcopy(model).half()
+    raise ValueError(f"Unknown precision '{precision}', expected 'float32', 'float16' or 'int8'")
+
+def cosine_agreement(reference, candidate, texts=CALIBRATION_TEXTS):
+    """(min, mean) cosine similarity between two models' embeddings of the same texts"""
+    expected = np.asarray(reference.encode(texts, normalize_embeddings=True), dtype=np.float32)
+    actual = np.asarray(candidate.encode(texts, normalize_embeddings=True), dtype=np.float32)
+    similarities = np.sum(expected * actual, axis=1)
+    return float(similarities.min()), float(similarities.mean())
+
+def load_serving_model(tracker, precision=EMBEDDING_PRECISION, min_cosine=EMBEDDING_MIN_COSINE):
+    """Load the model and reduce its precision if it stays within tolerance; returns (model, precision)"""
+    model = load_embedding_model(tracker)
+    if model is None or precision == "float32":
+        return model, "float32"
+    with tracker.component(f"precision:{precision}"):
+        reduced = reduce_precision(model, precision)
+        worst, mean = cosine_agreement(model, reduced)
+        print(f"{precision} model cosine vs float32: min {worst:.4f}, mean {mean:.4f}")
+        if worst >= min_cosine:
+            return reduced, precision
+        print(f"{precision} model is outside EMBEDDING_MIN_COSINE={min_cosine}, serving float32")
+    return model, "float32"
+
+async def read_frame(reader):
+    (length,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    return await reader.readexactly(length)
+
+def receive_exactly(sock, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("Embedding server closed the connection")
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+class EmbeddingServer:
+    """Serves encodes over a Unix socket, batching texts across every connected worker"""
+
+    def __init__(self, model, path=EMBEDDING_SERVER_SOCKET, max_batch_size=EMBEDDING_SERVER_BATCH_SIZE,
+                 window_ms=EMBED_BATCH_WINDOW_MS):
+        self.model = model
+        self.path = path
+        self.requests = 0
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+        self.batcher = EmbeddingBatcher(self._encode_batch, self.executor, max_batch_size, window_ms)
+
+    def _encode_batch(self, texts):
+        return np.asarray(self.model.encode(texts, batch_size=len(texts)), dtype=np.float32)
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                texts = json.loads(await read_frame(reader))
+                try:
+                    vectors = await asyncio.gather(*(self.batcher.encode(text) for text in texts))
+                    payload = bytes([STATUS_OK]) + np.asarray(vectors, dtype=np.float32).tobytes()
+                except Exception as e:
+                    payload = bytes([STATUS_ERROR]) + str(e).encode("utf-8")
+                self.requests += 1
+                writer.write(FRAME_HEADER.pack(len(payload)) + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_forever(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = await asyncio.start_unix_server(self._handle, path=self.path)
+        print(f"Embedding server listening on {self.path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.close()
+            self.executor.shutdown(wait=False)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+class RemoteEncoder:
+    """Stands in for SentenceTransformer in a worker: encode() is answered by the embedding server
+
+    Each calling thread keeps its own connection, reopened once if the server went away.
+    """
+
+    def __init__(self, path=EMBEDDING_SERVER_SOCKET):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            self._local.sock = sock
+        return sock
+
+    def _disconnect(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def _request(self, payload):
+        sock = self._connection()
+        sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+        (length,) = FRAME_HEADER.unpack(receive_exactly(sock, FRAME_HEADER.size))
+        return receive_exactly(sock, length)
+
+    def encode(self, texts, batch_size=None, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        payload = json.dumps(texts).encode("utf-8")
+        try:
+            response = self._request(payload)
+        except OSError:
+            # Stale connection, e.g. the server restarted: retry once on a fresh one
+            self._disconnect()
+            response = self._request(payload)
+        if response[0] != STATUS_OK:
+            raise RuntimeError(f"Embedding server error: {response[1:].decode('utf-8')}")
+        vectors = np.frombuffer(response, dtype=np.float32, offset=1).reshape(len(texts), -1)
+        return vectors[0] if single else vectors
+
+    def wait_ready(self, timeout_seconds=EMBEDDING_SERVER_CONNECT_SECONDS):
+        """Block until the server answers, e.g. while it is still loading the model"""
+        deadline = time.monotonic() + timeout_seconds
+        while True:
+            try:
+                self.encode(["ping"])
+                return self
+            except OSError:
+                self._disconnect()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.25)
+
+def compare_precisions(texts=CALIBRATION_TEXTS, repeats=20):
+    """Print cosine agreement and encode throughput of each precision against float32"""
+    model = load_embedding_model(StartupTracker())
+    batch = texts * 4
+    for precision in ("float32", "int8", "float16"):
+        candidate = model if precision == "float32" else reduce_precision(model, precision)
+        worst, mean = cosine_agreement(model, candidate, texts)
+        candidate.encode(batch)
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            candidate.encode(batch, batch_size=len(batch))
+        rate = repeats * len(batch) / (time.perf_counter() - start_time)
+        print(f"{precision:<8} cosine min {worst:.4f} mean {mean:.4f}   {rate:>8.1f} texts/s")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket", default=EMBEDDING_SERVER_SOCKET or "/tmp/embedding.sock")
+    parser.add_argument("--precision", default=EMBEDDING_PRECISION, choices=["float32", "float16", "int8"])
+    parser.add_argument("--compare", action="store_true", help="compare precisions and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_precisions()
+        return
+    tracker = StartupTracker()
+    model, precision = load_serving_model(tracker, args.precision)
+    if model is None:
+        raise SystemExit("Could not load the embedding model")
+    print(f"Serving {precision} embeddings")
+    # serve.py stops it with SIGTERM; treat that like Ctrl+C so the socket file is removed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(EmbeddingServer(model, args.socket).serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import os
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import metrics
+
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "1"))
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))
+
+def text_key(text):
+    """Cache key for a text; hashing keeps long prompts out of the key space"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def cosine_similarity(a, b):
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    denominator = np.linalg.norm(a) * np.linalg.norm(b)
+    return float(a @ b / denominator) if denominator else 0.0
+
+class EmbeddingCache:
+    """Bounded, thread-safe LRU of embeddings keyed by text hash"""
+
+    def __init__(self, max_size=EMBED_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key, vector):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+class EmbeddingBatcher:
+    """Collects concurrent encode calls for a short window and runs them as one batch"""
+
+    def __init__(self, encode_batch, executor, max_batch_size=EMBED_BATCH_SIZE,
+                 window_ms=EMBED_BATCH_WINDOW_MS):
+        self.encode_batch = encode_batch
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.window_seconds = window_ms / 1000.0
+        self.batches = 0
+        self.batched_texts = 0
+        # Created on first use so they bind to the running event loop
+        self._queue = None
+        self._worker = None
+
+    async def encode(self, text):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((text, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window_seconds
+        while len(batch) < self.max_batch_size:
+            # Take whatever is already queued before waiting out the window
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # Identical texts in the same window share one row of the batch
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vectors = await loop.run_in_executor(self.executor, self.encode_batch, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.batched_texts += len(texts)
+            by_text = dict(zip(texts, vectors))
+            for text, future in batch:
+                if not future.done():
+                    future.set_result(by_text[text])
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+            self._queue = None
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "batched_texts": self.batched_texts,
+            "avg_batch_size": round(self.batched_texts / self.batches, 2) if self.batches else 0.0,
+        }
+
+class EmbeddingService:
+    """Runs SentenceTransformer encodes on a dedicated executor off the event loop"""
+
+    def __init__(self, model=None, max_workers=EMBED_WORKERS, cache_size=EMBED_CACHE_SIZE,
+                 max_batch_size=EMBED_BATCH_SIZE, batch_window_ms=EMBED_BATCH_WINDOW_MS):
+        # May be attached after construction when the model loads in the background
+        self.model = model
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="embed")
+        self.cache = EmbeddingCache(cache_size)
+        # A batch size of 1 keeps the old one-at-a-time path
+        self.batcher = None
+        if max_batch_size > 1:
+            self.batcher = EmbeddingBatcher(self.encode_batch_sync, self.executor,
+                                            max_batch_size, batch_window_ms)
+        self.memo_hits = 0
+        self.encodes = 0
+
+    def encode_batch_sync(self, texts):
+        self.encodes += len(texts)
+        start_time = time.perf_counter()
+        vectors = self.model.encode(texts, batch_size=len(texts)).tolist()
+        metrics.EMBED_BATCH_SECONDS.observe(time.perf_counter() - start_time)
+        metrics.EMBED_BATCH_TEXTS.observe(len(texts))
+        return vectors
+
+    def encode_sync(self, text):
+        return self.encode_batch_sync([text])[0]
+
+    async def encode(self, text, memo=None):
+        """Embed text, reusing the per-request memo and the shared LRU before encoding"""
+        key = text_key(text)
+        if memo is not None and key in memo:
+            self.memo_hits += 1
+            return memo[key]
+
+        vector = self.cache.get(key)
+        if vector is None:
+            if self.batcher is not None:
+                vector = await self.batcher.encode(text)
+            else:
+                loop = asyncio.get_running_loop()
+                vector = await loop.run_in_executor(self.executor, self.encode_sync, text)
+            self.cache.put(key, vector)
+
+        if memo is not None:
+            memo[key] = vector
+        return vector
+
+    async def encode_many(self, texts, memo=None):
+        """Embed several texts, encoding every memo and cache miss in a single model call"""
+        keys = [text_key(text) for text in texts]
+        vectors = {}
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key in vectors or key in missing:
+                continue
+            if memo is not None and key in memo:
+                self.memo_hits += 1
+                vectors[key] = memo[key]
+                continue
+            vector = self.cache.get(key)
+            if vector is None:
+                missing[key] = text
+            else:
+                vectors[key] = vector
+
+        if missing:
+            loop = asyncio.get_running_loop()
+            encoded = await loop.run_in_executor(self.executor, self.encode_batch_sync, list(missing.values()))
+            for key, vector in zip(missing, encoded):
+                self.cache.put(key, vector)
+                vectors[key] = vector
+
+        if memo is not None:
+            memo.update(vectors)
+        return [vectors[key] for key in keys]
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats["memo_hits"] = self.memo_hits
+        stats["encodes"] = self.encodes
+        if self.batcher is not None:
+            stats.update(self.batcher.stats())
+        return stats
+
+    async def close(self):
+        if self.batcher is not None:
+            await self.batcher.close()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,389 @@
+import os
+import re
+import math
+import time
+import heapq
+import asyncio
+import threading
+from collections import OrderedDict
+
+from vector_store import VectorStore, Match, QueryResult, normalize_vector_records, SHARED_WRITERS
+from context_assembly import HISTORY_SCORE_FLOOR
+
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "0") == "1"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "30"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+# BM25 hits below either bound are dropped before fusion, so weak term overlap can't outrank close vector matches
+HYBRID_MIN_BM25 = float(os.getenv("HYBRID_MIN_BM25", "1.0"))
+HYBRID_MIN_BM25_RATIO = float(os.getenv("HYBRID_MIN_BM25_RATIO", "0.3"))
+LEXICAL_INDEX_NAMESPACES = int(os.getenv("LEXICAL_INDEX_NAMESPACES", "256"))
+LEXICAL_INDEX_CONVERSATIONS = int(os.getenv("LEXICAL_INDEX_CONVERSATIONS", "100000"))
+# Other workers' writes reach an index by reading newer document-store rows this often; 0 never does
+LEXICAL_INDEX_REFRESH_SECONDS = float(os.getenv("LEXICAL_INDEX_REFRESH_SECONDS", "10" if SHARED_WRITERS else "0"))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+BUILD_CHUNK_SIZE = 500
+
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+# Splits camelCase, PascalCase and acronyms: "parseHTTPResponse2" -> parse, HTTP, Response, 2
+IDENTIFIER_PART = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from how i if in is it its me my no not of on or "
+    "so that the this to was what when where which why will with you your".split()
+)
+
+def code_tokens(text):
+    """Lowercased terms for code-heavy text: each identifier whole plus its snake_case/camelCase parts"""
+    tokens = []
+    for identifier in IDENTIFIER.findall(text):
+        whole = identifier.lower()
+        if len(whole) > 1 and whole not in STOPWORDS:
+            tokens.append(whole)
+        parts = [part.lower() for piece in identifier.split("_") for part in IDENTIFIER_PART.findall(piece)]
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if len(part) > 1 and part not in STOPWORDS)
+    return tokens
+
+def conversation_text(metadata):
+    return f"{metadata.get('user_prompt', '')} {metadata.get('ai_response', '')}"
+
+class NamespaceIndex:
+    """BM25 inverted index over one namespace's conversations, updated one conversation at a time"""
+
+    def __init__(self):
+        self.postings = {}  # term -> {conversation_id: term frequency}
+        self.lengths = {}  # conversation_id -> token count
+        self.total_length = 0
+        # Terms per conversation, so removal touches only that conversation's postings
+        self._terms = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __contains__(self, conversation_id):
+        return conversation_id in self.lengths
+
+    def _remove(self, conversation_id):
+        length = self.lengths.pop(conversation_id, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for term in self._terms.pop(conversation_id, ()):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(conversation_id, None)
+                if not postings:
+                    del self.postings[term]
+
+    def add(self, conversation_id, tokens):
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        with self._lock:
+            self._remove(conversation_id)
+            for term, count in counts.items():
+                self.postings.setdefault(term, {})[conversation_id] = count
+            self._terms[conversation_id] = tuple(counts)
+            self.lengths[conversation_id] = len(tokens)
+            self.total_length += len(tokens)
+
+    def remove(self, conversation_ids):
+        with self._lock:
+            for conversation_id in conversation_ids:
+                self._remove(conversation_id)
+
+    def search(self, tokens, top_k):
+        """[(conversation_id, bm25 score)] best first"""
+        with self._lock:
+            count = len(self.lengths)
+            if not count:
+                return []
+            average_length = self.total_length / count or 1.0
+            scores = {}
+            for term in set(tokens):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for conversation_id, frequency in postings.items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[conversation_id] / average_length)
+                    scores[conversation_id] = scores.get(conversation_id, 0.0) + \
+                        idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """{id: sum of 1 / (k + rank)} over several best-first id lists"""
+    fused = {}
+    for ranking in rankings:
+        for rank, conversation_id in enumerate(ranking, start=1):
+            fused[conversation_id] = fused.get(conversation_id, 0.0) + 1.0 / (k + rank)
+    return fused
+
+def strong_lexical_hits(lexical_hits, min_score=HYBRID_MIN_BM25, min_ratio=HYBRID_MIN_BM25_RATIO):
+    """The BM25 hits scoring at least min_score and min_ratio of the best hit"""
+    if not lexical_hits:
+        return []
+    cutoff = max(min_score, min_ratio * lexical_hits[0][1])
+    return [(conversation_id, score) for conversation_id, score in lexical_hits if score >= cutoff]
+
+def fused_ranking(vector_matches, lexical_hits, top_k, k=RRF_K):
+    """The top_k (id, fused score) of the vector ranking fused with the strong BM25 hits, best first"""
+    lexical_ids = [conversation_id for conversation_id, _ in strong_lexical_hits(lexical_hits)]
+    fused = reciprocal_rank_fusion([[match.id for match in vector_matches], lexical_ids], k)
+    return heapq.nlargest(top_k, fused.items(), key=lambda item: item[1])
+
+def fuse_matches(vector_matches, lexical_hits, lexical_metadata, top_k, k=RRF_K, score_floor=HISTORY_SCORE_FLOOR):
+    """Top matches by reciprocal rank fusion of vector and BM25 rankings
+
+    Fusion picks and orders the matches, but score stays the cosine similarity that the
+    history score floor, recency blend and query enhancement compare; the fused score,
+    rescaled so a conversation ranked first by both searches gets 1.0, is kept in
+    fused_score. Only strong BM25 hits take part, and those are lifted to the floor:
+    a BM25-only hit has no cosine score, and a weak vector match with lexical support
+    should not be dropped for its cosine alone.
+    """
+    best_possible = 2.0 / (k + 1)
+    by_id = {match.id: match for match in vector_matches}
+    lexical_set = {conversation_id for conversation_id, _ in strong_lexical_hits(lexical_hits)}
+
+    matches = []
+    for conversation_id, fused_score in fused_ranking(vector_matches, lexical_hits, top_k, k):
+        match = by_id.get(conversation_id)
+        if match is not None:
+            score, metadata = match.score, match.metadata
+        else:
+            metadata = lexical_metadata.get(conversation_id)
+            if metadata is None:
+                continue
+            score, metadata = score_floor, dict(metadata)
+        if conversation_id in lexical_set:
+            score = max(score, score_floor)
+        matches.append(Match(id=conversation_id, score=score, metadata=metadata,
+                             fused_score=fused_score / best_possible))
+    return matches
+
+class LexicalVectorStore(VectorStore):
+    """Wraps a vector store with per-namespace BM25 indexes kept in step with its upserts and deletes
+
+    Sits above the document store so upserts still carry the conversation text. A namespace's
+    index is built in the background the first time it is searched, from the document store
+    when there is one and otherwise from store.records(); until then hybrid_query() answers
+    from the vector search alone. Indexes hold term statistics only, and the metadata of
+    BM25-only matches is fetched from the store. The LEXICAL_INDEX_NAMESPACES most recently
+    searched namespaces are kept, up to LEXICAL_INDEX_CONVERSATIONS conversations in all.
+    With a refresh interval an index reads the document-store rows written since its last
+    read, to pick up writes made by other workers.
+    """
+
+    def __init__(self, store, max_namespaces=LEXICAL_INDEX_NAMESPACES, max_conversations=LEXICAL_INDEX_CONVERSATIONS,
+                 candidates=HYBRID_CANDIDATES, refresh_seconds=LEXICAL_INDEX_REFRESH_SECONDS):
+        self.store = store
+        self.max_namespaces = max_namespaces
+        self.max_conversations = max_conversations
+        self.candidates = candidates
+        self.refresh_seconds = refresh_seconds
+        self.indexes = OrderedDict()  # namespace -> NamespaceIndex, least recently searched first
+        self.fused_queries = 0
+        self.vector_only_queries = 0
+        self._builds = {}
+        self._refreshes = {}
+        self._deleted = {}  # namespace -> ids deleted while its index was being built
+        self._read_rowids = {}  # namespace -> last document-store rowid read into its index
+        self._read_at = {}  # namespace -> monotonic time of that read
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    @property
+    def _documents(self):
+        return getattr(self.store, "documents", None)
+
+    async def upsert(self, vectors, namespace):
+        result = await self.store.upsert(vectors, namespace)
+        index = self.indexes.get(namespace)
+        if index is not None:
+            for conversation_id, _, metadata in normalize_vector_records(vectors):
+                index.add(conversation_id, code_tokens(conversation_text(metadata or {})))
+        return result
+
+    async def query(self, vector, namespace, top_k=10, filter=None, include_metadata=True):
+        return await self.store.query(vector, namespace, top_k, filter, include_metadata)
+
+    async def query_many(self, vectors, namespace, top_k=10, filter=None, include_metadata=True):
+        return await self.store.query_many(vectors, namespace, top_k, filter, include_metadata)
+
+    async def delete(self, ids, namespace):
+        result = await self.store.delete(ids, namespace)
+        index = self.indexes.get(namespace)
+        if index is not None:
+            index.remove(ids)
+            if namespace in self._builds:
+                self._deleted.setdefault(namespace, set()).update(ids)
+        return result
+
+    async def fetch(self, ids, namespace):
+        return await self.store.fetch(ids, namespace)
+
+    def _index(self, namespace):
+        """The namespace's index if it is ready, starting a background build if there is none"""
+        index = self.indexes.get(namespace)
+        if index is not None:
+            self.indexes.move_to_end(namespace)
+            if namespace in self._builds:
+                return None
+            if (self.refresh_seconds and self._documents is not None and namespace not in self._refreshes
+                    and time.monotonic() - self._read_at[namespace] > self.refresh_seconds):
+                self._refreshes[namespace] = asyncio.create_task(self._refresh(namespace, index))
+            return index
+
+        index = self.indexes[namespace] = NamespaceIndex()
+        self._builds[namespace] = asyncio.create_task(self._build(namespace, index))
+        self._evict()
+        return None
+
+    def _evict(self):
+        """Drop the least recently searched indexes until both caps are met, keeping the newest"""
+        conversations = sum(len(index) for index in self.indexes.values())
+        while len(self.indexes) > 1 and (len(self.indexes) > self.max_namespaces
+                                         or conversations > self.max_conversations):
+            evicted, index = self.indexes.popitem(last=False)
+            conversations -= len(index)
+            self._read_rowids.pop(evicted, None)
+            self._read_at.pop(evicted, None)
+            for tasks in (self._builds, self._refreshes):
+                task = tasks.pop(evicted, None)
+                if task is not None:
+                    task.cancel()
+
+    async def ensure_index(self, namespace):
+        """Build the namespace's index now if it isn't ready and return it"""
+        index = self._index(namespace)
+        if index is None:
+            await self._builds[namespace]
+            index = self.indexes.get(namespace)
+        return index
+
+    async def _build(self, namespace, index):
+        try:
+            if self._documents is not None:
+                await self._read_documents(namespace, index)
+            else:
+                chunk = []
+                async for conversation_id, _, metadata in self.store.records(namespace):
+                    chunk.append((conversation_id, metadata or {}))
+                    if len(chunk) >= BUILD_CHUNK_SIZE:
+                        await self._index_chunk(namespace, index, chunk)
+                        chunk = []
+                await self._index_chunk(namespace, index, chunk)
+        except Exception as e:
+            print(f"Error building lexical index for namespace {namespace}: {e}")
+            if self.indexes.get(namespace) is index:
+                del self.indexes[namespace]
+        finally:
+            if self._builds.get(namespace) is asyncio.current_task():
+                del self._builds[namespace]
+                self._deleted.pop(namespace, None)
+        self._evict()
+
+    async def _refresh(self, namespace, index):
+        try:
+            await self._read_documents(namespace, index)
+        except Exception as e:
+            print(f"Error refreshing lexical index for namespace {namespace}: {e}")
+        finally:
+            if self._refreshes.get(namespace) is asyncio.current_task():
+                del self._refreshes[namespace]
+
+    async def _read_documents(self, namespace, index):
+        """Index the namespace's document-store rows written since the index last read them"""
+        self._read_at[namespace] = time.monotonic()
+        rows = await asyncio.to_thread(self._documents.namespace_documents, namespace,
+                                       self._read_rowids.get(namespace, 0))
+        await self._index_chunk(namespace, index, [(conversation_id, body) for _, conversation_id, body in rows])
+        if rows:
+            self._read_rowids[namespace] = rows[-1][0]
+
+    async def _index_chunk(self, namespace, index, records):
+        building = namespace in self._builds
+        deleted = self._deleted.get(namespace, ())
+        # During a build, writes already indexed are newer than this snapshot
+        fresh = [(conversation_id, body) for conversation_id, body in records
+                 if not (building and conversation_id in index) and conversation_id not in deleted]
+
+        def tokenize():
+            for conversation_id, body in fresh:
+                index.add(conversation_id, code_tokens(conversation_text(body)))
+
+        await asyncio.to_thread(tokenize)
+
+    async def lexical_search(self, namespace, query, top_k):
+        """BM25 hits for the query, or None while the namespace's index is still being built"""
+        index = self._index(namespace)
+        if index is None:
+            return None
+        return index.search(code_tokens(query), top_k)
+
+    async def _fuse(self, namespace, vector_results, lexical_hits, top_k):
+        """fuse_matches() for each query, fetching the metadata of BM25-only matches in one call"""
+        missing = set()
+        for result, hits in zip(vector_results, lexical_hits):
+            vector_ids = {match.id for match in result.matches}
+            missing.update(conversation_id for conversation_id, _ in fused_ranking(result.matches, hits, top_k)
+                           if conversation_id not in vector_ids)
+        lexical_metadata = await self.store.fetch(list(missing), namespace) if missing else {}
+        index = self.indexes.get(namespace)
+        if index is not None and len(lexical_metadata) < len(missing):
+            # Deleted by another worker since the index read them
+            index.remove(missing.difference(lexical_metadata))
+        return [QueryResult(matches=fuse_matches(result.matches, hits, lexical_metadata, top_k), namespace=namespace)
+                for result, hits in zip(vector_results, lexical_hits)]
+
+    async def hybrid_query(self, vector, query, namespace, top_k=10):
+        """Vector and BM25 searches fused by reciprocal rank fusion"""
+        vector_results, lexical_hits = await asyncio.gather(
+            self.store.query(vector, namespace, top_k=max(top_k, self.candidates), include_metadata=True),
+            self.lexical_search(namespace, query, max(top_k, self.candidates)),
+        )
+        if lexical_hits is None:
+            self.vector_only_queries += 1
+            return QueryResult(matches=vector_results.matches[:top_k], namespace=namespace)
+        self.fused_queries += 1
+        return (await self._fuse(namespace, [vector_results], [lexical_hits], top_k))[0]
+
+    async def hybrid_query_many(self, vectors, queries, namespace, top_k=10):
+        """hybrid_query() for several queries against one namespace, with one grouped vector search"""
+        candidates = max(top_k, self.candidates)
+        vector_results = await self.store.query_many(vectors, namespace, top_k=candidates, include_metadata=True)
+        index = self._index(namespace)
+        if index is None:
+            self.vector_only_queries += len(queries)
+            return [QueryResult(matches=result.matches[:top_k], namespace=namespace) for result in vector_results]
+        self.fused_queries += len(queries)
+        return await self._fuse(namespace, vector_results,
+                                [index.search(code_tokens(query), candidates) for query in queries], top_k)
+
+    async def describe_index_stats(self, filter=None):
+        return await self.store.describe_index_stats(filter)
+
+    def records(self, namespace):
+        return self.store.records(namespace)
+
+    async def close(self):
+        tasks = [*self._builds.values(), *self._refreshes.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._builds = {}
+        self._refreshes = {}
+        await self.store.close()
+
+    def lexical_stats(self):
+        return {
+            "namespaces_indexed": len(self.indexes) - len(self._builds),
+            "namespaces_building": len(self._builds),
+            "conversations_indexed": sum(len(index) for index in self.indexes.values()),
+            "fused_queries": self.fused_queries,
+            "vector_only_queries": self.vector_only_queries,
+        }
@@ -0,0 +1,122 @@
+import os
+import time
+import asyncio
+import hashlib
+from dataclasses import dataclass
+
+import metrics
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+FAKE_LLM_LATENCY_SECONDS = float(os.getenv("FAKE_LLM_LATENCY_SECONDS", "0"))
+
+@dataclass
+class GenerationResult:
+    text: str
+    error: str = ""
+    generation_time_seconds: float = 0.0
+
+class GeminiBackend:
+    """Gemini backend that keeps one configured model for the life of the process"""
+    name = "gemini"
+
+    def __init__(self, system_instruction=None):
+        # Imported here so the fake backend never pays for google.generativeai
+        import chat
+        if system_instruction:
+            self.model = chat.create_model(system_instruction)
+        else:
+            self.model = chat.create_model()
+
+    async def agenerate(self, payload):
+        # A fresh session per call keeps requests independent, like the old chat.py subprocess
+        chat_session = self.model.start_chat(history=[])
+        response = await chat_session.send_message_async(payload)
+        return response.text
+
+    async def astream(self, payload):
+        chat_session = self.model.start_chat(history=[])
+        response = await chat_session.send_message_async(payload, stream=True)
+        async for chunk in response:
+            yield chunk.text
+
+class FakeBackend:
+    """Deterministic local backend for tests and benchmarks"""
+    name = "fake"
+
+    def __init__(self, system_instruction=None, latency_seconds=FAKE_LLM_LATENCY_SECONDS):
+        self.system_instruction = system_instruction
+        self.latency_seconds = latency_seconds
+
+    async def agenerate(self, payload):
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+        return self._respond(payload)
+
+    async def astream(self, payload):
+        words = self._respond(payload).split(" ")
+        for position, word in enumerate(words):
+            if self.latency_seconds:
+                await asyncio.sleep(self.latency_seconds / len(words))
+            yield word if position == 0 else f" {word}"
+
+    def _respond(self, payload):
+        digest = hashlib.sha1(payload.encode("utf-8")).hexdigest()[:12]
+        return f"Fake response {digest}"
+
+BACKENDS = {
+    GeminiBackend.name: GeminiBackend,
+    FakeBackend.name: FakeBackend,
+}
+
+class GenerationEngine:
+    """Long-lived generation engine called directly from the request handler"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.init_time_seconds = 0.0
+
+    async def agenerate(self, payload):
+        """Generate a response for a JSON payload and time the call"""
+        start_time = time.perf_counter()
+        try:
+            text = (await self.backend.agenerate(payload)).strip()
+            error = ""
+        except Exception as e:
+            print(f"Error generating response with {self.backend.name} backend: {e}")
+            text = ""
+            error = str(e)
+        metrics.LLM_CALLS.inc(backend=self.backend.name, outcome="error" if error else "ok")
+        return GenerationResult(
+            text=text,
+            error=error,
+            generation_time_seconds=round(time.perf_counter() - start_time, 3),
+        )
+
+    async def astream(self, payload, result):
+        """Yield response chunks as they arrive and fill in result once the stream ends"""
+        start_time = time.perf_counter()
+        parts = []
+        try:
+            async for chunk in self.backend.astream(payload):
+                if not chunk:
+                    continue
+                parts.append(chunk)
+                yield chunk
+        except Exception as e:
+            print(f"Error streaming response with {self.backend.name} backend: {e}")
+            result.error = str(e)
+        metrics.LLM_CALLS.inc(backend=self.backend.name, outcome="error" if result.error else "ok")
+        result.text = "".join(parts).strip()
+        result.generation_time_seconds = round(time.perf_counter() - start_time, 3)
+
+def create_engine(backend_name=None, system_instruction=None):
+    """Create a generation engine for the configured backend"""
+    backend_name = backend_name or LLM_BACKEND
+    if backend_name not in BACKENDS:
+        raise ValueError(f"Unknown LLM backend '{backend_name}', expected one of {sorted(BACKENDS)}")
+
+    start_time = time.perf_counter()
+    engine = GenerationEngine(BACKENDS[backend_name](system_instruction=system_instruction))
+    engine.init_time_seconds = round(time.perf_counter() - start_time, 3)
+    print(f"Loaded {backend_name} generation backend in {engine.init_time_seconds}s")
+    return engine
@@ -1,111 +1,256 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
+from contextlib import asynccontextmanager, AsyncExitStack
+from dataclasses import asdict
 import subprocess
 import json
+import time
+import asyncio
 import uvicorn
 from typing import Optional, List
-from sentence_transformers import SentenceTransformer
-from pinecone import Pinecone
 from datetime import datetime
 import uuid
-import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI()
+from llm import create_engine, GenerationResult
+from embeddings import EmbeddingService, cosine_similarity
+from vector_store import create_vector_store, base_store, LocalVectorStore, VECTOR_STORE, LOCAL_VECTOR_STORE_FLUSH_SECONDS
+from dedup import DedupVectorStore, content_hash, DEDUP_MODE, DEDUP_SIMILARITY_THRESHOLD
+from namespace_stats import StatsVectorStore
+from document_store import DocumentVectorStore, DOCUMENT_STORE
+from hybrid_search import LexicalVectorStore, HYBRID_SEARCH
+from write_behind import WriteBehindQueue, PendingWrite, WRITE_BEHIND
+from response_cache import ResponseCache, context_hash, RESPONSE_CACHE
+from context_assembly import assemble_payload, estimate_tokens, history_candidates, HISTORY_TOP_K
+from query_enhancement import QueryEnhancer, QUERY_ENHANCEMENT
+from timing import stage, record_stage, start_request_timings, clear_request_timings, TIMING_BREAKDOWN
+from concurrency import ConcurrencyLimiter, OverloadedError, gather_bounded, BATCH_MAX_ITEMS, BATCH_GENERATION_CONCURRENCY
+from profiler import SamplingProfiler, DEBUG_ENDPOINTS
+from scheduler import GenerationScheduler
+from coalescing import SingleFlight, COALESCE_REQUESTS
+from compaction import HistoryCompactor, COMPACTION, COMPACTION_SUMMARIZER
+from startup import StartupTracker, load_embedding_model, warm_up, STARTUP_MODE
+from embedding_server import RemoteEncoder, EMBEDDING_SERVER_SOCKET
+import metrics
+from prompts.query_enhancement_instruction import QUERY_ENHANCEMENT_SYSTEM_INSTRUCTION
+from prompts.compaction_instruction import COMPACTION_SYSTEM_INSTRUCTION
+
+@asynccontextmanager
+async def lifespan(app):
+    if STARTUP_MODE == "background":
+        # Accept connections right away; /readyz reports 200 once everything is loaded and warm
+        startup.start_background(load_components)
+    else:
+        await asyncio.to_thread(startup.run, load_components)
+    if COMPACTION:
+        compactor.start()
+    flusher = asyncio.create_task(flush_local_store()) if LOCAL_VECTOR_STORE_FLUSH_SECONDS > 0 else None
+    yield
+    # Drain queued writes before the store and encoder go away
+    await compactor.close()
+    await write_queue.close()
+    if flusher is not None:
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
+    if vector_store is not None:
+        await vector_store.close()
+    await embedding_service.close()
+    profiler.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 class InputData(BaseModel):
     query: str
     user_ID: str
     context: Optional[List[str]] = None
 
-# Load SentenceTransformer model globally
-embedder = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+# Per-component load times, reported at /readyz
+startup = StartupTracker()
+
+# Encodes are CPU-bound, so they run on a dedicated executor instead of the event loop.
+# The SentenceTransformer model is attached by load_components() once it has loaded.
+embedding_service = EmbeddingService()
+
+# Vector store: Pinecone by default, VECTOR_STORE=local for the in-process index; connected by load_components()
+vector_store = None
+
+def connect_vector_store():
+    global vector_store
+    try:
+        store = create_vector_store()
+        if DOCUMENT_STORE:
+            # Conversation bodies live in a local document store; vector metadata stays small
+            store = DocumentVectorStore(store)
+        if HYBRID_SEARCH:
+            # Per-user BM25 indexes over identifiers, fused with the vector search
+            store = LexicalVectorStore(store)
+        # Exact-duplicate checks are served from a content-hash index kept in step with the store,
+        # /user-stats from per-namespace counters maintained the same way
+        vector_store = StatsVectorStore(DedupVectorStore(store))
+        compactor.store = vector_store
+        print(f"Connected to {VECTOR_STORE} vector store")
+    except Exception:
+        print("Please check your Pinecone API key and run setup_pinecone.py first")
+        raise
+
+async def flush_local_store():
+    """Write the local vector store's changed namespaces to disk every LOCAL_VECTOR_STORE_FLUSH_SECONDS"""
+    while True:
+        await asyncio.sleep(LOCAL_VECTOR_STORE_FLUSH_SECONDS)
+        store = base_store(vector_store) if vector_store is not None else None
+        if not isinstance(store, LocalVectorStore):
+            continue
+        try:
+            await store.persist()
+        except Exception as e:
+            print(f"Error flushing local vector store: {e}")
+
+def load_components():
+    """Connect the vector store, load the embedding model and warm it up"""
+    with startup.component("vector_store"):
+        connect_vector_store()
+    if EMBEDDING_SERVER_SOCKET:
+        # Multi-worker mode: encodes go to the shared embedding process instead of a model per worker
+        model = None
+        with startup.component("embedding_server"):
+            model = RemoteEncoder(EMBEDDING_SERVER_SOCKET).wait_ready()
+    else:
+        model = load_embedding_model(startup)
+    if model is not None:
+        with startup.component("warmup"):
+            warm_up(model)
+        embedding_service.model = model
+
+# Load the generation engine once so requests don't pay for model setup
+engine = None
+with startup.component("generation_engine"):
+    engine = create_engine()
+
+# Fair per-user queuing, concurrency cap and rate limits in front of every LLM call
+generation_scheduler = GenerationScheduler()
+
+# Optional retrieval stage (QUERY_ENHANCEMENT=1) that rewrites queries before the vector search
+query_enhancer = None
+if QUERY_ENHANCEMENT:
+    query_enhancer = QueryEnhancer(create_engine(system_instruction=QUERY_ENHANCEMENT_SYSTEM_INSTRUCTION),
+                                   generation_scheduler)
+
+# Opt-in (RESPONSE_CACHE=1): answer repeated questions from stored exchanges
+response_cache = ResponseCache()
+
+# Bound in-flight /ask-ai requests; excess load gets a 429/503 instead of piling up
+limiter = ConcurrencyLimiter()
 
-# Initialize Pinecone
-PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
-PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME", "conversation-history")
+# Identical /ask-ai requests in flight at the same time share one answer (COALESCE_REQUESTS=1)
+single_flight = SingleFlight()
 
-# Initialize Pinecone with new API
-pc = Pinecone(api_key=PINECONE_API_KEY)
+# Periodic per-user compaction and retention (COMPACTION=1); summaries are LLM-written with COMPACTION_SUMMARIZER=llm
+compactor = HistoryCompactor(
+    engine=create_engine(system_instruction=COMPACTION_SYSTEM_INSTRUCTION) if COMPACTION_SUMMARIZER == "llm" else None,
+    scheduler=generation_scheduler
+)
 
-# Get or create index
-try:
-    index = pc.Index(PINECONE_INDEX_NAME)
-    print(f"Connected to Pinecone index: {PINECONE_INDEX_NAME}")
-except Exception as e:
-    print(f"Error connecting to Pinecone: {e}")
-    print("Please check your Pinecone API key and run setup_pinecone.py first")
+# Stack sampling for slow requests, switched on at runtime through /debug/profiler
+profiler = SamplingProfiler()
 
-def store_conversation_vector(user_id, user_prompt, ai_response, conversation_id):
+@app.exception_handler(OverloadedError)
+async def overloaded_handler(request: Request, exc: OverloadedError):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"error": exc.message},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+def conversation_record(conversation_id, embedding, user_prompt, ai_response, request_context_hash=None):
+    """Vector record for one exchange"""
+    metadata = {
+        'user_prompt': user_prompt,
+        'ai_response': ai_response,
+        'content_hash': content_hash(user_prompt, ai_response),
+        'timestamp': datetime.now().isoformat()
+    }
+    if request_context_hash:
+        # Lets the response cache reuse this answer only for the same workspace context
+        metadata['context_hash'] = request_context_hash
+    return {
+        'id': conversation_id,  # No need for user_id prefix in namespace
+        'values': embedding,
+        'metadata': metadata
+    }
+
+async def store_conversation_vector(user_id, user_prompt, ai_response, conversation_id, embeddings=None, request_context_hash=None):
     """Store conversation in Pinecone vector database using user namespace"""
     try:
         text = f"{user_prompt} {ai_response}"
-        embedding = embedder.encode([text])[0].tolist()
+        with stage("embed"):
+            embedding = await embedding_service.encode(text, embeddings)
         
         # Store in user's namespace
-        index.upsert(
-            vectors=[{
-                'id': conversation_id,  # No need for user_id prefix in namespace
-                'values': embedding,
-                'metadata': {
-                    'user_prompt': user_prompt,
-                    'ai_response': ai_response,
-                    'timestamp': datetime.now().isoformat()
-                }
-            }],
-            namespace=user_id  # Each user gets their own namespace
-        )
+        with stage("store"):
+            await vector_store.upsert(
+                vectors=[conversation_record(conversation_id, embedding, user_prompt, ai_response, request_context_hash)],
+                namespace=user_id  # Each user gets their own namespace
+            )
         print(f"Stored conversation vector for user {user_id} in namespace {user_id}")
         return True
     except Exception as e:
         print(f"Error storing conversation vector: {e}")
         return False
 
-def search_user_conversations(user_id, query, top_k=10):
+async def search_user_conversations(user_id, query, top_k=HISTORY_TOP_K, embeddings=None):
     """Search for relevant conversations in user's namespace"""
     try:
-        query_embedding = embedder.encode([query])[0].tolist()
+        with stage("embed"):
+            query_embedding = await embedding_service.encode(query, embeddings)
         
         # Search in user's namespace
-        results = index.query(
-            vector=query_embedding,
-            namespace=user_id,  # Search only in user's namespace
-            top_k=top_k,
-            include_metadata=True
-        )
+        with stage("search"):
+            if HYBRID_SEARCH:
+                results = await vector_store.hybrid_query(query_embedding, query, user_id, top_k)
+            else:
+                results = await vector_store.query(
+                    vector=query_embedding,
+                    namespace=user_id,  # Search only in user's namespace
+                    top_k=top_k,
+                    include_metadata=True
+                )
         
         return results.matches
     except Exception as e:
         print(f"Error searching conversations for user {user_id}: {e}")
         return []
 
-def check_duplicate_conversation(user_id, user_prompt, ai_response):
-    """Check if exact conversation already exists in user's namespace"""
+async def check_duplicate_conversation(user_id, user_prompt, ai_response, embeddings=None):
+    """Check if conversation already exists in user's namespace"""
     try:
-        # Search for exact match in user's namespace
-        results = index.query(
-            vector=embedder.encode([f"{user_prompt} {ai_response}"])[0].tolist(),
+        # Exact duplicates come from the in-memory content-hash index once the user's hashes are loaded
+        if await vector_store.is_duplicate(user_id, user_prompt, ai_response,
+                                           lambda: embedding_service.encode(f"{user_prompt} {ai_response}", embeddings)):
+            return True
+        if DEDUP_MODE != "near":
+            return False
+
+        # Near-duplicate mode: treat a very similar stored exchange as a duplicate
+        results = await vector_store.query(
+            vector=await embedding_service.encode(f"{user_prompt} {ai_response}", embeddings),
             namespace=user_id,  # Search only in user's namespace
-            filter={
-                "user_prompt": user_prompt,
-                "ai_response": ai_response
-            },
             top_k=1,
-            include_metadata=True
+            include_metadata=False
         )
         
-        return len(results.matches) > 0
+        return len(results.matches) > 0 and results.matches[0].score >= DEDUP_SIMILARITY_THRESHOLD
     except Exception as e:
         print(f"Error checking duplicate for user {user_id}: {e}")
         return False
 
-def get_user_conversation_stats(user_id):
-    """Get statistics for a user's namespace"""
+async def get_user_conversation_stats(user_id):
+    """Get statistics for a user's namespace from the in-memory counters"""
     try:
-        stats = index.describe_index_stats(filter={"user_id": user_id})
-        return stats
+        return await vector_store.namespace_stats(user_id)
     except Exception as e:
         print(f"Error getting stats for user {user_id}: {e}")
         return None
@@ -114,6 +259,24 @@ def get_user_conversation_stats(user_id):
 def read_root():
     return {"message": "Hello, world!"}
 
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving, whether or not models have loaded"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: 200 once every component has loaded and the model is warm, 503 before or if any failed"""
+    report = startup.report()
+    return JSONResponse(status_code=200 if report["ready"] else 503, content=report)
+
+def require_started():
+    if not startup.finished:
+        raise OverloadedError(503, "Server is starting up, models are still loading", retry_after=5)
+    failed = startup.failed
+    if failed:
+        raise OverloadedError(503, f"Server failed to load {', '.join(failed)}", retry_after=30)
+
 @app.get("/run-script")
 def run_script():
     try:
@@ -130,90 +293,535 @@ def run_script():
         return {"error": str(e)}
 
 @app.get("/user-stats/{user_id}")
-def get_user_stats(user_id: str):
+async def get_user_stats(user_id: str):
     """Get conversation statistics for a specific user"""
     try:
-        stats = get_user_conversation_stats(user_id)
+        stats = await get_user_conversation_stats(user_id)
         if stats:
             return {
                 "user_id": user_id,
-                "total_conversations": stats.total_vector_count,
-                "namespace": user_id
+                "total_conversations": stats["count"],
+                "namespace": user_id,
+                "bytes_stored": stats["bytes"],
+                "last_write": stats["last_write"],
+                "reconciled_at": stats["reconciled_at"]
             }
         else:
             return {"user_id": user_id, "total_conversations": 0, "namespace": user_id}
     except Exception as e:
         return {"error": str(e)}
 
+async def retrieve_history(data: InputData, request_context_hash, embeddings=None, details=None):
+    """Search the user's history, answering from the response cache when a stored exchange matches
+
+    Per-stage details worth returning to the client are added to the details dict.
+    """
+    if RESPONSE_CACHE:
+        cached = response_cache.get(data.user_ID, data.query, request_context_hash)
+        if cached is not None:
+            return cached, []
+
+    # 1. Search Pinecone for relevant history in user's namespace
+    if QUERY_ENHANCEMENT:
+        # The raw-query search runs while the query is rewritten, so enhancement adds no serial latency
+        async def search(query):
+            return await search_user_conversations(data.user_ID, query, embeddings=embeddings)
+
+        vector_results, enhancement = await query_enhancer.search(data.query, data.context, search, data.user_ID)
+        if details is not None:
+            details["query_enhancement"] = enhancement
+    else:
+        vector_results = await search_user_conversations(data.user_ID, data.query, embeddings=embeddings)
+    if vector_results:
+        print(f"Found {len(vector_results)} relevant conversations from user {data.user_ID}'s namespace")
+    await load_history_bodies(data, request_context_hash, vector_results)
+
+    if RESPONSE_CACHE:
+        cached = await match_cached_response(data, request_context_hash, vector_results, embeddings)
+        if cached is not None:
+            return cached, vector_results
+    return None, vector_results
+
+async def load_history_bodies(data: InputData, request_context_hash, vector_results):
+    """Fetch conversation bodies for the matches that can reach the payload or the response cache"""
+    if not DOCUMENT_STORE or not vector_results:
+        return
+    wanted = history_candidates(data.query, data.context, vector_results)
+    if RESPONSE_CACHE:
+        wanted += [match for match in vector_results[:3]
+                   if (match.metadata or {}).get("context_hash") == request_context_hash]
+    with stage("documents"):
+        await vector_store.hydrate(list({id(match): match for match in wanted}.values()))
+
+async def match_cached_response(data: InputData, request_context_hash, vector_results, embeddings):
+    """Look for a stored exchange among the search results whose prompt matches the query"""
+    # Already encoded for the search, so this is a memo hit
+    query_embedding = await embedding_service.encode(data.query, embeddings)
+
+    async def prompt_similarity(user_prompt):
+        return cosine_similarity(query_embedding, await embedding_service.encode(user_prompt, embeddings))
+
+    return await response_cache.match(data.user_ID, data.query, request_context_hash,
+                                      vector_results, prompt_similarity)
+
+def record_generation_wait(seconds):
+    metrics.GENERATION_WAIT_SECONDS.observe(seconds)
+    record_stage("generation_queue", seconds)
+
+async def generate(user_id, payload):
+    """Call the LLM once the generation scheduler grants this user a slot"""
+    async with generation_scheduler.slot(user_id, estimate_tokens(payload)) as waited:
+        record_generation_wait(waited)
+        with stage("generate"):
+            return await engine.agenerate(payload)
+
+def build_payload(data: InputData, vector_results):
+    """Build the JSON payload for the LLM from the query, context and ranked history"""
+    # 2. Rank history and fit history and context into the token budget
+    payload, report = assemble_payload(data.query, data.context, vector_results)
+    print(f"Payload for user {data.user_ID}: {report.tokens_included} tokens included, "
+          f"{report.tokens_dropped} dropped, {report.history_included} history entries kept")
+
+    # 3. Prepare payload
+    return json.dumps(payload), report
+
+async def save_conversation(user_id, user_prompt, ai_response, embeddings=None, request_context_hash=None):
+    """Store a completed exchange unless the same one is already stored"""
+    # Check for duplicate before storing
+    with stage("dedup"):
+        is_duplicate = await check_duplicate_conversation(user_id, user_prompt, ai_response, embeddings)
+    
+    if not is_duplicate:
+        # Store new conversation in user's namespace
+        conversation_id = str(uuid.uuid4())
+        store_success = await store_conversation_vector(user_id, user_prompt, ai_response, conversation_id, embeddings, request_context_hash)
+        
+        if store_success:
+            print(f"New conversation stored for user {user_id} in namespace {user_id}")
+        else:
+            print(f"Failed to store conversation for user {user_id}")
+    else:
+        print(f"Duplicate conversation found for user {user_id}, skipping store")
+
+async def store_conversation_batch(user_id, items):
+    """Store queued exchanges for one user with a single upsert, skipping duplicates"""
+    clear_request_timings()
+    new_items = []
+    seen = set()
+    with stage("dedup"):
+        for item in items:
+            digest = content_hash(item.user_prompt, item.ai_response)
+            if digest in seen or await check_duplicate_conversation(user_id, item.user_prompt, item.ai_response, item.embeddings):
+                print(f"Duplicate conversation found for user {user_id}, skipping store")
+                continue
+            seen.add(digest)
+            new_items.append(item)
+    if not new_items:
+        return
+
+    # Concurrent encodes are merged into one batch by the embedding batcher
+    with stage("embed"):
+        vectors = await asyncio.gather(*(
+            embedding_service.encode(f"{item.user_prompt} {item.ai_response}", item.embeddings)
+            for item in new_items
+        ))
+    with stage("store"):
+        await vector_store.upsert(
+            vectors=[
+                conversation_record(str(uuid.uuid4()), vector, item.user_prompt, item.ai_response, item.context_hash)
+                for item, vector in zip(new_items, vectors)
+            ],
+            namespace=user_id
+        )
+    print(f"Stored {len(new_items)} conversations for user {user_id} in namespace {user_id}")
+
+# Storing happens off the response path; clients don't wait on dedup, encode and upsert
+write_queue = WriteBehindQueue(store_conversation_batch)
+
+# Component counters from /pipeline-stats, exported as gauges on /metrics
+metrics.register_stats("requests", limiter.stats)
+metrics.register_stats("embeddings", embedding_service.stats)
+metrics.register_stats("write_queue", write_queue.stats)
+metrics.register_stats("response_cache", response_cache.stats)
+metrics.register_stats("coalescing", single_flight.stats)
+metrics.register_stats("generation_scheduler", generation_scheduler.stats)
+metrics.register_stats("compaction", compactor.stats)
+if query_enhancer:
+    metrics.register_stats("query_enhancement", query_enhancer.stats)
+
+async def persist_conversation(user_id, user_prompt, ai_response, embeddings=None, request_context_hash=None):
+    """Queue an exchange for background storage, storing inline if write-behind is off or full"""
+    if RESPONSE_CACHE:
+        response_cache.put(user_id, user_prompt, request_context_hash, ai_response)
+    item = PendingWrite(user_id, user_prompt, ai_response, embeddings=embeddings, context_hash=request_context_hash)
+    if WRITE_BEHIND and write_queue.submit(item):
+        return
+    await save_conversation(user_id, user_prompt, ai_response, embeddings, request_context_hash)
+
+@app.get("/pipeline-stats")
+async def pipeline_stats():
+    """Queue depth, lag and cache counters for the request pipeline"""
+    return {
+        "startup": startup.report(),
+        "requests": limiter.stats(),
+        "embeddings": embedding_service.stats(),
+        "write_queue": write_queue.stats(),
+        "response_cache": response_cache.stats(),
+        "documents": vector_store.documents.stats() if DOCUMENT_STORE and vector_store else None,
+        "hybrid_search": vector_store.lexical_stats() if HYBRID_SEARCH and vector_store else None,
+        "coalescing": single_flight.stats(),
+        "generation_scheduler": generation_scheduler.stats(),
+        "compaction": compactor.stats(),
+        "query_enhancement": query_enhancer.stats() if query_enhancer else None
+    }
+
+@app.get("/scheduler-stats")
+async def scheduler_stats():
+    """Generation scheduler totals plus queue depth and wait times per recently active user"""
+    return {**generation_scheduler.stats(), "users": generation_scheduler.user_stats()}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Stage latency histograms, request counters and pipeline gauges in Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+if DEBUG_ENDPOINTS:
+    @app.get("/debug/profiler")
+    async def get_profiler():
+        """Profiler state and the aggregated stacks of recent slow requests"""
+        return {**profiler.stats(), "recent": profiler.profiles()}
+
+    @app.post("/debug/profiler")
+    async def set_profiler(enabled: bool, slow_ms: Optional[float] = None):
+        """Switch stack sampling on or off; requests slower than slow_ms keep a profile"""
+        if slow_ms is not None:
+            profiler.slow_ms = slow_ms
+        if enabled:
+            profiler.start()
+        else:
+            await asyncio.to_thread(profiler.stop)
+        return profiler.stats()
+
+    @app.post("/debug/compaction")
+    async def run_compaction(user_id: Optional[str] = None):
+        """Compact one user's namespace now, or every namespace when user_id is omitted"""
+        require_started()
+        if user_id is not None:
+            return await compactor.compact_namespace(user_id)
+        return {"namespaces": await compactor.compact_all()}
+
+def observe_request(endpoint, status, start_time):
+    """Record a finished request in the request metrics and hand it to the profiler"""
+    end_time = time.perf_counter()
+    metrics.REQUESTS_TOTAL.inc(endpoint=endpoint, status=status)
+    metrics.REQUEST_SECONDS.observe(end_time - start_time, endpoint=endpoint)
+    profiler.request_finished(endpoint, start_time, end_time)
+
 @app.post("/ask-ai")
-def ask_ai(data: InputData):
+async def ask_ai(data: InputData, timings: bool = False):
+    """Answer a query; ?timings=true adds the per-stage breakdown to the response"""
+    start_time = time.perf_counter()
+    status = "error"
+    try:
+        require_started()
+        include_timings = timings or TIMING_BREAKDOWN
+
+        async def limited_answer():
+            async with limiter.acquire():
+                return await answer_query(data, include_timings)
+
+        if COALESCE_REQUESTS:
+            # Duplicates wait on the request already in flight instead of taking a slot of their own
+            key = (data.user_ID, data.query, context_hash(data.context), include_timings)
+            response, coalesced = await single_flight.do(key, limited_answer)
+            if coalesced:
+                response = {**response, "coalesced": True}
+        else:
+            response = await limited_answer()
+        status = "error" if response.get("error") else "ok"
+        return response
+    except OverloadedError:
+        status = "rejected"
+        raise
+    finally:
+        observe_request("/ask-ai", status, start_time)
+
+async def answer_query(data: InputData, include_timings=TIMING_BREAKDOWN):
     try:
         # Time calculate
-        import time
         start_time = time.time()
+        timings = start_request_timings()
+        # Per-request embedding memo so each text is encoded at most once
+        embeddings = {}
+        request_context_hash = context_hash(data.context)
+        details = {}
 
-        # 1. Search Pinecone for relevant history in user's namespace
-        vector_results = search_user_conversations(data.user_ID, data.query, top_k=10)
-        
-        # 2. Extract history from vector results
-        history = []
-        if vector_results:
-            history = [
-                {
-                    "user_prompt": result.metadata['user_prompt'],
-                    "AI": result.metadata['ai_response']
-                }
-                for result in vector_results
-            ]
-            print(f"Found {len(history)} relevant conversations from user {data.user_ID}'s namespace")
-
-        # 3. Prepare payload
-        if data.context:
-            if isinstance(data.context, list):
-                joined_context = "\n\n".join(data.context)
-            else:
-                joined_context = str(data.context)
-            payload = json.dumps({"query": data.query, "context": joined_context, "history": history})
-        else:
-            payload = json.dumps({"query": data.query, "history": history})
+        cached, vector_results = await retrieve_history(data, request_context_hash, embeddings, details)
+        if cached is not None:
+            print(f"Answered from response cache for user {data.user_ID} (similarity {cached.similarity})")
+            return {
+                "response": cached.response,
+                "error": "",
+                "response_time_seconds": round(time.time() - start_time, 3),
+                "generation_time_seconds": 0.0,
+                "cached": True,
+                "cache_similarity": cached.similarity,
+                **details,
+                **({"timings": timings} if include_timings else {})
+            }
+
+        with stage("payload"):
+            payload, report = build_payload(data, vector_results)
         
         # 4. Generate AI response
-        result = subprocess.run(
-            ['python', 'chat.py', payload],
-            capture_output=True,
-            text=True
-        )
+        result = await generate(data.user_ID, payload)
         
-        ai_response = result.stdout.strip()
+        ai_response = result.text
         
         # 5. Store in Pinecone if response exists
         if ai_response:
-            # Check for duplicate before storing
-            is_duplicate = check_duplicate_conversation(data.user_ID, data.query, ai_response)
-            
-            if not is_duplicate:
-                # Store new conversation in user's namespace
-                conversation_id = str(uuid.uuid4())
-                store_success = store_conversation_vector(data.user_ID, data.query, ai_response, conversation_id)
-                
-                if store_success:
-                    print(f"New conversation stored for user {data.user_ID} in namespace {data.user_ID}")
-                else:
-                    print(f"Failed to store conversation for user {data.user_ID}")
-            else:
-                print(f"Duplicate conversation found for user {data.user_ID}, skipping store")
-        
+            await persist_conversation(data.user_ID, data.query, ai_response, embeddings, request_context_hash)
         
         end_time = time.time()
         response_time = end_time - start_time
+        if include_timings:
+            details["timings"] = timings
         
         return {
-            "response": result.stdout.strip(), 
-            "error": result.stderr.strip(),
-            "response_time_seconds": round(response_time, 3)
+            "response": ai_response, 
+            "error": result.error,
+            "response_time_seconds": round(response_time, 3),
+            "generation_time_seconds": result.generation_time_seconds,
+            "cached": False,
+            "payload_tokens": asdict(report),
+            **details
         }
+    except OverloadedError:
+        # Rejected by the generation scheduler; the handler turns it into a 429/503
+        raise
     except Exception as e:
         return {"error": str(e)}
 
+async def search_batch(items: List[InputData], embeddings):
+    """Embed every query in one encode call and run one grouped search per user namespace"""
+    with stage("embed"):
+        query_embeddings = await embedding_service.encode_many([data.query for data in items], embeddings)
+
+    by_namespace = {}
+    for position, data in enumerate(items):
+        queries = by_namespace.setdefault(data.user_ID, {})
+        # The same question twice from one user is searched once
+        queries.setdefault(data.query, (query_embeddings[position], []))[1].append(position)
+
+    vector_results = [[] for _ in items]
+
+    async def search_namespace(user_id, queries):
+        try:
+            if HYBRID_SEARCH:
+                results = await vector_store.hybrid_query_many(
+                    [vector for vector, _ in queries.values()], list(queries), user_id, HISTORY_TOP_K
+                )
+            else:
+                results = await vector_store.query_many(
+                    vectors=[vector for vector, _ in queries.values()],
+                    namespace=user_id,
+                    top_k=HISTORY_TOP_K,
+                    include_metadata=True
+                )
+        except Exception as e:
+            print(f"Error searching conversations for user {user_id}: {e}")
+            return
+        for (_, positions), result in zip(queries.values(), results):
+            for position in positions:
+                vector_results[position] = result.matches
+
+    with stage("search"):
+        await asyncio.gather(*(search_namespace(user_id, queries) for user_id, queries in by_namespace.items()))
+    return vector_results
+
+async def answer_batch_item(data: InputData, vector_results, embeddings, include_timings):
+    """Answer one batch item from its search results; returns the item's result and the exchange to store"""
+    start_time = time.time()
+    timings = start_request_timings()
+    request_context_hash = context_hash(data.context)
+    try:
+        cached = None
+        if RESPONSE_CACHE:
+            cached = response_cache.get(data.user_ID, data.query, request_context_hash)
+        if cached is None:
+            await load_history_bodies(data, request_context_hash, vector_results)
+            if RESPONSE_CACHE:
+                cached = await match_cached_response(data, request_context_hash, vector_results, embeddings)
+        if cached is not None:
+            result = {
+                "response": cached.response,
+                "error": "",
+                "generation_time_seconds": 0.0,
+                "cached": True,
+                "cache_similarity": cached.similarity,
+            }
+            exchange = None
+        else:
+            with stage("payload"):
+                payload, report = build_payload(data, vector_results)
+            generation = await generate(data.user_ID, payload)
+            result = {
+                "response": generation.text,
+                "error": generation.error,
+                "generation_time_seconds": generation.generation_time_seconds,
+                "cached": False,
+                "payload_tokens": asdict(report),
+            }
+            exchange = (data, generation.text, request_context_hash) if generation.text else None
+    except Exception as e:
+        result = {"response": "", "error": str(e)}
+        exchange = None
+
+    result["response_time_seconds"] = round(time.time() - start_time, 3)
+    if include_timings:
+        result["timings"] = timings
+    return result, exchange
+
+async def store_batch_exchanges(exchanges, embeddings):
+    """Store a batch's answered exchanges with one upsert per user"""
+    by_user = {}
+    for data, ai_response, request_context_hash in exchanges:
+        if RESPONSE_CACHE:
+            response_cache.put(data.user_ID, data.query, request_context_hash, ai_response)
+        item = PendingWrite(data.user_ID, data.query, ai_response, embeddings=embeddings, context_hash=request_context_hash)
+        # The write-behind queue already batches per user
+        if WRITE_BEHIND and write_queue.submit(item):
+            continue
+        by_user.setdefault(data.user_ID, []).append(item)
+
+    async def store_user(user_id, items):
+        try:
+            await store_conversation_batch(user_id, items)
+        except Exception as e:
+            print(f"Error storing conversations for user {user_id}: {e}")
+
+    await asyncio.gather(*(store_user(user_id, items) for user_id, items in by_user.items()))
+
+async def answer_batch(items: List[InputData], include_timings=TIMING_BREAKDOWN):
+    start_time = time.time()
+    timings = start_request_timings()
+    # Shared across items, so a text that appears in several items is encoded once
+    embeddings = {}
+
+    vector_results = await search_batch(items, embeddings)
+    answered = await gather_bounded(
+        (answer_batch_item(data, results, embeddings, include_timings) for data, results in zip(items, vector_results)),
+        BATCH_GENERATION_CONCURRENCY
+    )
+    await store_batch_exchanges([exchange for _, exchange in answered if exchange], embeddings)
+
+    response = {
+        "results": [result for result, _ in answered],
+        "response_time_seconds": round(time.time() - start_time, 3),
+    }
+    if include_timings:
+        response["timings"] = timings
+    return response
+
+@app.post("/ask-ai/batch")
+async def ask_ai_batch(items: List[InputData], timings: bool = False):
+    """Answer several queries in one call; results come back in request order with per-item errors"""
+    start_time = time.perf_counter()
+    status = "error"
+    try:
+        require_started()
+        if len(items) > BATCH_MAX_ITEMS:
+            status = "rejected"
+            return JSONResponse(status_code=413, content={"error": f"At most {BATCH_MAX_ITEMS} items per batch"})
+        async with limiter.acquire():
+            response = await answer_batch(items, timings or TIMING_BREAKDOWN)
+        status = "error" if any(result["error"] for result in response["results"]) else "ok"
+        return response
+    except OverloadedError:
+        status = "rejected"
+        raise
+    finally:
+        observe_request("/ask-ai/batch", status, start_time)
+
+def sse_event(data, event=None):
+    """Format one Server-Sent Event"""
+    message = f"data: {json.dumps(data)}\n\n"
+    if event:
+        message = f"event: {event}\n{message}"
+    return message
+
+@app.post("/ask-ai/stream")
+async def ask_ai_stream(data: InputData, timings: bool = False):
+    """Stream the AI response as Server-Sent Events while it is generated"""
+    request_start = time.perf_counter()
+    include_timings = timings or TIMING_BREAKDOWN
+    # Hold the request slot until the stream finishes, not just until headers go out
+    slot = AsyncExitStack()
+    try:
+        require_started()
+        await slot.enter_async_context(limiter.acquire())
+    except OverloadedError:
+        observe_request("/ask-ai/stream", "rejected", request_start)
+        raise
+
+    async def event_stream():
+        result = GenerationResult(text="", error="stream closed before completion")
+        try:
+            start_time = time.time()
+            timings = start_request_timings()
+            result.error = ""
+            embeddings = {}
+            request_context_hash = context_hash(data.context)
+            cached = None
+            report = None
+            details = {}
+            # From the start of the request, so search, payload building and the scheduler wait are included
+            time_to_first_token = None
+            try:
+                cached, vector_results = await retrieve_history(data, request_context_hash, embeddings, details)
+                if cached is not None:
+                    result.text = cached.response
+                    time_to_first_token = round(time.time() - start_time, 3)
+                    yield sse_event({"token": cached.response})
+                else:
+                    with stage("payload"):
+                        payload, report = build_payload(data, vector_results)
+                    async with generation_scheduler.slot(data.user_ID, estimate_tokens(payload)) as waited:
+                        record_generation_wait(waited)
+                        async for chunk in engine.astream(payload, result):
+                            if time_to_first_token is None:
+                                time_to_first_token = round(time.time() - start_time, 3)
+                            yield sse_event({"token": chunk})
+                    record_stage("generate", result.generation_time_seconds)
+
+                    # Store the assembled response just like /ask-ai; a stream that failed midway is partial
+                    if result.text and not result.error:
+                        await persist_conversation(data.user_ID, data.query, result.text, embeddings, request_context_hash)
+            except Exception as e:
+                result.error = str(e)
+
+            if include_timings:
+                details["timings"] = timings
+            yield sse_event({
+                "response": result.text,
+                "error": result.error,
+                "response_time_seconds": round(time.time() - start_time, 3),
+                "time_to_first_token_seconds": time_to_first_token,
+                "generation_time_seconds": result.generation_time_seconds,
+                "cached": cached is not None,
+                "payload_tokens": asdict(report) if report else None,
+                **details
+            }, event="done")
+        finally:
+            await slot.aclose()
+            observe_request("/ask-ai/stream", "error" if result.error else "ok", request_start)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(slot.aclose)
+    )
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
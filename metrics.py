@@ -0,0 +1,120 @@
+import threading
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+_stats_sources = []
+_lock = threading.Lock()
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(label_key, extra=None):
+    pairs = list(label_key) + (list(extra) if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonic counter with optional labels, rendered in Prometheus text format"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        with _lock:
+            _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels, rendered in Prometheus text format"""
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}  # label key -> [bucket counts..., sum, count]
+        with _lock:
+            _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        position = bisect_left(self.buckets, value)
+        with _lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if position < len(self.buckets):
+                series[position] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+def register_stats(prefix, stats_function):
+    """Export the numeric fields of a component's stats() dict as gauges named app_<prefix>_<field>"""
+    with _lock:
+        _stats_sources.append((prefix, stats_function))
+
+def render():
+    """All metrics in Prometheus text exposition format"""
+    with _lock:
+        metrics = list(_registry)
+        sources = list(_stats_sources)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+    for prefix, stats_function in sources:
+        try:
+            stats = stats_function()
+        except Exception as e:
+            print(f"Error collecting {prefix} stats for /metrics: {e}")
+            continue
+        for field, value in (stats or {}).items():
+            if isinstance(value, bool):
+                value = int(value)
+            if not isinstance(value, (int, float)):
+                continue
+            name = f"app_{prefix}_{field}"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+STAGE_SECONDS = Histogram("app_stage_duration_seconds", "Time spent in each request pipeline stage")
+REQUEST_SECONDS = Histogram("app_request_duration_seconds", "End-to-end request handling time")
+REQUESTS_TOTAL = Counter("app_requests_total", "Requests handled, by endpoint and outcome")
+EMBED_BATCH_SECONDS = Histogram("app_embed_batch_duration_seconds", "Time spent in SentenceTransformer.encode per batch")
+EMBED_BATCH_TEXTS = Histogram("app_embed_batch_texts", "Texts per SentenceTransformer.encode call",
+                              buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+LLM_CALLS = Counter("app_llm_calls_total", "LLM generation calls, by backend and outcome")
+GENERATION_WAIT_SECONDS = Histogram("app_generation_queue_wait_seconds", "Time requests waited in the generation scheduler")
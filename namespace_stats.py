@@ -0,0 +1,203 @@
+import os
+import json
+import asyncio
+import threading
+from datetime import datetime
+
+from vector_store import VectorStore, LocalVectorStore, base_store, normalize_vector_records, SHARED_WRITERS
+
+NAMESPACE_STATS_PATH = os.getenv("NAMESPACE_STATS_PATH", os.path.join("vector_data", "namespace_stats.json"))
+NAMESPACE_STATS_RECONCILE_SECONDS = float(os.getenv("NAMESPACE_STATS_RECONCILE_SECONDS", "300"))
+
+def record_bytes(values, metadata):
+    """Approximate stored size of one record: float32 vector plus JSON metadata"""
+    return len(values) * 4 + len(json.dumps(metadata or {}, separators=(",", ":")).encode("utf-8"))
+
+class NamespaceCounters:
+    """Conversation count, bytes stored and last write time per namespace, kept in memory
+
+    Sizes are tracked per conversation id so deletes subtract exactly what was added.
+    Only upserts move the last write time; deletes leave it alone.
+    """
+
+    def __init__(self, path=NAMESPACE_STATS_PATH):
+        self.path = path
+        self.reconciled_at = None
+        self._sizes = {}  # namespace -> {conversation_id: bytes}
+        self._bytes = {}
+        self._last_write = {}
+        # Backend count minus tracked ids at the last reconcile, e.g. writes from another worker
+        self._untracked = {}
+        self._lock = threading.Lock()
+
+    def add(self, namespace, conversation_id, size, written_at):
+        with self._lock:
+            sizes = self._sizes.setdefault(namespace, {})
+            self._bytes[namespace] = self._bytes.get(namespace, 0) + size - sizes.get(conversation_id, 0)
+            sizes[conversation_id] = size
+            if written_at and written_at > self._last_write.get(namespace, ""):
+                self._last_write[namespace] = written_at
+
+    def remove(self, namespace, conversation_ids):
+        with self._lock:
+            sizes = self._sizes.get(namespace, {})
+            for conversation_id in conversation_ids:
+                self._bytes[namespace] = self._bytes.get(namespace, 0) - sizes.pop(conversation_id, 0)
+
+    def get(self, namespace):
+        with self._lock:
+            tracked = len(self._sizes.get(namespace, {}))
+            untracked = self._untracked.get(namespace, 0)
+            count = max(0, tracked + untracked)
+            size = self._bytes.get(namespace, 0)
+            if untracked and tracked:
+                # Conversations written elsewhere are assumed to be of average size
+                size = max(0, round(size / tracked * count))
+            return {
+                "count": count,
+                "bytes": size,
+                "last_write": self._last_write.get(namespace),
+                "reconciled_at": self.reconciled_at,
+            }
+
+    def reconcile(self, backend_counts):
+        """Adopt the backend's per-namespace counts where they differ from the tracked ids"""
+        with self._lock:
+            namespaces = set(backend_counts) | {namespace for namespace, sizes in self._sizes.items() if sizes}
+            self._untracked = {}
+            for namespace in namespaces:
+                difference = backend_counts.get(namespace, 0) - len(self._sizes.get(namespace, {}))
+                if difference:
+                    self._untracked[namespace] = difference
+            self.reconciled_at = datetime.now().isoformat()
+            return len(self._untracked)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            saved = json.load(f)
+        for namespace, entry in saved.items():
+            for conversation_id, size in entry["sizes"].items():
+                self.add(namespace, conversation_id, size, None)
+            if entry.get("last_write"):
+                self._last_write[namespace] = entry["last_write"]
+        print(f"Loaded stats for {len(saved)} namespaces from {self.path}")
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock:
+            snapshot = {
+                namespace: {"sizes": dict(sizes), "last_write": self._last_write.get(namespace)}
+                for namespace, sizes in self._sizes.items() if sizes
+            }
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(snapshot, f)
+        os.replace(self.path + ".tmp", self.path)
+
+class StatsVectorStore(VectorStore):
+    """Wraps a vector store and keeps per-namespace counters in step with its upserts and deletes
+
+    A background task periodically reconciles the counts with describe_index_stats(),
+    one unfiltered call covering every namespace. With shared writers (several workers)
+    nothing is saved or loaded, since each worker's snapshot would overwrite the others';
+    counts then come from reconciling.
+    """
+
+    def __init__(self, store, counters=None, reconcile_seconds=NAMESPACE_STATS_RECONCILE_SECONDS,
+                 shared=SHARED_WRITERS):
+        self.store = store
+        self.counters = counters if counters is not None else NamespaceCounters()
+        self._persist = not shared
+        self.reconcile_seconds = reconcile_seconds
+        self.reconciliations = 0
+        self._reconciler = None
+        self._first_reconcile = None  # set once the reconciler's first pass has finished
+        self._local = isinstance(base_store(store), LocalVectorStore)
+        if self._local:
+            # Every record is in memory, so rebuild rather than trust a saved file
+            for name, namespace in base_store(store).namespaces.items():
+                for row, (conversation_id, metadata) in enumerate(zip(namespace.ids, namespace.metadata)):
+                    self.counters.add(name, conversation_id, record_bytes(namespace.matrix[row], metadata),
+                                      metadata.get("timestamp"))
+        elif self._persist:
+            self.counters.load()
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def _start_reconciler(self):
+        if self._reconciler is None and self.reconcile_seconds > 0:
+            self._first_reconcile = asyncio.Event()
+            self._reconciler = asyncio.create_task(self._reconcile_periodically())
+
+    async def _reconcile_periodically(self):
+        # Reconcile right away, so writes made before this process started show up without waiting an interval
+        while True:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                print(f"Error reconciling namespace stats: {e}")
+            self._first_reconcile.set()
+            await asyncio.sleep(self.reconcile_seconds)
+
+    async def reconcile(self):
+        stats = await self.store.describe_index_stats()
+        backend_counts = {name: namespace.vector_count for name, namespace in (stats.namespaces or {}).items()}
+        corrected = self.counters.reconcile(backend_counts)
+        self.reconciliations += 1
+        if corrected:
+            print(f"Namespace stats reconciled, {corrected} namespaces differed from the backend")
+
+    async def namespace_stats(self, namespace):
+        """Counters for one namespace, served from memory"""
+        self._start_reconciler()
+        if not self._local and self._first_reconcile is not None:
+            # Without a snapshot the counters only know this process's writes until the first reconcile
+            await self._first_reconcile.wait()
+        return self.counters.get(namespace)
+
+    async def upsert(self, vectors, namespace):
+        self._start_reconciler()
+        result = await self.store.upsert(vectors, namespace)
+        written_at = datetime.now().isoformat()
+        # Size what reaches the base store, e.g. without the bodies the document store keeps
+        stored_metadata = getattr(self.store, "stored_metadata", None)
+        for conversation_id, values, metadata in normalize_vector_records(vectors):
+            size = record_bytes(values, stored_metadata(metadata) if stored_metadata else metadata)
+            self.counters.add(namespace, conversation_id, size, (metadata or {}).get("timestamp", written_at))
+        return result
+
+    async def query(self, vector, namespace, top_k=10, filter=None, include_metadata=True):
+        return await self.store.query(vector, namespace, top_k, filter, include_metadata)
+
+    async def query_many(self, vectors, namespace, top_k=10, filter=None, include_metadata=True):
+        return await self.store.query_many(vectors, namespace, top_k, filter, include_metadata)
+
+    async def delete(self, ids, namespace):
+        result = await self.store.delete(ids, namespace)
+        self.counters.remove(namespace, ids)
+        return result
+
+    async def fetch(self, ids, namespace):
+        return await self.store.fetch(ids, namespace)
+
+    async def describe_index_stats(self, filter=None):
+        return await self.store.describe_index_stats(filter)
+
+    def records(self, namespace):
+        return self.store.records(namespace)
+
+    async def close(self):
+        if self._reconciler is not None:
+            self._reconciler.cancel()
+            try:
+                await self._reconciler
+            except asyncio.CancelledError:
+                pass
+            self._reconciler = None
+        if not self._local and self._persist:
+            self.counters.save()
+        await self.store.close()
@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+import threading
+from collections import Counter, deque
+from datetime import datetime
+
+DEBUG_ENDPOINTS = os.getenv("DEBUG_ENDPOINTS", "0") == "1"
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "5"))
+PROFILER_SLOW_MS = float(os.getenv("PROFILER_SLOW_MS", "1000"))
+PROFILER_MAX_PROFILES = int(os.getenv("PROFILER_MAX_PROFILES", "20"))
+
+MAX_STACK_DEPTH = 40
+MAX_SAMPLES = 100000
+TOP_STACKS = 15
+
+def collapse_stack(frame):
+    """Stack as "file:function:line" entries joined outermost first, the collapsed-stack flame graph format"""
+    entries = []
+    while frame is not None and len(entries) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        entries.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(entries))
+
+class SamplingProfiler:
+    """Samples every thread's stack on a timer and keeps aggregated stacks for slow requests
+
+    Off until start() is called. Samples cover the whole process, so on the shared event
+    loop a slow request's profile also includes whatever else ran during its window.
+    """
+
+    def __init__(self, interval_ms=PROFILER_INTERVAL_MS, slow_ms=PROFILER_SLOW_MS,
+                 max_profiles=PROFILER_MAX_PROFILES):
+        self.interval_seconds = interval_ms / 1000.0
+        self.slow_ms = slow_ms
+        self.samples_taken = 0
+        self._samples = deque(maxlen=MAX_SAMPLES)  # (perf_counter, thread name, collapsed stack)
+        self._profiles = deque(maxlen=max_profiles)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        with self._lock:
+            self._samples.clear()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval_seconds):
+            now = time.perf_counter()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, frame in frames.items():
+                    if thread_id != own_id:
+                        self._samples.append((now, names.get(thread_id, str(thread_id)), collapse_stack(frame)))
+                self.samples_taken += 1
+
+    def request_finished(self, name, start_time, end_time):
+        """Keep a profile of the request if it was slower than slow_ms; times are time.perf_counter()"""
+        duration_ms = (end_time - start_time) * 1000
+        if not self.enabled or duration_ms < self.slow_ms:
+            return
+        with self._lock:
+            window = [(thread, stack) for at, thread, stack in self._samples if start_time <= at <= end_time]
+        stacks = Counter(f"{thread};{stack}" for thread, stack in window)
+        self._profiles.append({
+            "request": name,
+            "finished_at": datetime.now().isoformat(),
+            "duration_ms": round(duration_ms, 1),
+            "samples": len(window),
+            "top_stacks": [{"stack": stack, "samples": count} for stack, count in stacks.most_common(TOP_STACKS)],
+        })
+
+    def profiles(self):
+        return list(self._profiles)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "interval_ms": self.interval_seconds * 1000,
+            "slow_ms": self.slow_ms,
+            "samples_taken": self.samples_taken,
+            "profiles": len(self._profiles),
+        }
@@ -0,0 +1,160 @@
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+from concurrency import OverloadedError
+
+QUERY_ENHANCEMENT = os.getenv("QUERY_ENHANCEMENT", "0") == "1"
+QUERY_ENHANCEMENT_TIMEOUT_SECONDS = float(os.getenv("QUERY_ENHANCEMENT_TIMEOUT_SECONDS", "1.5"))
+QUERY_ENHANCEMENT_CACHE_SIZE = int(os.getenv("QUERY_ENHANCEMENT_CACHE_SIZE", "2048"))
+
+JSON_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+def enhancement_key(question, context):
+    joined = "\n\n".join(context) if isinstance(context, list) else (context or "")
+    return hashlib.sha256(f"{question}\0{joined}".encode("utf-8")).hexdigest()
+
+def parse_enhanced_query(text):
+    """Pull enhancedQuery out of the model's JSON reply; None if it is missing or reports an error"""
+    try:
+        reply = json.loads(JSON_FENCE.sub("", text.strip()))
+    except ValueError:
+        return None
+    if not isinstance(reply, dict) or reply.get("error"):
+        return None
+    enhanced_query = reply.get("enhancedQuery")
+    return enhanced_query.strip() if isinstance(enhanced_query, str) and enhanced_query.strip() else None
+
+def mean_top_score(matches, n=3):
+    scores = [match.score for match in matches[:n]]
+    return sum(scores) / len(scores) if scores else float("-inf")
+
+class QueryEnhancer:
+    """Rewrites queries for retrieval with QUERY_ENHANCEMENT_SYSTEM_INSTRUCTION, cached and time-bounded
+
+    With a scheduler, each rewrite takes one of the asking user's generation slots, and the
+    time spent waiting for it counts against the timeout.
+    """
+
+    def __init__(self, engine, scheduler=None, timeout_seconds=QUERY_ENHANCEMENT_TIMEOUT_SECONDS,
+                 cache_size=QUERY_ENHANCEMENT_CACHE_SIZE):
+        self.engine = engine
+        self.scheduler = scheduler
+        self.timeout_seconds = timeout_seconds
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.rejected = 0
+        self.enhanced_chosen = 0
+        self.raw_chosen = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, key):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return True, self._cache[key]
+            self.cache_misses += 1
+            return False, None
+
+    def _remember(self, key, enhanced_query):
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = enhanced_query
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    async def enhance(self, question, context, user_id=None):
+        """Return the rewritten query, or None to fall back to the raw query"""
+        key = enhancement_key(question, context)
+        found, enhanced_query = self._cached(key)
+        if found:
+            return enhanced_query
+
+        joined = "\n\n".join(context) if isinstance(context, list) else context
+        payload = json.dumps({"question": question, "context": joined or {}})
+        if self.scheduler is not None:
+            generation = self.scheduler.generate(self.engine, user_id, payload)
+        else:
+            generation = self.engine.agenerate(payload)
+        try:
+            result = await asyncio.wait_for(generation, self.timeout_seconds)
+        except asyncio.TimeoutError:
+            # Not cached: a slow call says nothing about the next one
+            self.timeouts += 1
+            return None
+        except OverloadedError:
+            # No slot for the rewrite (queue full or the user's rate used up); search with the raw query
+            self.rejected += 1
+            return None
+
+        enhanced_query = parse_enhanced_query(result.text) if not result.error else None
+        if enhanced_query is None:
+            self.failures += 1
+        self._remember(key, enhanced_query)
+        return enhanced_query
+
+    async def search(self, question, context, search, user_id=None):
+        """Run the raw-query search alongside enhancement and keep the stronger result set
+
+        search(query) is the coroutine that embeds a query and searches the vector store.
+        """
+        timings = {}
+        start_time = time.perf_counter()
+
+        async def timed_search(query, stage):
+            stage_start = time.perf_counter()
+            results = await search(query)
+            timings[stage] = round(time.perf_counter() - stage_start, 3)
+            return results
+
+        raw_task = asyncio.create_task(timed_search(question, "raw_search_seconds"))
+        try:
+            enhanced_query = await self.enhance(question, context, user_id)
+            timings["enhancement_seconds"] = round(time.perf_counter() - start_time, 3)
+
+            enhanced_results = None
+            if enhanced_query and enhanced_query != question:
+                enhanced_results = await timed_search(enhanced_query, "enhanced_search_seconds")
+            raw_results = await raw_task
+        finally:
+            if not raw_task.done():
+                raw_task.cancel()
+
+        use_enhanced = enhanced_results is not None and mean_top_score(enhanced_results) > mean_top_score(raw_results)
+        if use_enhanced:
+            self.enhanced_chosen += 1
+        else:
+            self.raw_chosen += 1
+        timings["total_seconds"] = round(time.perf_counter() - start_time, 3)
+        return (enhanced_results if use_enhanced else raw_results), {
+            "enhanced_query": enhanced_query,
+            "used_enhanced_results": use_enhanced,
+            "timings": timings,
+        }
+
+    def stats(self):
+        with self._lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                "cache_size": len(self._cache),
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+                "cache_hit_rate": round(self.cache_hits / lookups, 4) if lookups else 0.0,
+                "timeouts": self.timeouts,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "enhanced_chosen": self.enhanced_chosen,
+                "raw_chosen": self.raw_chosen,
+            }
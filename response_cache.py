@@ -0,0 +1,133 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+
+from dedup import normalize_text
+
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+
+def context_hash(context):
+    """Hash of the request's workspace context; cached answers only apply to the same context"""
+    if not context:
+        joined = ""
+    elif isinstance(context, list):
+        joined = "\n\n".join(context)
+    else:
+        joined = str(context)
+    return hashlib.sha256(joined.encode("utf-8")).hexdigest()
+
+@dataclass
+class CachedResponse:
+    response: str
+    similarity: float
+    stored_at: float
+
+class ResponseCache:
+    """Answers repeated questions from stored exchanges instead of calling the LLM
+
+    Exact repeats are served from an in-memory LRU before any search. Near repeats
+    are matched against the top search results that share the request's
+    context_hash and are younger than the TTL.
+    """
+
+    def __init__(self, threshold=RESPONSE_CACHE_THRESHOLD, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+                 max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, user_id, query, request_context_hash):
+        return (user_id, normalize_text(query), request_context_hash)
+
+    def put(self, user_id, query, request_context_hash, response):
+        if self.max_entries <= 0:
+            return
+        key = self._key(user_id, query, request_context_hash)
+        with self._lock:
+            self._entries[key] = CachedResponse(response, 1.0, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def get(self, user_id, query, request_context_hash):
+        """Exact-repeat lookup; a miss here is not counted until match() also misses"""
+        key = self._key(user_id, query, request_context_hash)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry.stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self.expired += 1
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return entry
+
+    async def match(self, user_id, query, request_context_hash, matches, prompt_similarity):
+        """Semantic lookup against the top vector search results
+
+        Stored vectors embed prompt and response together, so the search score only
+        shortlists candidates; prompt_similarity(user_prompt) scores the stored
+        question itself against the incoming one.
+        """
+        entry = None
+        for candidate in self._candidates(matches, request_context_hash):
+            similarity = await prompt_similarity(candidate.metadata["user_prompt"])
+            if similarity >= self.threshold and (entry is None or similarity > entry.similarity):
+                entry = CachedResponse(candidate.metadata["ai_response"], round(float(similarity), 4),
+                                       time.time())
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.semantic_hits += 1
+        self.put(user_id, query, request_context_hash, entry.response)
+        return entry
+
+    def _candidates(self, matches, request_context_hash, limit=3):
+        candidates = []
+        for match in matches[:limit]:
+            metadata = match.metadata or {}
+            if metadata.get("context_hash") != request_context_hash or "user_prompt" not in metadata:
+                continue
+            try:
+                stored_at = datetime.fromisoformat(metadata["timestamp"]).timestamp()
+            except (KeyError, ValueError):
+                continue
+            if time.time() - stored_at > self.ttl_seconds:
+                with self._lock:
+                    self.expired += 1
+                continue
+            candidates.append(match)
+        return candidates
+
+    def stats(self):
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            lookups = hits + self.misses
+            return {
+                "size": len(self._entries),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
@@ -0,0 +1,280 @@
+import os
+import math
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+
+from concurrency import OverloadedError
+from context_assembly import estimate_tokens
+
+GENERATION_MAX_CONCURRENT = int(os.getenv("GENERATION_MAX_CONCURRENT", "32"))
+GENERATION_RPM = float(os.getenv("GENERATION_RPM", "0"))
+GENERATION_TPM = float(os.getenv("GENERATION_TPM", "0"))
+USER_GENERATION_RPM = float(os.getenv("USER_GENERATION_RPM", "0"))
+GENERATION_QUEUE_DEADLINE_SECONDS = float(os.getenv("GENERATION_QUEUE_DEADLINE_SECONDS", "10"))
+SCHEDULER_QUANTUM_TOKENS = int(os.getenv("SCHEDULER_QUANTUM_TOKENS", "2000"))
+
+# Per-user stats are kept for the most recently seen users only
+TRACKED_USERS = 1000
+# Generation time assumed until the first generation finishes
+INITIAL_SERVICE_SECONDS = 2.0
+
+class TokenBucket:
+    """Refills at rate_per_minute, holds up to a minute's worth; a rate of 0 means unlimited"""
+
+    def __init__(self, rate_per_minute):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate_per_second)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount can be taken (a request larger than the bucket waits for a full one)"""
+        if self.rate_per_second <= 0:
+            return 0.0
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate_per_second)
+
+    def take(self, amount):
+        if self.rate_per_second <= 0:
+            return
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+@dataclass
+class Ticket:
+    user_id: str
+    cost: int
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+@dataclass
+class UserStats:
+    queued: int = 0
+    running: int = 0
+    granted: int = 0
+    rejected: int = 0
+    total_wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+
+class GenerationScheduler:
+    """Admission control and per-user fair queuing in front of the LLM call
+
+    Waiting requests sit in one queue per user and are granted in deficit round-robin
+    order weighted by estimated prompt tokens, so a user sending long contexts gets
+    the same token share as everyone else rather than more. Grants are limited by a
+    global concurrency cap and by global requests/tokens-per-minute and per-user
+    requests-per-minute buckets. A request whose estimated wait exceeds the deadline
+    is rejected up front with a Retry-After.
+    """
+
+    def __init__(self, max_concurrent=GENERATION_MAX_CONCURRENT, rpm=GENERATION_RPM, tpm=GENERATION_TPM,
+                 user_rpm=USER_GENERATION_RPM, deadline_seconds=GENERATION_QUEUE_DEADLINE_SECONDS,
+                 quantum_tokens=SCHEDULER_QUANTUM_TOKENS):
+        self.max_concurrent = max_concurrent
+        self.user_rpm = user_rpm
+        self.deadline_seconds = deadline_seconds
+        self.quantum_tokens = quantum_tokens
+        self.requests_bucket = TokenBucket(rpm)
+        self.tokens_bucket = TokenBucket(tpm)
+        self.running = 0
+        self.queued = 0
+        self.rejected = 0
+        self.service_seconds = INITIAL_SERVICE_SECONDS  # moving average of generation time
+        self._queues = OrderedDict()  # user -> deque of waiting tickets, in round-robin order
+        self._deficits = {}
+        self._user_buckets = OrderedDict()
+        self._users = OrderedDict()
+        self._retry_handle = None
+
+    def _user(self, user_id):
+        stats = self._users.get(user_id)
+        if stats is None:
+            stats = self._users[user_id] = UserStats()
+        self._users.move_to_end(user_id)
+        while len(self._users) > TRACKED_USERS:
+            oldest, oldest_stats = next(iter(self._users.items()))
+            if oldest_stats.queued or oldest_stats.running:
+                break
+            del self._users[oldest]
+        return stats
+
+    def _user_bucket(self, user_id):
+        bucket = self._user_buckets.get(user_id)
+        if bucket is None:
+            bucket = self._user_buckets[user_id] = TokenBucket(self.user_rpm)
+        self._user_buckets.move_to_end(user_id)
+        while len(self._user_buckets) > TRACKED_USERS:
+            self._user_buckets.popitem(last=False)
+        return bucket
+
+    def estimated_wait(self, user_id, cost):
+        """Rough seconds until a new request from user_id would start generating"""
+        user_queued = len(self._queues.get(user_id, ()))
+        # Round-robin: the new request waits for about one request per active user per turn
+        ahead = min(self.queued, (user_queued + 1) * max(1, len(self._queues)))
+        if self.running + ahead < self.max_concurrent:
+            slot_wait = 0.0
+        else:
+            slot_wait = (self.running + ahead - self.max_concurrent + 1) / self.max_concurrent * self.service_seconds
+        rate_wait = max(
+            self._user_bucket(user_id).wait_time(user_queued + 1),
+            self.requests_bucket.wait_time(self.queued + 1),
+            self.tokens_bucket.wait_time(cost),
+        )
+        return max(slot_wait, rate_wait)
+
+    @asynccontextmanager
+    async def slot(self, user_id, cost):
+        """Wait for this user's turn to generate; cost is the estimated prompt tokens"""
+        stats = self._user(user_id)
+        estimate = self.estimated_wait(user_id, cost)
+        if estimate > self.deadline_seconds:
+            self.rejected += 1
+            stats.rejected += 1
+            raise OverloadedError(429, f"Generation queue is full, estimated wait {estimate:.1f}s",
+                                  retry_after=math.ceil(estimate))
+
+        ticket = Ticket(user_id, cost, asyncio.get_running_loop().create_future())
+        self._queues.setdefault(user_id, deque()).append(ticket)
+        self._deficits.setdefault(user_id, 0)
+        self.queued += 1
+        stats.queued += 1
+        self._dispatch()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), self.deadline_seconds)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # Granted just as we gave up: hand the slot back
+                self._finish(ticket, None)
+            else:
+                ticket.future.cancel()
+                self._remove(ticket)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                stats.rejected += 1
+                raise OverloadedError(503, "Timed out waiting for a generation slot",
+                                      retry_after=math.ceil(self.service_seconds))
+            raise
+
+        waited = time.monotonic() - ticket.enqueued_at
+        stats.total_wait_seconds += waited
+        stats.max_wait_seconds = max(stats.max_wait_seconds, waited)
+        start_time = time.monotonic()
+        try:
+            yield waited
+        finally:
+            self._finish(ticket, time.monotonic() - start_time)
+
+    async def generate(self, engine, user_id, payload):
+        """engine.agenerate(payload) in one of user_id's slots, for LLM calls outside the answer path"""
+        async with self.slot(user_id, estimate_tokens(payload)):
+            return await engine.agenerate(payload)
+
+    def _remove(self, ticket):
+        queue = self._queues.get(ticket.user_id)
+        if queue is None or ticket not in queue:
+            return
+        queue.remove(ticket)
+        self.queued -= 1
+        self._user(ticket.user_id).queued -= 1
+        if not queue:
+            del self._queues[ticket.user_id]
+            self._deficits.pop(ticket.user_id, None)
+
+    def _finish(self, ticket, seconds):
+        self.running -= 1
+        self._user(ticket.user_id).running -= 1
+        if seconds is not None:
+            self.service_seconds = 0.8 * self.service_seconds + 0.2 * seconds
+        self._dispatch()
+
+    def _grant(self, ticket):
+        queue = self._queues[ticket.user_id]
+        queue.popleft()
+        if not queue:
+            del self._queues[ticket.user_id]
+            self._deficits.pop(ticket.user_id, None)
+        self.queued -= 1
+        self.running += 1
+        stats = self._user(ticket.user_id)
+        stats.queued -= 1
+        stats.running += 1
+        stats.granted += 1
+        self._user_bucket(ticket.user_id).take(1)
+        self.requests_bucket.take(1)
+        self.tokens_bucket.take(ticket.cost)
+        ticket.future.set_result(None)
+
+    def _dispatch(self):
+        """Grant slots in deficit round-robin order until the cap, the buckets or the queues run out"""
+        retry_after = None
+        blocked = 0
+        while self._queues and self.running < self.max_concurrent and blocked < len(self._queues):
+            user_id, queue = next(iter(self._queues.items()))
+            ticket = queue[0]
+            if ticket.future.done():
+                # Cancelled while queued
+                self._remove(ticket)
+                continue
+
+            global_wait = max(self.requests_bucket.wait_time(1), self.tokens_bucket.wait_time(ticket.cost))
+            if global_wait > 0:
+                retry_after = global_wait
+                break
+            user_wait = self._user_bucket(user_id).wait_time(1)
+            if user_wait > 0:
+                retry_after = user_wait if retry_after is None else min(retry_after, user_wait)
+                blocked += 1
+                self._queues.move_to_end(user_id)
+                continue
+
+            blocked = 0
+            if self._deficits[user_id] < ticket.cost:
+                self._deficits[user_id] += self.quantum_tokens
+                self._queues.move_to_end(user_id)
+                continue
+            self._deficits[user_id] -= ticket.cost
+            self._grant(ticket)
+            if user_id in self._queues:
+                self._queues.move_to_end(user_id)
+
+        if retry_after is not None and self._queues and self._retry_handle is None:
+            loop = asyncio.get_running_loop()
+            self._retry_handle = loop.call_later(retry_after, self._retry)
+
+    def _retry(self):
+        self._retry_handle = None
+        self._dispatch()
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "active_users": len(self._queues),
+            "max_concurrent": self.max_concurrent,
+            "avg_generation_seconds": round(self.service_seconds, 3),
+        }
+
+    def user_stats(self):
+        return {
+            user_id: {
+                "queued": stats.queued,
+                "running": stats.running,
+                "granted": stats.granted,
+                "rejected": stats.rejected,
+                "avg_wait_seconds": round(stats.total_wait_seconds / stats.granted, 4) if stats.granted else 0.0,
+                "max_wait_seconds": round(stats.max_wait_seconds, 4),
+            }
+            for user_id, stats in self._users.items()
+        }
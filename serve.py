@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Run the API, with WORKERS uvicorn workers sharing one embedding process when WORKERS > 1
+
+    python serve.py
+    WORKERS=4 EMBEDDING_PRECISION=int8 python serve.py
+
+With a single worker this is plain `uvicorn main:app`. With several, embedding_server.py
+loads the model once and the workers send it their encodes over EMBEDDING_SERVER_SOCKET
+instead of each holding a copy. EMBEDDING_SERVER=1 or 0 forces the shared process on or off.
+"""
+
+import os
+import sys
+import signal
+import subprocess
+
+WORKERS = int(os.getenv("WORKERS", "1"))
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+EMBEDDING_SERVER = os.getenv("EMBEDDING_SERVER", "auto")
+DEFAULT_EMBEDDING_SOCKET = "/tmp/embedding.sock"
+
+def main():
+    if WORKERS > 1 and os.getenv("VECTOR_STORE") == "local":
+        sys.exit("The local vector store lives in one process; use Pinecone with WORKERS > 1")
+    # Workers read WORKERS too: with several, no per-process snapshots and single-process compaction
+    env = dict(os.environ, WORKERS=str(WORKERS))
+    shared = WORKERS > 1 if EMBEDDING_SERVER == "auto" else EMBEDDING_SERVER == "1"
+    children = []
+    if shared:
+        env.setdefault("EMBEDDING_SERVER_SOCKET", DEFAULT_EMBEDDING_SOCKET)
+        children.append(subprocess.Popen([sys.executable, "embedding_server.py",
+                                          "--socket", env["EMBEDDING_SERVER_SOCKET"]], env=env))
+    else:
+        env.pop("EMBEDDING_SERVER_SOCKET", None)
+    api = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--host", HOST, "--port", str(PORT),
+                            "--workers", str(WORKERS)], env=env)
+    children.append(api)
+
+    def stop(signum, frame):
+        # Workers drain first; the embedding server goes last since they may still be encoding
+        api.send_signal(signal.SIGTERM)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    code = api.wait()
+    for child in children[:-1]:
+        child.terminate()
+        child.wait(timeout=30)
+    sys.exit(code)
+
+if __name__ == "__main__":
+    main()
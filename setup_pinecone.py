@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 from pinecone import Pinecone, ServerlessSpec
 from dotenv import load_dotenv
 
@@ -184,6 +185,12 @@ def test_pinecone_connection():
         return False
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "import":
+        # Bulk import / re-embed: python setup_pinecone.py import --help
+        import bulk_import
+        bulk_import.main(sys.argv[2:])
+        sys.exit(0)
+
     print("🚀 Pinecone Setup Script")
     print("=" * 40)
     
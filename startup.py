@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Component loading for server startup, with per-component timing and readiness
+
+Run directly to bake the embedding model into EMBEDDING_MODEL_PATH (done in the Docker build):
+
+    python startup.py
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+STARTUP_MODE = os.getenv("STARTUP_MODE", "background")
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_MODEL_PATH = os.getenv("EMBEDDING_MODEL_PATH", "models/all-MiniLM-L6-v2")
+WARMUP_ENCODES = int(os.getenv("WARMUP_ENCODES", "3"))
+
+# transformers imports TensorFlow whenever it is installed; the server only uses PyTorch
+os.environ.setdefault("USE_TF", "0")
+os.environ.setdefault("TRANSFORMERS_NO_TF", "1")
+
+WARMUP_TEXTS = [
+    "How do I reverse a list in Python?",
+    "Explain the difference between a process and a thread, and when to use asyncio instead of threads.",
+    "def merge_sort(items):\n    if len(items) <= 1:\n        return items\n    middle = len(items) // 2\n"
+    "    return merge(merge_sort(items[:middle]), merge_sort(items[middle:]))",
+]
+
+class StartupTracker:
+    """Records how long each component took to import or load and whether it succeeded"""
+
+    def __init__(self):
+        self.components = {}
+        self.started_at = time.perf_counter()
+        self.finished = False
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def component(self, name):
+        """Time loading one component; a failure is recorded and printed instead of raised"""
+        with self._lock:
+            self.components[name] = {"status": "loading", "seconds": None}
+        start_time = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            seconds = round(time.perf_counter() - start_time, 3)
+            with self._lock:
+                self.components[name] = {"status": "failed", "seconds": seconds, "error": str(e)}
+            print(f"Failed to load {name} after {seconds}s: {e}")
+        else:
+            seconds = round(time.perf_counter() - start_time, 3)
+            with self._lock:
+                self.components[name] = {"status": "ready", "seconds": seconds}
+            print(f"Loaded {name} in {seconds}s")
+
+    def run(self, load):
+        """Run load() and mark startup finished, even if a component failed"""
+        try:
+            load()
+        finally:
+            self.finished = True
+            print(f"Startup finished in {round(time.perf_counter() - self.started_at, 3)}s")
+
+    def start_background(self, load):
+        thread = threading.Thread(target=self.run, args=(load,), name="startup", daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def ready(self):
+        with self._lock:
+            return self.finished and all(c["status"] == "ready" for c in self.components.values())
+
+    @property
+    def failed(self):
+        """Names of the components that failed to load"""
+        with self._lock:
+            return [name for name, c in self.components.items() if c["status"] == "failed"]
+
+    def report(self):
+        with self._lock:
+            return {
+                "ready": self.finished and all(c["status"] == "ready" for c in self.components.values()),
+                "finished": self.finished,
+                "failed": [name for name, c in self.components.items() if c["status"] == "failed"],
+                "components": {name: dict(component) for name, component in self.components.items()},
+            }
+
+def load_embedding_model(tracker, name=EMBEDDING_MODEL_NAME, path=EMBEDDING_MODEL_PATH):
+    """Load the SentenceTransformer, from the baked local copy when there is one"""
+    with tracker.component("import:sentence_transformers"):
+        from sentence_transformers import SentenceTransformer
+
+    model = None
+    with tracker.component("embedding_model"):
+        if path and os.path.isdir(path):
+            # Loading from a saved directory never touches the Hugging Face Hub
+            model = SentenceTransformer(path, local_files_only=True)
+        else:
+            print(f"No baked model at {path}, loading {name} from the Hugging Face cache or Hub")
+            model = SentenceTransformer(name)
+    return model
+
+def warm_up(model, encodes=WARMUP_ENCODES):
+    """Run a few encodes so the first requests don't pay for lazy kernel and tokenizer setup"""
+    for i in range(encodes):
+        model.encode(WARMUP_TEXTS[:i % len(WARMUP_TEXTS) + 1])
+
+def bake_model(name=EMBEDDING_MODEL_NAME, path=EMBEDDING_MODEL_PATH):
+    from sentence_transformers import SentenceTransformer
+    SentenceTransformer(name).save(path)
+    print(f"Saved {name} to {path}")
+
+if __name__ == "__main__":
+    bake_model()
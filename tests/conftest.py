@@ -0,0 +1,9 @@
+import os
+import sys
+
+# main.py and the store modules read their configuration at import time
+os.environ.setdefault("LLM_BACKEND", "fake")
+os.environ.setdefault("VECTOR_STORE", "fake")
+os.environ.setdefault("FAKE_LLM_LATENCY_SECONDS", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
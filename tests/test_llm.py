@@ -0,0 +1,46 @@
+import asyncio
+
+from llm import FakeBackend, GenerationEngine, GenerationResult, create_engine
+
+class FailingBackend(FakeBackend):
+    name = "failing"
+
+    async def agenerate(self, payload):
+        raise RuntimeError("quota exceeded")
+
+    async def astream(self, payload):
+        yield "partial"
+        raise RuntimeError("stream reset")
+
+def stream(engine, payload):
+    result = GenerationResult(text="")
+
+    async def collect():
+        return [chunk async for chunk in engine.astream(payload, result)]
+    return asyncio.run(collect()), result
+
+def test_agenerate_times_the_call():
+    engine = GenerationEngine(FakeBackend(latency_seconds=0.05))
+    result = asyncio.run(engine.agenerate('{"query": "sort a list"}'))
+    assert result.text.startswith("Fake response")
+    assert result.error == ""
+    assert result.generation_time_seconds >= 0.05
+
+def test_agenerate_reports_backend_errors():
+    result = asyncio.run(GenerationEngine(FailingBackend()).agenerate("{}"))
+    assert result.text == ""
+    assert result.error == "quota exceeded"
+
+def test_astream_fills_in_the_result():
+    engine = create_engine("fake")
+    chunks, result = stream(engine, '{"query": "sort a list"}')
+    assert "".join(chunks) == result.text
+    assert result.text == asyncio.run(engine.agenerate('{"query": "sort a list"}')).text
+    assert result.error == ""
+    assert result.generation_time_seconds >= 0
+
+def test_astream_keeps_partial_text_on_error():
+    chunks, result = stream(GenerationEngine(FailingBackend()), "{}")
+    assert chunks == ["partial"]
+    assert result.text == "partial"
+    assert result.error == "stream reset"
@@ -0,0 +1,38 @@
+import asyncio
+import json
+
+import pytest
+
+import main
+from concurrency import OverloadedError
+from startup import StartupTracker
+
+@pytest.fixture
+def tracker(monkeypatch):
+    tracker = StartupTracker()
+    monkeypatch.setattr(main, "startup", tracker)
+    return tracker
+
+def test_failed_component_blocks_requests(tracker):
+    with tracker.component("vector_store"):
+        pass
+    with tracker.component("embedding_model"):
+        raise RuntimeError("no model")
+    tracker.finished = True
+
+    with pytest.raises(OverloadedError) as rejected:
+        main.require_started()
+    assert rejected.value.status_code == 503
+    assert "embedding_model" in rejected.value.message
+
+    response = asyncio.run(main.readyz())
+    assert response.status_code == 503
+    assert json.loads(response.body)["failed"] == ["embedding_model"]
+
+def test_loaded_components_pass(tracker):
+    with tracker.component("vector_store"):
+        pass
+    tracker.finished = True
+
+    main.require_started()
+    assert asyncio.run(main.readyz()).status_code == 200
@@ -0,0 +1,80 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import main
+from vector_store import LocalVectorStore, base_store
+from namespace_stats import record_bytes
+
+NAMESPACE = "user-1"
+
+def unit(seed):
+    vector = np.random.default_rng(seed).normal(size=384).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+@pytest.fixture(params=[False, True], ids=["no-document-store", "document-store"])
+def stack(request, monkeypatch):
+    """The server's wrapper stack as connect_vector_store() builds it, with call counts on the base store"""
+    monkeypatch.setattr(main, "DOCUMENT_STORE", request.param)
+    monkeypatch.setattr(main, "HYBRID_SEARCH", True)
+    main.connect_vector_store()
+    store = main.vector_store
+    base = base_store(store)
+    assert isinstance(base, LocalVectorStore)
+    calls = {"query": 0, "query_many": 0}
+    for name in calls:
+        original = getattr(base, name)
+
+        async def counted(*args, _original=original, _name=name, **kwargs):
+            calls[_name] += 1
+            return await _original(*args, **kwargs)
+        monkeypatch.setattr(base, name, counted)
+    base.latency_seconds = 0
+    yield store, calls
+    asyncio.run(store.close())
+    main.vector_store = None
+
+def seed(store):
+    asyncio.run(store.upsert([
+        {"id": f"c{i}", "values": unit(i),
+         "metadata": {"user_prompt": f"parse_config_{i} fails", "ai_response": "check the path", "timestamp": "2024-01-01"}}
+        for i in range(20)
+    ], NAMESPACE))
+
+def test_query_many_reaches_the_grouped_search(stack):
+    store, calls = stack
+    seed(store)
+    results = asyncio.run(store.query_many([unit(i) for i in range(5)], NAMESPACE, top_k=3))
+    assert calls == {"query": 0, "query_many": 1}
+    assert [result.matches[0].id for result in results] == [f"c{i}" for i in range(5)]
+
+def test_hybrid_query_many_reaches_the_grouped_search(stack):
+    store, calls = stack
+    seed(store)
+
+    async def search():
+        await store.ensure_index(NAMESPACE)
+        return await store.hybrid_query_many([unit(i) for i in range(5)],
+                                             [f"parse_config_{i}" for i in range(5)], NAMESPACE, top_k=3)
+    results = asyncio.run(search())
+    assert calls == {"query": 0, "query_many": 1}
+    assert [result.matches[0].id for result in results] == [f"c{i}" for i in range(5)]
+    # Fusion orders the matches but leaves score as the cosine similarity
+    assert all(result.matches[0].score == pytest.approx(1.0, abs=1e-5) for result in results)
+    assert all(result.matches[0].fused_score == pytest.approx(1.0) for result in results)
+
+def test_user_stats_count_what_the_base_store_holds(stack):
+    store, _ = stack
+    seed(store)
+    base = base_store(store).namespaces[NAMESPACE]
+    expected = sum(record_bytes(base.matrix[row], base.metadata[row]) for row in range(len(base)))
+
+    stats = asyncio.run(store.namespace_stats(NAMESPACE))
+    assert stats["count"] == 20
+    assert stats["bytes"] == expected
+
+    asyncio.run(store.delete(["c0"], NAMESPACE))
+    after_delete = asyncio.run(store.namespace_stats(NAMESPACE))
+    assert after_delete["count"] == 19
+    assert after_delete["last_write"] == stats["last_write"]
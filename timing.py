@@ -0,0 +1,37 @@
+import os
+import time
+import contextvars
+from contextlib import contextmanager
+
+import metrics
+
+TIMING_BREAKDOWN = os.getenv("TIMING_BREAKDOWN", "0") == "1"
+
+# Stage durations for the request being handled; tasks spawned by the request share the dict
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+def start_request_timings():
+    """Begin collecting stage timings for the current request and return the dict they go into"""
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+def clear_request_timings():
+    """Detach background work from the request that happened to start it"""
+    _request_timings.set(None)
+
+def record_stage(name, seconds):
+    """Add a measured duration to the stage histogram and the current request's timings"""
+    metrics.STAGE_SECONDS.observe(seconds, stage=name)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = round(timings.get(name, 0.0) + seconds, 4)
+
+@contextmanager
+def stage(name):
+    """Time a block and record it under name"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start_time)
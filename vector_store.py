@@ -0,0 +1,539 @@
+import os
+import json
+import base64
+import asyncio
+import hashlib
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+
+VECTOR_STORE = os.getenv("VECTOR_STORE", "pinecone")
+LOCAL_VECTOR_STORE_PATH = os.getenv("LOCAL_VECTOR_STORE_PATH", "vector_data")
+# The local store is the system of record, so changed namespaces are written out this often, not just on shutdown
+LOCAL_VECTOR_STORE_FLUSH_SECONDS = float(os.getenv("LOCAL_VECTOR_STORE_FLUSH_SECONDS", "30"))
+# Flushes append to a per-namespace log; the namespace is rewritten once its log holds this many writes per vector
+LOCAL_VECTOR_STORE_COMPACT_RATIO = float(os.getenv("LOCAL_VECTOR_STORE_COMPACT_RATIO", "0.5"))
+LOCAL_VECTOR_STORE_COMPACT_MIN_WRITES = 1000
+FAKE_VECTOR_STORE_LATENCY_SECONDS = float(os.getenv("FAKE_VECTOR_STORE_LATENCY_SECONDS", "0"))
+EMBEDDING_DIMENSION = 384  # all-MiniLM-L6-v2 dimension
+# serve.py runs WORKERS processes against one store, and each one only sees its own writes
+SHARED_WRITERS = int(os.getenv("WORKERS", "1")) > 1
+
+@dataclass
+class Match:
+    id: str
+    score: float
+    metadata: Optional[dict] = None
+    # Rescaled reciprocal-rank-fusion score, set by hybrid search; score stays the cosine similarity
+    fused_score: Optional[float] = None
+
+@dataclass
+class QueryResult:
+    matches: List[Match]
+    namespace: str = ""
+
+@dataclass
+class NamespaceStats:
+    vector_count: int
+
+@dataclass
+class IndexStats:
+    dimension: int
+    total_vector_count: int
+    namespaces: Dict[str, NamespaceStats] = field(default_factory=dict)
+
+class VectorStore:
+    """Operations the app needs from a vector index, shaped after the Pinecone client"""
+
+    async def upsert(self, vectors, namespace):
+        raise NotImplementedError
+
+    async def query(self, vector, namespace, top_k=10, filter=None, include_metadata=True):
+        raise NotImplementedError
+
+    async def query_many(self, vectors, namespace, top_k=10, filter=None, include_metadata=True):
+        """One result per vector, in order; stores that can search several vectors at once override this"""
+        return list(await asyncio.gather(*(
+            self.query(vector, namespace, top_k, filter, include_metadata) for vector in vectors
+        )))
+
+    async def delete(self, ids, namespace):
+        raise NotImplementedError
+
+    async def fetch(self, ids, namespace):
+        """{id: metadata} for the ids that exist in the namespace"""
+        raise NotImplementedError
+
+    async def describe_index_stats(self, filter=None):
+        raise NotImplementedError
+
+    async def records(self, namespace):
+        """Yield every (id, values, metadata) in a namespace, for maintenance jobs"""
+        raise NotImplementedError
+        yield
+
+    async def close(self):
+        pass
+
+class PineconeVectorStore(VectorStore):
+    """Async access to a Pinecone index"""
+
+    def __init__(self, pc, index_name):
+        self.pc = pc
+        self.index_name = index_name
+        # Resolve the host once; the async client itself is created inside the event loop
+        self.host = pc.describe_index(index_name).host
+        self._index = None
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = self.pc.IndexAsyncio(host=self.host)
+        return self._index
+
+    async def upsert(self, vectors, namespace):
+        return await self._get_index().upsert(vectors=vectors, namespace=namespace)
+
+    async def query(self, vector, namespace, top_k=10, filter=None, include_metadata=True):
+        return await self._get_index().query(
+            vector=vector,
+            namespace=namespace,
+            top_k=top_k,
+            filter=filter,
+            include_metadata=include_metadata
+        )
+
+    async def delete(self, ids, namespace):
+        return await self._get_index().delete(ids=ids, namespace=namespace)
+
+    async def fetch(self, ids, namespace):
+        fetched = await self._get_index().fetch(ids=list(ids), namespace=namespace)
+        return {vector_id: vector.metadata or {} for vector_id, vector in fetched.vectors.items()}
+
+    async def describe_index_stats(self, filter=None):
+        return await self._get_index().describe_index_stats(filter=filter)
+
+    async def records(self, namespace):
+        index = self._get_index()
+        pagination_token = None
+        while True:
+            page = await index.list_paginated(namespace=namespace, limit=100, pagination_token=pagination_token)
+            ids = [item.id for item in page.vectors]
+            if ids:
+                fetched = await index.fetch(ids=ids, namespace=namespace)
+                for vector_id, vector in fetched.vectors.items():
+                    yield vector_id, vector.values, vector.metadata or {}
+            pagination_token = page.pagination.next if page.pagination else None
+            if not pagination_token:
+                break
+
+    async def close(self):
+        if self._index is not None:
+            await self._index.close()
+            self._index = None
+
+def base_store(store):
+    """The store underneath any wrapping stores (wrappers keep the wrapped one in .store)"""
+    while isinstance(getattr(store, "store", None), VectorStore):
+        store = store.store
+    return store
+
+def matches_filter(metadata, filter):
+    """Evaluate a Pinecone-style metadata filter ($eq, $ne, $in, $nin, $and, $or)"""
+    if not filter:
+        return True
+    metadata = metadata or {}
+    for key, condition in filter.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, part) for part in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches_filter(metadata, part) for part in condition):
+                return False
+            continue
+
+        value = metadata.get(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for operator, expected in condition.items():
+            if operator == "$eq" and value != expected:
+                return False
+            if operator == "$ne" and value == expected:
+                return False
+            if operator == "$in" and value not in expected:
+                return False
+            if operator == "$nin" and value in expected:
+                return False
+    return True
+
+def normalize_vector_records(vectors):
+    """Accept the dict and tuple upsert formats the Pinecone client accepts"""
+    records = []
+    for vector in vectors:
+        if isinstance(vector, dict):
+            records.append((vector["id"], vector["values"], vector.get("metadata") or {}))
+        else:
+            vector_id, values = vector[0], vector[1]
+            records.append((vector_id, values, vector[2] if len(vector) > 2 else {}))
+    return records
+
+class LocalNamespace:
+    """Normalized vectors for one namespace in a growable float32 matrix"""
+
+    def __init__(self, name, dimension, matrix=None, ids=None, metadata=None):
+        self.name = name
+        self.dimension = dimension
+        self.ids = ids or []
+        self.metadata = metadata or []
+        self.rows = {vector_id: row for row, vector_id in enumerate(self.ids)}
+        # A loaded namespace starts on a read-only memory map and is copied on first write
+        self.matrix = matrix if matrix is not None else np.zeros((0, dimension), dtype=np.float32)
+        # Writes not yet on disk, as ("upsert", records) / ("delete", ids); None when nothing is persisted
+        self.pending = None
+        # Writes in the on-disk log since the namespace was last rewritten
+        self.logged = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _writable(self, capacity):
+        if self.matrix.flags.writeable and self.matrix.shape[0] >= capacity:
+            return
+        new_capacity = max(capacity, self.matrix.shape[0] * 2, 16)
+        matrix = np.zeros((new_capacity, self.dimension), dtype=np.float32)
+        matrix[:len(self.ids)] = self.matrix[:len(self.ids)]
+        self.matrix = matrix
+
+    def upsert(self, records):
+        self._writable(len(self.ids) + len(records))
+        written = []
+        for vector_id, values, metadata in records:
+            vector = np.asarray(values, dtype=np.float32)
+            if vector.shape != (self.dimension,):
+                raise ValueError(f"Vector {vector_id} has dimension {vector.shape[-1]}, expected {self.dimension}")
+            norm = np.linalg.norm(vector)
+            vector = vector / norm if norm else vector.copy()
+
+            row = self.rows.get(vector_id)
+            if row is None:
+                row = len(self.ids)
+                self.rows[vector_id] = row
+                self.ids.append(vector_id)
+                self.metadata.append(metadata)
+            else:
+                self.metadata[row] = metadata
+            self.matrix[row] = vector
+            if self.pending is not None:
+                written.append((vector_id, vector, metadata))
+        if self.pending is not None:
+            self.pending.append(("upsert", written))
+
+    def delete(self, ids):
+        self._writable(len(self.ids))
+        for vector_id in ids:
+            row = self.rows.pop(vector_id, None)
+            if row is None:
+                continue
+            # Move the last row into the hole so the matrix stays dense
+            last = len(self.ids) - 1
+            if row != last:
+                self.matrix[row] = self.matrix[last]
+                self.ids[row] = self.ids[last]
+                self.metadata[row] = self.metadata[last]
+                self.rows[self.ids[row]] = row
+            self.ids.pop()
+            self.metadata.pop()
+        if self.pending is not None:
+            self.pending.append(("delete", list(ids)))
+
+    def query(self, vector, top_k, filter=None, include_metadata=True):
+        return self.query_many([vector], top_k, filter, include_metadata)[0]
+
+    def query_many(self, vectors, top_k, filter=None, include_metadata=True):
+        """Top matches for each vector from a single pass over the matrix"""
+        count = len(self.ids)
+        if count == 0 or top_k <= 0:
+            return [[] for _ in vectors]
+
+        queries = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.dimension)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+        scores = self.matrix[:count] @ queries.T
+
+        if filter:
+            mask = np.fromiter((matches_filter(metadata, filter) for metadata in self.metadata),
+                               dtype=bool, count=count)
+            scores = np.where(mask[:, None], scores, -np.inf)
+            count = int(mask.sum())
+            if count == 0:
+                return [[] for _ in vectors]
+
+        return [self._top_matches(scores[:, column], min(top_k, count), include_metadata)
+                for column in range(len(vectors))]
+
+    def _top_matches(self, scores, top_k, include_metadata):
+        if top_k < len(scores):
+            candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(len(scores))
+        candidates = candidates[np.argsort(-scores[candidates])][:top_k]
+        return [
+            Match(
+                id=self.ids[row],
+                score=float(scores[row]),
+                metadata=self.metadata[row] if include_metadata else None
+            )
+            for row in candidates
+        ]
+
+class LocalVectorStore(VectorStore):
+    """In-process vector index with per-namespace NumPy matrices, persisted as .npy files
+
+    Writes stay in memory until flush(), persist() or close(), which append them to a
+    per-namespace log; a namespace's .npy and metadata are only rewritten once its log
+    has grown past LOCAL_VECTOR_STORE_COMPACT_RATIO writes per vector. Loading
+    memory-maps the saved matrices so startup does not read every vector up front.
+    """
+
+    def __init__(self, path=LOCAL_VECTOR_STORE_PATH, dimension=EMBEDDING_DIMENSION):
+        self.path = path
+        self.dimension = dimension
+        self.namespaces = {}
+        # Snapshots taken on the event loop, written in order by whichever thread gets the lock first
+        self._writes = deque()
+        self._write_lock = threading.Lock()
+        self._journal = False
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._load()
+            self._journal = True
+
+    def _files(self, namespace):
+        name = hashlib.sha1(namespace.encode("utf-8")).hexdigest()
+        base = os.path.join(self.path, name)
+        return f"{base}.npy", f"{base}.json", f"{base}.log"
+
+    def _load(self):
+        filenames = sorted(os.listdir(self.path))
+        for filename in filenames:
+            if not filename.endswith(".json"):
+                continue
+            with open(os.path.join(self.path, filename)) as f:
+                saved = json.load(f)
+            matrix_file, _, _ = self._files(saved["namespace"])
+            matrix = np.load(matrix_file, mmap_mode="r")
+            self.namespaces[saved["namespace"]] = LocalNamespace(
+                saved["namespace"], self.dimension, matrix, saved["ids"], saved["metadata"]
+            )
+        for filename in filenames:
+            if filename.endswith(".log"):
+                self._replay(os.path.join(self.path, filename))
+        for namespace in self.namespaces.values():
+            namespace.pending = []
+        if self.namespaces:
+            print(f"Loaded {len(self.namespaces)} namespaces from local vector store at {self.path}")
+
+    def _replay(self, log_file):
+        with open(log_file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A crash mid-append leaves at most one torn line at the end
+                    break
+                namespace = self._namespace(entry["namespace"])
+                if "upsert" in entry:
+                    namespace.upsert([
+                        (vector_id, np.frombuffer(base64.b64decode(values), dtype=np.float32), metadata)
+                        for vector_id, values, metadata in entry["upsert"]
+                    ])
+                else:
+                    namespace.delete(entry["delete"])
+                namespace.logged += 1
+
+    def _snapshot(self):
+        """Queue the writes made since the last snapshot; cheap enough to run on the event loop"""
+        work = []
+        for namespace in list(self.namespaces.values()):
+            if not namespace.pending:
+                continue
+            writes, namespace.pending = namespace.pending, []
+            namespace.logged += len(writes)
+            if len(namespace) == 0:
+                work.append((namespace.name, "remove", None))
+                del self.namespaces[namespace.name]
+            elif namespace.logged >= max(LOCAL_VECTOR_STORE_COMPACT_MIN_WRITES,
+                                         len(namespace) * LOCAL_VECTOR_STORE_COMPACT_RATIO):
+                namespace.logged = 0
+                rows = len(namespace)
+                work.append((namespace.name, "rewrite",
+                             (np.array(namespace.matrix[:rows]), list(namespace.ids), list(namespace.metadata))))
+            else:
+                work.append((namespace.name, "append", writes))
+        if work:
+            self._writes.append(work)
+
+    def _write_snapshots(self):
+        with self._write_lock:
+            while self._writes:
+                for name, action, data in self._writes.popleft():
+                    getattr(self, f"_{action}")(name, data)
+
+    def _append(self, name, writes):
+        lines = []
+        for kind, data in writes:
+            if kind == "upsert":
+                data = [[vector_id, base64.b64encode(vector.tobytes()).decode("ascii"), metadata]
+                        for vector_id, vector, metadata in data]
+            lines.append(json.dumps({"namespace": name, kind: data}) + "\n")
+        _, _, log_file = self._files(name)
+        with open(log_file, "a") as f:
+            f.writelines(lines)
+
+    def _rewrite(self, name, snapshot):
+        matrix, ids, metadata = snapshot
+        matrix_file, meta_file, log_file = self._files(name)
+        # Write to temp files and rename so a crash never leaves a torn namespace. A crash before
+        # the log is removed only means it is replayed again, which gives the same vectors.
+        with open(matrix_file + ".tmp", "wb") as f:
+            np.save(f, matrix)
+        with open(meta_file + ".tmp", "w") as f:
+            json.dump({"namespace": name, "ids": ids, "metadata": metadata}, f)
+        os.replace(matrix_file + ".tmp", matrix_file)
+        os.replace(meta_file + ".tmp", meta_file)
+        if os.path.exists(log_file):
+            os.remove(log_file)
+
+    def _remove(self, name, _):
+        for stale in self._files(name):
+            if os.path.exists(stale):
+                os.remove(stale)
+
+    def flush(self):
+        """Persist every write made since the last flush, blocking until it is on disk"""
+        if not self.path:
+            return
+        self._snapshot()
+        self._write_snapshots()
+
+    async def persist(self):
+        """flush() with the file writes in a worker thread instead of on the event loop"""
+        if not self.path:
+            return
+        self._snapshot()
+        await asyncio.to_thread(self._write_snapshots)
+
+    def _namespace(self, namespace):
+        if namespace not in self.namespaces:
+            self.namespaces[namespace] = LocalNamespace(namespace, self.dimension)
+            if self._journal:
+                self.namespaces[namespace].pending = []
+        return self.namespaces[namespace]
+
+    async def upsert(self, vectors, namespace):
+        records = normalize_vector_records(vectors)
+        self._namespace(namespace).upsert(records)
+        return {"upserted_count": len(records)}
+
+    async def query(self, vector, namespace, top_k=10, filter=None, include_metadata=True):
+        store = self.namespaces.get(namespace)
+        matches = store.query(vector, top_k, filter, include_metadata) if store else []
+        return QueryResult(matches=matches, namespace=namespace)
+
+    async def query_many(self, vectors, namespace, top_k=10, filter=None, include_metadata=True):
+        store = self.namespaces.get(namespace)
+        if not store:
+            return [QueryResult(matches=[], namespace=namespace) for _ in vectors]
+        return [QueryResult(matches=matches, namespace=namespace)
+                for matches in store.query_many(vectors, top_k, filter, include_metadata)]
+
+    async def delete(self, ids, namespace):
+        store = self.namespaces.get(namespace)
+        if store:
+            store.delete(ids)
+        return {}
+
+    async def fetch(self, ids, namespace):
+        store = self.namespaces.get(namespace)
+        if not store:
+            return {}
+        return {vector_id: store.metadata[store.rows[vector_id]] for vector_id in ids if vector_id in store.rows}
+
+    async def describe_index_stats(self, filter=None):
+        namespaces = {}
+        for name, store in self.namespaces.items():
+            if filter:
+                count = sum(1 for metadata in store.metadata if matches_filter(metadata, filter))
+            else:
+                count = len(store)
+            if count:
+                namespaces[name] = NamespaceStats(vector_count=count)
+        return IndexStats(
+            dimension=self.dimension,
+            total_vector_count=sum(stats.vector_count for stats in namespaces.values()),
+            namespaces=namespaces
+        )
+
+    async def records(self, namespace):
+        store = self.namespaces.get(namespace)
+        if not store:
+            return
+        # Snapshot first so writes during iteration don't shift rows
+        ids, metadata, matrix = list(store.ids), list(store.metadata), np.array(store.matrix[:len(store)])
+        for row, vector_id in enumerate(ids):
+            yield vector_id, matrix[row], metadata[row]
+
+    async def close(self):
+        self.flush()
+
+class FakeVectorStore(LocalVectorStore):
+    """Unpersisted local store that adds a fixed delay per call to stand in for Pinecone round trips"""
+
+    def __init__(self, latency_seconds=FAKE_VECTOR_STORE_LATENCY_SECONDS, dimension=EMBEDDING_DIMENSION):
+        super().__init__(path="", dimension=dimension)
+        self.latency_seconds = latency_seconds
+
+    async def _delay(self):
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+
+    async def upsert(self, vectors, namespace):
+        await self._delay()
+        return await super().upsert(vectors, namespace)
+
+    async def query(self, vector, namespace, top_k=10, filter=None, include_metadata=True):
+        await self._delay()
+        return await super().query(vector, namespace, top_k, filter, include_metadata)
+
+    async def query_many(self, vectors, namespace, top_k=10, filter=None, include_metadata=True):
+        await self._delay()
+        return await super().query_many(vectors, namespace, top_k, filter, include_metadata)
+
+    async def delete(self, ids, namespace):
+        await self._delay()
+        return await super().delete(ids, namespace)
+
+    async def fetch(self, ids, namespace):
+        await self._delay()
+        return await super().fetch(ids, namespace)
+
+    async def describe_index_stats(self, filter=None):
+        await self._delay()
+        return await super().describe_index_stats(filter)
+
+def create_vector_store(backend=None):
+    """Create the configured vector store ("pinecone", "local" or "fake")"""
+    backend = backend or VECTOR_STORE
+    if backend == "local":
+        return LocalVectorStore()
+    if backend == "fake":
+        return FakeVectorStore()
+    if backend == "pinecone":
+        # Imported here so the local backend runs without the Pinecone client
+        from pinecone import Pinecone
+        pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
+        return PineconeVectorStore(pc, os.getenv("PINECONE_INDEX_NAME", "conversation-history"))
+    raise ValueError(f"Unknown vector store '{backend}', expected 'pinecone', 'local' or 'fake'")
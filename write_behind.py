@@ -0,0 +1,160 @@
+import os
+import time
+import random
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional
+
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "1") == "1"
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "64"))
+WRITE_FLUSH_MS = float(os.getenv("WRITE_FLUSH_MS", "50"))
+WRITE_QUEUE_MAX_SIZE = int(os.getenv("WRITE_QUEUE_MAX_SIZE", "10000"))
+WRITE_MAX_RETRIES = int(os.getenv("WRITE_MAX_RETRIES", "5"))
+WRITE_RETRY_BASE_SECONDS = float(os.getenv("WRITE_RETRY_BASE_SECONDS", "0.5"))
+WRITE_DRAIN_TIMEOUT_SECONDS = float(os.getenv("WRITE_DRAIN_TIMEOUT_SECONDS", "30"))
+
+@dataclass
+class PendingWrite:
+    user_id: str
+    user_prompt: str
+    ai_response: str
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # The request's embedding memo, so vectors computed on the request path are reused
+    embeddings: Optional[dict] = None
+    context_hash: Optional[str] = None
+
+class WriteBehindQueue:
+    """Stores completed exchanges in the background, batching upserts per namespace
+
+    write_batch(user_id, items) must raise on failure so the batch is retried.
+    """
+
+    def __init__(self, write_batch, batch_size=WRITE_BATCH_SIZE, flush_ms=WRITE_FLUSH_MS,
+                 max_size=WRITE_QUEUE_MAX_SIZE, max_retries=WRITE_MAX_RETRIES,
+                 retry_base_seconds=WRITE_RETRY_BASE_SECONDS):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_seconds = flush_ms / 1000.0
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.retry_base_seconds = retry_base_seconds
+        self.processed = 0
+        self.failed = 0
+        self.retries = 0
+        self.rejected = 0
+        self.last_lag_seconds = 0.0
+        self.max_lag_seconds = 0.0
+        self._enqueue_times = deque()
+        # Created on first use so they bind to the running event loop
+        self._queue = None
+        self._worker = None
+        self._writes = {}  # user_id -> task writing that user's latest batch
+
+    def submit(self, item):
+        """Queue an exchange for storage; returns False if the queue is full"""
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_size)
+            self._worker = asyncio.create_task(self._run())
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self._enqueue_times.append(item.enqueued_at)
+        return True
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_seconds
+        while len(batch) < self.batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        for _ in batch:
+            self._enqueue_times.popleft()
+        return batch
+
+    async def _write_namespace(self, user_id, items):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.write_batch(user_id, items)
+                self.processed += len(items)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    self.failed += len(items)
+                    print(f"Giving up storing {len(items)} conversations for user {user_id}: {e}")
+                    break
+                self.retries += 1
+                delay = self.retry_base_seconds * (2 ** attempt)
+                print(f"Error storing conversations for user {user_id}, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+
+        now = time.monotonic()
+        for item in items:
+            lag = now - item.enqueued_at
+            self.last_lag_seconds = lag
+            self.max_lag_seconds = max(self.max_lag_seconds, lag)
+
+    async def _write_after(self, previous, user_id, items):
+        queue = self._queue
+        try:
+            # One user's batches are written in order, each after the previous one finished
+            if previous is not None:
+                await asyncio.wait({previous})
+            await self._write_namespace(user_id, items)
+        finally:
+            for _ in items:
+                queue.task_done()
+            if self._writes.get(user_id) is asyncio.current_task():
+                del self._writes[user_id]
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            by_user = {}
+            for item in batch:
+                by_user.setdefault(item.user_id, []).append(item)
+            # Writes run as their own tasks so a namespace backing off between retries
+            # doesn't hold up the next batch for everyone else
+            for user_id, items in by_user.items():
+                previous = self._writes.get(user_id)
+                self._writes[user_id] = asyncio.create_task(self._write_after(previous, user_id, items))
+
+    async def close(self, timeout=WRITE_DRAIN_TIMEOUT_SECONDS):
+        """Drain pending writes, then stop the worker"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Write-behind queue not drained after {timeout}s, dropping {self._queue.qsize()} conversations")
+        self._worker.cancel()
+        for write in self._writes.values():
+            write.cancel()
+        await asyncio.gather(self._worker, *self._writes.values(), return_exceptions=True)
+        self._writes = {}
+        self._queue = None
+        self._worker = None
+
+    def stats(self):
+        oldest = self._enqueue_times[0] if self._enqueue_times else None
+        return {
+            "depth": self._queue.qsize() if self._queue is not None else 0,
+            "oldest_pending_seconds": round(time.monotonic() - oldest, 3) if oldest is not None else 0.0,
+            "last_lag_seconds": round(self.last_lag_seconds, 3),
+            "max_lag_seconds": round(self.max_lag_seconds, 3),
+            "processed": self.processed,
+            "failed": self.failed,
+            "retries": self.retries,
+            "rejected": self.rejected,
+        }